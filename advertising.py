@@ -0,0 +1,250 @@
+"""
+Advertising data laid out within the legacy advertising payload budget.
+
+A legacy advertisement carries 31 bytes of advertising data plus 31 bytes
+of scan response, and every AD structure costs a length and a type byte on
+top of its data. BlueZ rejects or truncates content that does not fit, so
+AdvertisingManager works out the encoded size of every field up front and
+packs the fields, in the order they were added, into the advertising data,
+then the scan response, then further advertisement instances.
+
+Fields can rotate through several values on a timer or be set to a new
+value later. Their slot is sized for the largest value, so changes are
+pushed to BlueZ with PropertiesChanged on the registered advertisement
+instead of unregistering and registering it again.
+"""
+
+import logging
+
+import dbus
+
+from ble import GLib, Advertisement
+
+logger = logging.getLogger(__name__)
+
+LEGACY_PAYLOAD_SIZE = 31
+# BlueZ puts a Flags structure in front of the data of peripheral advertisements
+FLAGS_SIZE = 3
+
+UUID = "uuid"
+MANUFACTURER = "manufacturer"
+SERVICE = "service"
+NAME = "name"
+TX_POWER = "tx-power"
+DATA = "data"
+
+# Advertisement attribute and LEAdvertisement1 property of each kind of
+# field, in the advertising data and in the scan response
+_TARGETS = {
+    UUID: (("service_uuids", "ServiceUUIDs"),
+           ("scan_response_service_uuids", "ScanResponseServiceUUIDs")),
+    MANUFACTURER: (("manufacturer_data", "ManufacturerData"),
+                   ("scan_response_manufacturer_data", "ScanResponseManufacturerData")),
+    SERVICE: (("service_data", "ServiceData"),
+              ("scan_response_service_data", "ScanResponseServiceData")),
+    DATA: (("data", "Data"), ("scan_response_data", "ScanResponseData")),
+    # BlueZ always sends the local name in the scan response and the TX
+    # power level in the advertising data
+    NAME: (None, ("local_name", "LocalName")),
+    TX_POWER: (("include_tx_power", "IncludeTxPower"), None),
+}
+
+
+def uuid_size(uuid):
+    digits = len(uuid.replace("-", ""))
+    return {4: 2, 8: 4}.get(digits, 16)
+
+
+class AdField:
+    """
+    One AD structure. `values` are the values it rotates through, the first
+    one is advertised until rotate() or set() says otherwise. Fields that
+    passive scanners must see are kept out of the scan response.
+    """
+
+    def __init__(self, kind, key=None, values=(None,), scan_response=True):
+        if kind not in _TARGETS:
+            raise ValueError("unknown advertising field kind %r" % kind)
+        self.kind = kind
+        self.key = key
+        self.values = list(values)
+        self.scan_response = scan_response
+        self.current = 0
+        self.reserved = max(self.size(value) for value in self.values)
+        # (Advertisement, scan response?) once laid out
+        self.placement = None
+
+    @property
+    def value(self):
+        return self.values[self.current]
+
+    def size(self, value):
+        """
+        Encoded size in bytes. For a service UUID this leaves out the
+        two byte header its list shares with UUIDs of the same width.
+        """
+        if self.kind == UUID:
+            return uuid_size(self.key)
+        if self.kind == MANUFACTURER:
+            return 4 + len(value)
+        if self.kind == SERVICE:
+            return 2 + uuid_size(self.key) + len(value)
+        if self.kind == NAME:
+            return 2 + len(value.encode("utf-8"))
+        if self.kind == TX_POWER:
+            return 3
+        return 2 + len(value)
+
+
+class _Payload:
+    """
+    The advertising data or the scan response of one instance being laid out
+    """
+
+    def __init__(self, budget, scan_response):
+        self.free = budget
+        self.scan_response = scan_response
+        self.fields = []
+        self._uuid_sizes = set()
+
+    def cost(self, field):
+        if field.kind == UUID and uuid_size(field.key) not in self._uuid_sizes:
+            return 2 + field.reserved
+        return field.reserved
+
+    def add(self, field):
+        if _TARGETS[field.kind][self.scan_response] is None:
+            return False
+        if self.scan_response and not field.scan_response:
+            return False
+        cost = self.cost(field)
+        if cost > self.free:
+            return False
+        self.free -= cost
+        self.fields.append(field)
+        if field.kind == UUID:
+            self._uuid_sizes.add(uuid_size(field.key))
+        return True
+
+
+class AdvertisingManager:
+    """
+    Lays advertising fields out over up to max_instances advertisements.
+    The first instance is advertised with ad_type, any others as broadcasts.
+    Add the fields, call build(), then register every one of `instances`.
+    """
+
+    def __init__(self, bus, path_base, ad_type="peripheral", max_instances=1,
+                 budget=LEGACY_PAYLOAD_SIZE):
+        self.bus = bus
+        self.path_base = path_base
+        self.ad_type = ad_type
+        self.max_instances = max_instances
+        self.budget = budget
+        self.fields = []
+        self.instances = []
+        self._rotations = {}
+
+    def add(self, kind, key=None, value=None, values=None, scan_response=True):
+        if self.instances:
+            raise RuntimeError("fields must be added before build()")
+        field = AdField(
+            kind, key, values if values is not None else (value,), scan_response
+        )
+        self.fields.append(field)
+        return field
+
+    def layout(self):
+        """
+        Returns [(advertising data, scan response)] payloads per instance,
+        or raises ValueError if the fields do not fit
+        """
+        payloads = []
+        for field in self.fields:
+            if not any(p.add(field) for payload in payloads for p in payload):
+                if len(payloads) == self.max_instances:
+                    raise ValueError(
+                        "%s field %s does not fit in %d advertisement(s)"
+                        % (field.kind, field.key or "", self.max_instances)
+                    )
+                flags = FLAGS_SIZE if not payloads and self.ad_type == "peripheral" else 0
+                payload = (_Payload(self.budget - flags, False), _Payload(self.budget, True))
+                payloads.append(payload)
+                if not any(p.add(field) for p in payload):
+                    raise ValueError(
+                        "%s field %s is larger than an advertisement"
+                        % (field.kind, field.key or "")
+                    )
+        return payloads
+
+    def build(self):
+        for index, (data, scan_response) in enumerate(self.layout()):
+            ad_type = self.ad_type if index == 0 else "broadcast"
+            ad = Advertisement(self.bus, index, ad_type, self.path_base)
+            for payload in (data, scan_response):
+                for field in payload.fields:
+                    field.placement = (ad, payload.scan_response)
+            self.instances.append(ad)
+            self._apply(ad)
+            logger.info(
+                "%s: %d bytes of advertising data, %d of scan response",
+                ad.path, self.budget - data.free, self.budget - scan_response.free,
+            )
+        return self.instances
+
+    def set(self, field, value):
+        """
+        Advertises value for field from now on, in place
+        """
+        if field.size(value) > field.reserved:
+            raise ValueError(
+                "%d byte value does not fit the %d byte %s field"
+                % (field.size(value), field.reserved, field.kind)
+            )
+        field.values[field.current] = value
+        self._refresh(field)
+
+    def rotate(self, field, interval):
+        """
+        Cycles field through its values every interval seconds
+        """
+        self.stop_rotation(field)
+        self._rotations[field] = GLib.timeout_add(int(interval * 1000), self._next, field)
+
+    def stop_rotation(self, field):
+        source = self._rotations.pop(field, None)
+        if source is not None:
+            GLib.source_remove(source)
+
+    def _next(self, field):
+        field.current = (field.current + 1) % len(field.values)
+        self._refresh(field)
+        return True
+
+    def _refresh(self, field):
+        if field.placement is None:
+            return
+        ad, scan_response = field.placement
+        self._apply(ad)
+        ad.update(_TARGETS[field.kind][scan_response][1])
+
+    def _apply(self, ad):
+        for targets in _TARGETS.values():
+            for target in targets:
+                if target is not None:
+                    setattr(ad, target[0], None)
+
+        for field in self.fields:
+            if field.placement is None or field.placement[0] is not ad:
+                continue
+            attribute = _TARGETS[field.kind][field.placement[1]][0]
+            if field.kind == UUID:
+                setattr(ad, attribute, (getattr(ad, attribute) or []) + [field.key])
+            elif field.kind in (MANUFACTURER, SERVICE, DATA):
+                content = getattr(ad, attribute) or {}
+                content[field.key] = dbus.Array(field.value, signature="y")
+                setattr(ad, attribute, content)
+            elif field.kind == NAME:
+                ad.local_name = field.value
+            else:
+                ad.include_tx_power = True
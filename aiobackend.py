@@ -0,0 +1,256 @@
+import asyncio
+import json
+import logging
+import time
+
+import metrics
+from backend import CircuitBreaker, VivaldiBackend, check_status
+from ble import FailedException
+from status import MachineStatus
+
+logger = logging.getLogger(__name__)
+
+# statuses a GET is retried on, like VivaldiBackend's urllib3 Retry
+RETRY_STATUSES = frozenset([502, 503, 504])
+
+
+class AsyncVivaldiBackend:
+    """
+    asyncio client for the Vivaldi machine backend, on aiohttp.
+
+    The coroutine counterpart of VivaldiBackend for handlers running on the
+    aioloop thread: the same paths, timeouts, retries of status GETs,
+    circuit breaker and metrics, but hundreds of calls can be in flight on
+    that one thread. `max_connections` caps the keep-alive connections they
+    share. Every method must be awaited on the aioloop thread.
+    """
+
+    STATUS_PATH = VivaldiBackend.STATUS_PATH
+    COMMANDS_PATH = VivaldiBackend.COMMANDS_PATH
+    TELEMETRY_PATH = VivaldiBackend.TELEMETRY_PATH
+
+    def __init__(
+        self,
+        base_url,
+        connect_timeout=2.0,
+        read_timeout=5.0,
+        retries=2,
+        backoff_factor=0.2,
+        max_connections=100,
+        breaker=None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_connections = max_connections
+        self.breaker = breaker or CircuitBreaker()
+        self._session = None
+        self._request_errors = ()
+
+    def _connect(self):
+        # aiohttp is only needed with the asyncio transport, and the session
+        # has to be created on the loop it will run on
+        import aiohttp
+
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_connections),
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=self.connect_timeout, sock_read=self.read_timeout
+            ),
+        )
+        self._request_errors = (aiohttp.ClientError, asyncio.TimeoutError)
+
+    async def _request(self, method, path, **kwargs):
+        labels = (("method", method), ("path", path))
+        if not self.breaker.allow():
+            metrics.registry.inc("backend_errors_total", labels + (("error", "circuit-open"),))
+            raise FailedException("Backend unavailable")
+
+        if self._session is None:
+            self._connect()
+        # only idempotent requests are retried, commands are sent once
+        attempts = 1 + (self.retries if method in ("GET", "HEAD") else 0)
+        start = time.perf_counter()
+        try:
+            for attempt in range(attempts):
+                if attempt:
+                    await asyncio.sleep(self.backoff_factor * 2 ** (attempt - 1))
+                try:
+                    async with self._session.request(
+                        method, self.base_url + path, **kwargs
+                    ) as res:
+                        if res.status in RETRY_STATUSES and attempt + 1 < attempts:
+                            continue
+                        status = res.status
+                        body = await res.read()
+                        break
+                except self._request_errors as e:
+                    if attempt + 1 < attempts:
+                        continue
+                    self.breaker.record_failure()
+                    metrics.registry.inc(
+                        "backend_errors_total", labels + (("error", type(e).__name__),)
+                    )
+                    logger.error("Backend %s %s failed: %s", method, path, e)
+                    raise FailedException(str(e) or type(e).__name__)
+        finally:
+            metrics.registry.observe(
+                "backend_request_seconds", time.perf_counter() - start, labels
+            )
+
+        check_status(self.breaker, method, path, status)
+        return body
+
+    async def get_status(self):
+        return json.loads(await self._request("GET", self.STATUS_PATH))
+
+    async def get_telemetry(self, since=None):
+        """
+        Returns the shot samples recorded after `since` (backend milliseconds),
+        or the backend's recent samples when since is None
+        """
+        params = {} if since is None else {"since": str(since)}
+        body = await self._request("GET", self.TELEMETRY_PATH, params=params)
+        return json.loads(body)["samples"]
+
+    async def send_command(self, data):
+        return await self._request("POST", self.COMMANDS_PATH, json=data)
+
+    async def send_commands(self, commands):
+        return await self._request("POST", self.COMMANDS_PATH, json=list(commands))
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+class AsyncCommandQueue:
+    """
+    backend.CommandQueue for an AsyncVivaldiBackend: the same coalescing and
+    batching, with asyncio futures and a loop timer instead of a main loop
+    timeout and a sender thread. submit() must be called on the aioloop
+    thread.
+    """
+
+    def __init__(self, backend, window=0.05, batch=False, on_sent=None):
+        self.backend = backend
+        self.window = window
+        self.batch = batch
+        self._on_sent = on_sent
+        self._pending = {}
+        self._timer = None
+
+    def submit(self, key, data):
+        """
+        Queues data under key and returns an asyncio Future for the backend
+        response
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        entry = self._pending.get(key)
+        if entry is None:
+            self._pending[key] = [data, [future]]
+        else:
+            logger.debug("coalescing command %s", key)
+            entry[0] = data
+            entry[1].append(future)
+        if self._timer is None:
+            self._timer = loop.call_later(
+                self.window, lambda: asyncio.ensure_future(self.flush())
+            )
+        return future
+
+    async def flush(self):
+        pending = self._pending
+        self._pending = {}
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not pending:
+            return
+
+        try:
+            if self.batch and len(pending) > 1:
+                commands = [data for data, futures in pending.values()]
+                futures = [f for data, fs in pending.values() for f in fs]
+                await self._send(self.backend.send_commands, commands, futures)
+            else:
+                for data, futures in pending.values():
+                    await self._send(self.backend.send_command, data, futures)
+        finally:
+            if self._on_sent is not None:
+                self._on_sent()
+
+    async def _send(self, send, data, futures):
+        try:
+            res = await send(data)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future in futures:
+            if not future.done():
+                future.set_result(res)
+
+
+class AsyncMachineStatus(MachineStatus):
+    """
+    status.MachineStatus for a coroutine `fetch`, such as an
+    AsyncVivaldiBackend's get_status. get() and field() are coroutines and,
+    like invalidate(), run on the aioloop thread, the only one touching the
+    snapshot. Concurrent readers await one shared refresh task.
+    """
+
+    async def get(self):
+        if self._is_fresh():
+            return self._snapshot
+        task = self._inflight
+        if task is None:
+            task = self._inflight = asyncio.ensure_future(self._run(self._generation))
+        if self.source == self.STORED:
+            # cold start or outage: answer now, refresh in the background
+            return self._snapshot
+        # a reader that goes away must not cancel the refresh others wait on
+        if self._snapshot is None:
+            return await asyncio.shield(task)
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), self.stale_wait)
+        except asyncio.TimeoutError:
+            logger.debug("status refresh is slow, serving the previous snapshot")
+            return self._snapshot
+
+    async def _run(self, generation):
+        try:
+            result = await self._fetch()
+        except Exception:
+            if self._snapshot is None:
+                raise
+            if self.source != self.STORED:
+                logger.warning("status refresh failed, serving the last good snapshot")
+                self.source = self.STORED
+            return self._snapshot
+        finally:
+            if self._inflight is asyncio.current_task():
+                self._inflight = None
+
+        # a snapshot fetched before an invalidation is already stale
+        if generation == self._generation:
+            self._snapshot = result
+            self._fetched_at = self._clock()
+            self.fetched_wall = time.time()
+            self.source = self.LIVE
+            if self._store is not None:
+                self._store.put(self._key, result, self.fetched_wall)
+        return result
+
+    async def field(self, name):
+        return (await self.get())[name]
+
+    def invalidate(self):
+        self._generation += 1
+        self._fetched_at = None
+        self._inflight = None
+        logger.debug("status snapshot invalidated")
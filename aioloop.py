@@ -0,0 +1,44 @@
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_loop = None
+_lock = threading.Lock()
+
+
+def loop():
+    """
+    Returns the asyncio event loop coroutine handlers run on, starting its
+    thread on first use.
+
+    dbus-python dispatches on the GLib main loop, so asyncio gets a thread
+    of its own next to it rather than replacing it. Every coroutine handler
+    and async backend call shares that one thread, however many are in
+    flight.
+    """
+    global _loop
+    with _lock:
+        if _loop is None:
+            new_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_run, args=(new_loop,), name="asyncio-loop", daemon=True
+            ).start()
+            _loop = new_loop
+    return _loop
+
+
+def _run(new_loop):
+    asyncio.set_event_loop(new_loop)
+    logger.debug("asyncio loop started")
+    new_loop.run_forever()
+
+
+def submit(coro):
+    """
+    Schedules coro on the asyncio loop from any thread and returns a
+    concurrent.futures.Future for its result
+    """
+    return asyncio.run_coroutine_threadsafe(coro, loop())
+
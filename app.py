@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
 
+import time
+
+# time-to-advertise is measured from here, before the heavy imports
+STARTED = time.monotonic()
+
 import logging
 
 import dbus
@@ -8,21 +13,36 @@ import dbus.mainloop.glib
 import dbus.service
 
 from ble import (
-    Advertisement,
     Characteristic,
     Service,
     Application,
-    find_adapter,
+    find_adapters,
     Descriptor,
     Agent,
+    NotSupportedException,
+    NotPermittedException,
+    read_slice,
+    to_payload,
 )
-
+import advertising
+import logconfig
+import metrics
+from advertising import AdvertisingManager
+from backend import CommandQueue, VivaldiBackend
+from beacon import StatusBeacon, empty_status
+from laststate import LastStateStore
+from pairing import PairingPolicy, TrustStore
+from recorder import TrafficRecorder
+from schema import load_schema
+from sessions import SessionManager
+from status import MachineStatus, StatusPoller
+from supervisor import BACKOFF, DOWN, REGISTERED, REGISTERING, Backoff, Supervisor
+from telemetry import TelemetryFeed, decimate, pack_frame, samples_per_frame
+
+
+import os
 import struct
-import requests
-import array
-from enum import Enum
-
-import sys
+from concurrent.futures import Future
 
 MainLoop = None
 try:
@@ -30,203 +50,346 @@ try:
 
     MainLoop = GLib.MainLoop
 except ImportError:
-    import gobject as GObject
+    import gobject as GLib
 
-    MainLoop = GObject.MainLoop
+    MainLoop = GLib.MainLoop
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-logHandler = logging.StreamHandler()
-filelogHandler = logging.FileHandler("logs.log")
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-logHandler.setFormatter(formatter)
-filelogHandler.setFormatter(formatter)
-logger.addHandler(filelogHandler)
-logger.addHandler(logHandler)
 
 
 VivaldiBaseUrl = "XXXXXXXXXXXX"
 
+# adapter name (e.g. "hci1") -> backend URL of the machine served on it.
+# Adapters not listed serve VivaldiBaseUrl, map one to None to leave it unused.
+MachineBackends = {}
+
+# port of the local Prometheus metrics endpoint, None to disable it
+MetricsPort = 9108
+
+# every adapter's objects are exported below PATH_BASE/<adapter name>
+PATH_BASE = "/com/punchthrough/vivaldi"
+
+VivaldiSchema = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vivaldi_gatt.json")
+
+# directory the state kept across restarts is written to, set
+# VIVALDI_STATE_DIR to move it
+StateDir = os.environ.get("VIVALDI_STATE_DIR", "/var/lib/vivaldi")
+
+# how long (seconds) a machine status snapshot is served before re-fetching
+StatusMaxAge = 2.0
+# how long (seconds) a read waits on a refresh before it is answered from
+# the previous snapshot
+StatusStaleWait = 0.5
+# last good status snapshot of every machine, served while the backend is
+# down and right after a restart
+LastStatePath = os.path.join(StateDir, "last_state.sqlite")
+# how often (seconds) the backend is polled while a central is subscribed
+StatusPollInterval = 1.0
+# "threads" runs backend calls and characteristic handlers on the handler
+# pool, "asyncio" as coroutines sharing one asyncio thread (needs aiohttp)
+BackendTransport = "threads"
+# how long (seconds) commands are held to merge repeated writes, and whether
+# the backend accepts a list of commands in one POST to /vivaldi/cmds
+CommandWindow = 0.05
+BackendAcceptsBatches = False
+# how often (seconds) shot telemetry is fetched while a central is subscribed
+TelemetryPollInterval = 0.1
+# samples kept for centrals that subscribe mid-shot, and how many seconds of
+# them are sent in the first burst
+TelemetryBufferSize = 1024
+TelemetryBurstSeconds = 5
+# frames worth of samples held back under backpressure before decimating
+TelemetryMaxPendingFrames = 16
+# advertisement instances the advertising data may be spread over when it
+# does not fit one advertisement and its scan response
+AdvertisingInstances = 2
+# broadcast power, boiler and auto-off in the manufacturer data so observers
+# can read them without connecting. Keeps the status poller running.
+BroadcastStatus = False
+
+# pairing policy: addresses and OUIs ("AA:BB:CC") allowed to pair. With both
+# empty, any device may pair while PairingAllowUnknown is set, but such
+# devices are not remembered in the trust store.
+PairingAllowAddresses = []
+PairingAllowOuis = []
+PairingAllowUnknown = False
+# confirm numeric comparison automatically for allowed devices
+PairingAutoConfirm = True
+# centrals served at once per adapter, and per central and characteristic
+# the reads/writes per second allowed (with bursts of up to *Burst). Write
+# commands (without response) are not limited, the command queue
+# coalesces them instead.
+SessionMaxCentrals = 4
+SessionReadRate = 20.0
+SessionReadBurst = 10
+SessionWriteRate = 5.0
+SessionWriteBurst = 5
+# how long (seconds) a central's repeated reads are answered from its cache
+SessionCacheTtl = 0.5
+# devices that paired are remembered here and allowed from then on
+TrustStorePath = os.path.join(StateDir, "trusted_devices.json")
+# file to record every GATT call centrals make to, for
+# benchmarks/replay.py, None to not record. Write payloads are only
+# recorded with TrafficLogPayloads.
+TrafficLogPath = None
+TrafficLogPayloads = False
+
 mainloop = None
 
 BLUEZ_SERVICE_NAME = "org.bluez"
 GATT_MANAGER_IFACE = "org.bluez.GattManager1"
-LE_ADVERTISEMENT_IFACE = "org.bluez.LEAdvertisement1"
 LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
 
 
-class InvalidArgsException(dbus.exceptions.DBusException):
-    _dbus_error_name = "org.freedesktop.DBus.Error.InvalidArgs"
-
-
-class NotSupportedException(dbus.exceptions.DBusException):
-    _dbus_error_name = "org.bluez.Error.NotSupported"
-
-
-class NotPermittedException(dbus.exceptions.DBusException):
-    _dbus_error_name = "org.bluez.Error.NotPermitted"
-
-
-class InvalidValueLengthException(dbus.exceptions.DBusException):
-    _dbus_error_name = "org.bluez.Error.InvalidValueLength"
-
-
-class FailedException(dbus.exceptions.DBusException):
-    _dbus_error_name = "org.bluez.Error.Failed"
-
-
-def register_app_cb():
-    logger.info("GATT application registered")
-
-
-def register_app_error_cb(error):
-    logger.critical("Failed to register application: " + str(error))
-    mainloop.quit()
-
-
 class VivaldiS1Service(Service):
     """
-    Dummy test service that provides characteristics and descriptors that
-    exercise various API functionality.
-
+    Espresso machine service. Its characteristics are built from the GATT
+    schema file, each one backed by a field of the shared status snapshot.
     """
 
     ESPRESSO_SVC_UUID = "12634d89-d598-4874-8e86-7d042ee07ba7"
 
-    def __init__(self, bus, index):
-        Service.__init__(self, bus, index, self.ESPRESSO_SVC_UUID, True)
-        self.add_characteristic(PowerControlCharacteristic(bus, 0, self))
-        self.add_characteristic(BoilerControlCharacteristic(bus, 1, self))
-        self.add_characteristic(AutoOffCharacteristic(bus, 2, self))
-
-
-class PowerControlCharacteristic(Characteristic):
-    uuid = "4116f8d2-9f66-4f58-a53d-fc7440e7c14e"
-    description = b"Get/set machine power state {'ON', 'OFF', 'UNKNOWN'}"
-
-    class State(Enum):
-        on = "ON"
-        off = "OFF"
-        unknown = "UNKNOWN"
-
-        @classmethod
-        def has_value(cls, value):
-            return value in cls._value2member_map_
-
-    power_options = {"ON", "OFF", "UNKNOWN"}
-
-    def __init__(self, bus, index, service):
-        Characteristic.__init__(
-            self, bus, index, self.uuid, ["encrypt-read", "encrypt-write"], service,
+    def __init__(
+        self,
+        bus,
+        index,
+        backend,
+        spec=None,
+        status_max_age=StatusMaxAge,
+        path_base=None,
+        store=None,
+        transport=BackendTransport,
+    ):
+        if spec is None:
+            spec = load_schema(VivaldiSchema)[0]
+        Service.__init__(self, bus, index, spec.uuid, spec.primary, path_base)
+        self.backend = backend
+        if transport == "asyncio":
+            from aiobackend import AsyncCommandQueue, AsyncMachineStatus
+
+            status_class, queue_class = AsyncMachineStatus, AsyncCommandQueue
+            characteristic_class = AsyncVivaldiCharacteristic
+        else:
+            status_class, queue_class = MachineStatus, CommandQueue
+            characteristic_class = VivaldiCharacteristic
+        self.status = status_class(
+            backend.get_status,
+            max_age=status_max_age,
+            store=store,
+            key=backend.base_url,
+            stale_wait=StatusStaleWait,
+        )
+        self.poller = StatusPoller(self.status, interval=StatusPollInterval)
+        self.commands = queue_class(
+            backend,
+            window=CommandWindow,
+            batch=BackendAcceptsBatches,
+            on_sent=self.status.invalidate,
+        )
+        self.telemetry = TelemetryFeed(
+            backend.get_telemetry,
+            capacity=TelemetryBufferSize,
+            interval=TelemetryPollInterval,
+        )
+        for i, chrc_spec in enumerate(spec.characteristics):
+            self.add_characteristic(characteristic_class(bus, i, self, chrc_spec))
+        self.add_characteristic(
+            TelemetryCharacteristic(bus, len(spec.characteristics), self)
         )
 
-        self.value = [0xFF]
-        self.add_descriptor(CharacteristicUserDescriptionDescriptor(bus, 1, self))
 
-    def ReadValue(self, options):
-        logger.debug("power Read: " + repr(self.value))
-        res = None
+class VivaldiCharacteristic(Characteristic):
+    """
+    Characteristic backed by one field of the service's status snapshot, as
+    described by a schema.CharacteristicSpec. Writes post the spec's command.
+    Notifications are driven by the service's shared status poller.
+    """
+
+    def __init__(self, bus, index, service, spec):
+        Characteristic.__init__(self, bus, index, spec.uuid, spec.flags, service)
+        self.spec = spec
+        self.field = spec.field
+        self.encode = spec.encode
+        self.description = spec.description
+
+        # last raw status field and its encoded payload
+        self._raw = None
+        self.value = to_payload(b"")
+        if self.description:
+            self.add_descriptor(CharacteristicUserDescriptionDescriptor(bus, 1, self))
+        if self.field is not None:
+            self.add_descriptor(StatusAgeDescriptor(bus, 2, self))
+
+    def read_value(self, options):
+        logger.debug("%s read: %r", self.field, self.value)
+        if self.field is None:
+            raise NotSupportedException()
         try:
-            res = requests.get(VivaldiBaseUrl + "/vivaldi")
-            self.value = bytearray(res.json()["machine"], encoding="utf8")
+            self.update(self.service.status.field(self.field))
         except Exception as e:
-            logger.error(f"Error getting status {e}")
-            self.value = bytearray(self.State.unknown, encoding="utf8")
+            logger.error("Error getting status %s", e)
+            if self.spec.default is not None:
+                self.update(self.spec.default)
 
         return self.value
 
-    def WriteValue(self, value, options):
-        logger.debug("power Write: " + repr(value))
-        cmd = bytes(value).decode("utf-8")
-        if self.State.has_value(cmd):
-            # write it to machine
-            logger.info("writing {cmd} to machine")
-            data = {"cmd": cmd.lower()}
-            try:
-                res = requests.post(VivaldiBaseUrl + "/vivaldi/cmds", json=data)
-            except Exceptions as e:
-                logger.error(f"Error updating machine state: {e}")
-        else:
-            logger.info(f"invalid state written {cmd}")
-            raise NotPermittedException
-
-        self.value = value
+    def update(self, raw):
+        """
+        Re-encodes the payload only when the status field actually changed
+        """
+        if raw != self._raw or self._raw is None:
+            self.value = to_payload(self.encode(raw))
+            self._raw = raw
+        return self.value
 
+    def write_value(self, value, options):
+        logger.debug("%s write: %r", self.field, value)
+        if self.spec.make_command is None:
+            raise NotSupportedException()
+        data = self.spec.make_command(self.spec.decode(value))
 
-class BoilerControlCharacteristic(Characteristic):
-    uuid = "322e774f-c909-49c4-bd7b-48a4003a967f"
-    description = b"Get/set boiler power state can be `on` or `off`"
+        # write it to machine
+        logger.info("writing %s to machine", data)
+        future = self.service.commands.submit(self.field or self.uuid, data)
+        if options.get("type") == "command":
+            # write without response, the central is not waiting for an outcome
+            future.add_done_callback(self._command_done)
+            self._written(value)
+            return None
+
+        # answered once the backend is, without holding a handler worker
+        applied = Future()
+
+        def sent(future):
+            error = future.exception()
+            if error is not None:
+                logger.error("Error updating machine state: %s", error)
+                applied.set_exception(error)
+                return
+            self._written(value)
+            applied.set_result(None)
+
+        future.add_done_callback(sent)
+        return applied
+
+    def _written(self, value):
+        self.value = to_payload(value)
+        self._raw = None
+
+    def _command_done(self, future):
+        if future.exception() is not None:
+            logger.error("Error updating machine state: %s", future.exception())
+
+    def start_notify(self):
+        self.service.poller.subscribe(self.field, self.field_changed)
+
+    def stop_notify(self):
+        self.service.poller.unsubscribe(self.field, self.field_changed)
+
+    def field_changed(self, value):
+        try:
+            self.update(value)
+        except Exception as e:
+            logger.error("Error encoding %s %r: %s", self.field, value, e)
+            return
+        self.notify_value(self.value)
 
-    def __init__(self, bus, index, service):
-        Characteristic.__init__(
-            self, bus, index, self.uuid, ["encrypt-read", "encrypt-write"], service,
-        )
 
-        self.value = []
-        self.add_descriptor(CharacteristicUserDescriptionDescriptor(bus, 1, self))
+class AsyncVivaldiCharacteristic(VivaldiCharacteristic):
+    """
+    VivaldiCharacteristic for the asyncio transport: reads await the
+    service's AsyncMachineStatus and writes its AsyncCommandQueue on the
+    asyncio loop thread instead of holding a handler pool thread each
+    """
 
-    def ReadValue(self, options):
-        logger.info("boiler read: " + repr(self.value))
-        res = None
+    async def read_value(self, options):
+        if self.field is None:
+            raise NotSupportedException()
         try:
-            res = requests.get(VivaldiBaseUrl + "/vivaldi")
-            self.value = bytearray(res.json()["boiler"], encoding="utf8")
+            self.update(await self.service.status.field(self.field))
         except Exception as e:
-            logger.error(f"Error getting status {e}")
+            logger.error("Error getting status %s", e)
+            if self.spec.default is not None:
+                self.update(self.spec.default)
 
         return self.value
 
-    def WriteValue(self, value, options):
-        logger.info("boiler state Write: " + repr(value))
-        cmd = bytes(value).decode("utf-8")
+    async def write_value(self, value, options):
+        logger.debug("%s write: %r", self.field, value)
+        if self.spec.make_command is None:
+            raise NotSupportedException()
+        data = self.spec.make_command(self.spec.decode(value))
 
-        # write it to machine
-        logger.info("writing {cmd} to machine")
-        data = {"cmd": "setboiler", "state": cmd.lower()}
-        try:
-            res = requests.post(VivaldiBaseUrl + "/vivaldi/cmds", json=data)
-            logger.info(res)
-        except Exceptions as e:
-            logger.error(f"Error updating machine state: {e}")
-            raise
+        logger.info("writing %s to machine", data)
+        future = self.service.commands.submit(self.field or self.uuid, data)
+        if options.get("type") == "command":
+            future.add_done_callback(self._command_done)
+        else:
+            try:
+                await future
+            except Exception as e:
+                logger.error("Error updating machine state: %s", e)
+                raise
 
+        self.value = to_payload(value)
+        self._raw = None
 
-class AutoOffCharacteristic(Characteristic):
-    uuid = "9c7dbce8-de5f-4168-89dd-74f04f4e5842"
-    description = b"Get/set autoff time in minutes"
+
+class TelemetryCharacteristic(Characteristic):
+    """
+    Streams shot telemetry as telemetry.pack_frame frames, as many samples
+    per notification as the MTU allows. When the notify socket is full the
+    waiting samples are decimated rather than queued without bound.
+    """
+
+    uuid = "cadbfc3e-3af6-47fd-896d-49c150c27dd4"
+    description = b"Live shot telemetry: pressure, temperature and flow frames"
+    acquire_notify = True
 
     def __init__(self, bus, index, service):
         Characteristic.__init__(
-            self, bus, index, self.uuid, ["secure-read", "secure-write"], service,
+            self, bus, index, self.uuid, ["encrypt-read", "notify"], service,
         )
-
-        self.value = []
+        self.feed = service.telemetry
+        self._pending = []
+        self._last_t = None
         self.add_descriptor(CharacteristicUserDescriptionDescriptor(bus, 1, self))
 
-    def ReadValue(self, options):
-        logger.info("auto off read: " + repr(self.value))
-        res = None
-        try:
-            res = requests.get(VivaldiBaseUrl + "/vivaldi")
-            self.value = bytearray(struct.pack("i", int(res.json()["autoOffMinutes"])))
-        except Exception as e:
-            logger.error(f"Error getting status {e}")
-
-        return self.value
-
-    def WriteValue(self, value, options):
-        logger.info("auto off write: " + repr(value))
-        cmd = bytes(value)
-
-        # write it to machine
-        logger.info("writing {cmd} to machine")
-        data = {"cmd": "autoOffMinutes", "time": struct.unpack("i", cmd)[0]}
-        try:
-            res = requests.post(VivaldiBaseUrl + "/vivaldi/cmds", json=data)
-            logger.info(res)
-        except Exceptions as e:
-            logger.error(f"Error updating machine state: {e}")
-            raise
+    def read_value(self, options):
+        latest = self.feed.buffer.latest()
+        if latest is None:
+            return to_payload(b"")
+        return to_payload(pack_frame([latest]))
+
+    def start_notify(self):
+        # give the new subscriber the recent part of the shot in one burst.
+        # The buffer is only filled while the feed runs; when it was idle
+        # the burst is the backend's recent samples, from the first poll.
+        self._pending = self.feed.buffer.recent(TelemetryBurstSeconds)
+        self._last_t = None
+        self.feed.subscribe(self.samples_arrived)
+        self.send_pending()
+
+    def stop_notify(self):
+        self.feed.unsubscribe(self.samples_arrived)
+        self._pending = []
+
+    def samples_arrived(self, samples):
+        self._pending.extend(samples)
+        self.send_pending()
+
+    def send_pending(self):
+        per_frame = samples_per_frame(self.notify_mtu())
+        while len(self._pending) > per_frame * TelemetryMaxPendingFrames:
+            self._pending = decimate(self._pending)
+
+        while self._pending:
+            batch = self._pending[:per_frame]
+            if not self.notify_value(pack_frame(batch, self._last_t)):
+                # socket is full, retry when the next samples arrive
+                break
+            self._last_t = batch[-1].t
+            del self._pending[:per_frame]
 
 
 class CharacteristicUserDescriptionDescriptor(Descriptor):
@@ -240,102 +403,367 @@ class CharacteristicUserDescriptionDescriptor(Descriptor):
         self, bus, index, characteristic,
     ):
 
-        self.value = array.array("B", characteristic.description)
-        self.value = self.value.tolist()
+        self.value = to_payload(characteristic.description)
         Descriptor.__init__(self, bus, index, self.CUD_UUID, ["read"], characteristic)
 
     def ReadValue(self, options):
-        return self.value
+        return read_slice(self.value, options)
 
     def WriteValue(self, value, options):
-        if not self.writable:
+        if "write" not in self.flags:
             raise NotPermittedException()
-        self.value = value
+        self.value = to_payload(value)
 
 
-class VivaldiAdvertisement(Advertisement):
-    def __init__(self, bus, index):
-        Advertisement.__init__(self, bus, index, "peripheral")
-        self.add_manufacturer_data(
-            0xFFFF, [0x70, 0x74],
+class StatusAgeDescriptor(Descriptor):
+    """
+    How current the status behind a characteristic is: seconds since it was
+    fetched (uint32, 0xFFFFFFFF if never) and where it came from (uint8,
+    0 live from the backend, 1 last known state from before an outage or
+    restart, 0xFF none).
+    """
+
+    STATUS_AGE_UUID = "a5f1e8b4-3b6c-4f0e-9d2a-6c1e0f7b2d41"
+    VALUE = struct.Struct("<IB")
+    SOURCES = {MachineStatus.LIVE: 0, MachineStatus.STORED: 1}
+
+    def __init__(self, bus, index, characteristic):
+        Descriptor.__init__(
+            self, bus, index, self.STATUS_AGE_UUID, ["encrypt-read"], characteristic
         )
-        self.add_service_uuid(VivaldiS1Service.ESPRESSO_SVC_UUID)
 
-        self.add_local_name("Vivaldi")
-        self.include_tx_power = True
+    def ReadValue(self, options):
+        status = self.chrc.service.status
+        age = status.age()
+        value = self.VALUE.pack(
+            0xFFFFFFFF if age is None else min(int(age), 0xFFFFFFFE),
+            self.SOURCES.get(status.source, 0xFF),
+        )
+        return read_slice(to_payload(value), options)
 
 
-def register_ad_cb():
-    logger.info("Advertisement registered")
+class VivaldiAdvertising(AdvertisingManager):
+    """
+    Advertises the espresso service. The 128-bit service UUID, TX power and
+    manufacturer data take 30 of the 31 bytes, the name goes in the scan
+    response.
 
+    With broadcast_status the manufacturer data carries a status record
+    instead. It no longer fits next to the service UUID and must be seen by
+    passive scanners, so it is broadcast from a second instance.
+    """
 
-def register_ad_error_cb(error):
-    logger.critical("Failed to register advertisement: " + str(error))
-    mainloop.quit()
+    def __init__(
+        self, bus, path_base=None, max_instances=AdvertisingInstances, broadcast_status=False
+    ):
+        AdvertisingManager.__init__(
+            self, bus, path_base, "peripheral", max_instances=max_instances
+        )
+        self.add(advertising.UUID, VivaldiS1Service.ESPRESSO_SVC_UUID)
+        self.add(advertising.TX_POWER)
+        if broadcast_status:
+            self.manufacturer = self.add(
+                advertising.MANUFACTURER, 0xFFFF, empty_status(), scan_response=False
+            )
+        else:
+            self.manufacturer = self.add(advertising.MANUFACTURER, 0xFFFF, bytes([0x70, 0x74]))
+        self.add(advertising.NAME, value="Vivaldi")
+        self.build()
 
 
-AGENT_PATH = "/com/punchthrough/agent"
+class Machine:
+    """
+    One espresso machine served on one adapter: its backend client, GATT
+    application and advertisement, exported under a path namespace of its
+    own so several machines can share the process and its bus connection.
 
+    The objects are exported once; register() can run again whenever BlueZ
+    has forgotten them and only registers what is missing.
+    """
 
-def main():
-    global mainloop
+    def __init__(self, bus, adapter, base_url, backoff=None, store=None, recorder=None):
+        self.bus = bus
+        self.adapter = adapter
+        self.store = store
+        self.recorder = recorder
+        self.name = adapter.rsplit("/", 1)[-1]
+        self.path = PATH_BASE + "/" + self.name
+
+        self.state = DOWN
+        self.attempts = 0
+        self.last_error = None
+        self.changed_at = time.monotonic()
+        self.backoff = backoff or Backoff()
+        self._registered = set()
+        self._pending = set()
+        self._retry = None
+        # bumped whenever BlueZ loses our registrations, so that replies to
+        # calls made before then are ignored
+        self._epoch = 0
+
+        # seconds from startup to the advertisement and the whole
+        # registration first being accepted
+        self.startup = {}
+
+        if BackendTransport == "asyncio":
+            from aiobackend import AsyncVivaldiBackend
+
+            self.backend = AsyncVivaldiBackend(base_url)
+        else:
+            self.backend = VivaldiBackend(base_url)
+        self.sessions = SessionManager(
+            bus,
+            max_sessions=SessionMaxCentrals,
+            read_rate=SessionReadRate,
+            read_burst=SessionReadBurst,
+            write_rate=SessionWriteRate,
+            write_burst=SessionWriteBurst,
+            cache_ttl=SessionCacheTtl,
+            name=self.name,
+        )
+        self.advertising = VivaldiAdvertising(
+            bus, path_base=self.path + "/advertisement", broadcast_status=BroadcastStatus
+        )
+        for ad in self.advertising.instances:
+            ad.on_release = lambda ad=ad: self.ad_released(ad)
+
+        # the GATT tree is built by build_app() once advertising is under way
+        self.app = None
+        self.service = None
+        self.beacon = None
+
+    def build_app(self):
+        if self.app is not None:
+            return
+        self.sessions.start()
+        self.app = Application(
+            self.bus, self.path, sessions=self.sessions, recorder=self.recorder
+        )
+        self.service = VivaldiS1Service(
+            self.bus,
+            0,
+            self.backend,
+            path_base=self.path + "/service",
+            store=self.store if self.store is not None else last_state_store(),
+            transport=BackendTransport,
+        )
+        self.app.add_service(self.service)
+        if BroadcastStatus:
+            self.beacon = StatusBeacon(
+                self.advertising, self.advertising.manufacturer, self.service.poller
+            )
+            self.beacon.start()
+
+    def health(self):
+        return {
+            "state": self.state,
+            "since": time.monotonic() - self.changed_at,
+            "attempts": self.attempts,
+            "error": self.last_error,
+            "sessions": self.sessions.stats(),
+            "startup": self.startup,
+        }
+
+    def set_state(self, state):
+        if state != self.state:
+            logger.info("%s: %s -> %s", self.name, self.state, state)
+            self.state = state
+            self.changed_at = time.monotonic()
+
+    def register(self):
+        self._cancel_retry()
+        self.attempts += 1
+        self.set_state(REGISTERING)
+        epoch = self._epoch
+        adapter_obj = self.bus.get_object(BLUEZ_SERVICE_NAME, self.adapter, introspect=False)
+
+        # power on, advertise, then register the GATT tree without waiting
+        # for BlueZ in between: it handles the calls in the order sent, and
+        # the advertisement goes out while the tree is still being registered
+        adapter_props = dbus.Interface(adapter_obj, "org.freedesktop.DBus.Properties")
+        adapter_props.Set(
+            "org.bluez.Adapter1",
+            "Powered",
+            dbus.Boolean(1),
+            reply_handler=lambda: None,
+            error_handler=lambda error: self.failed(epoch, "power on", error),
+        )
 
-    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        ad_manager = dbus.Interface(adapter_obj, LE_ADVERTISING_MANAGER_IFACE)
+        for ad in self.advertising.instances:
+            if ad.path in self._registered | self._pending:
+                continue
+            self._pending.add(ad.path)
+            ad_manager.RegisterAdvertisement(
+                ad.get_path(),
+                dbus.Dictionary({}, signature="sv"),
+                reply_handler=lambda what=ad.path: self.registered(epoch, what),
+                error_handler=lambda error, what=ad.path: self.failed(epoch, what, error),
+            )
+
+        if "application" not in self._registered | self._pending:
+            self.build_app()
+            self._pending.add("application")
+            logger.info("%s: registering GATT application...", self.name)
+            service_manager = dbus.Interface(adapter_obj, GATT_MANAGER_IFACE)
+            service_manager.RegisterApplication(
+                self.app.get_path(),
+                dbus.Dictionary({}, signature="sv"),
+                reply_handler=lambda: self.registered(epoch, "application"),
+                error_handler=lambda error: self.failed(epoch, "application", error),
+            )
+
+        self._check_registered()
+
+    def registered(self, epoch, what):
+        if epoch != self._epoch:
+            return
+        logger.info("%s: %s registered", self.name, what)
+        self._pending.discard(what)
+        self._registered.add(what)
+        if what != "application":
+            self._milestone("advertise")
+        self._check_registered()
+
+    def failed(self, epoch, what, error):
+        if epoch != self._epoch:
+            return
+        self._pending.discard(what)
+        self.last_error = "%s: %s" % (what, error)
+        metrics.registry.inc("registration_failures_total", (("adapter", self.name),))
+        if self._retry is None:
+            delay = self.backoff.next()
+            logger.error(
+                "%s: failed to register %s: %s, retrying in %.1fs", self.name, what, error, delay
+            )
+            self.set_state(BACKOFF)
+            self._retry = GLib.timeout_add(int(delay * 1000), self._retry_now)
+        else:
+            logger.error("%s: failed to register %s: %s", self.name, what, error)
+
+    def _check_registered(self):
+        wanted = {"application"} | {ad.path for ad in self.advertising.instances}
+        if self._registered >= wanted and self._retry is None:
+            self.backoff.reset()
+            self.last_error = None
+            self.set_state(REGISTERED)
+            self._milestone("registered")
+
+    def _milestone(self, name):
+        if name in self.startup:
+            return
+        elapsed = self.startup[name] = time.monotonic() - STARTED
+        metrics.registry.set(
+            "startup_seconds", elapsed, (("adapter", self.name), ("milestone", name))
+        )
+        logger.info("%s: %s %.3fs after startup", self.name, name, elapsed)
+
+    def ad_released(self, ad):
+        # BlueZ dropped the advertisement while keeping the adapter, e.g.
+        # when it was powered off. Leave time for a NameOwnerChanged or
+        # InterfacesRemoved to arrive before advertising again.
+        self._registered.discard(ad.path)
+        if self.state == REGISTERED:
+            self.failed(self._epoch, ad.path, "released by BlueZ")
+
+    def powered_off(self):
+        if self.state == REGISTERED:
+            self.failed(self._epoch, "power on", "adapter powered off")
+
+    def lost(self):
+        """
+        bluetoothd or the adapter went away, taking our registrations with it
+        """
+        self._epoch += 1
+        self._cancel_retry()
+        self._registered.clear()
+        self._pending.clear()
+        self.sessions.clear()
+        self.set_state(DOWN)
+
+    def _retry_now(self):
+        self._retry = None
+        self.register()
+        return False
+
+    def _cancel_retry(self):
+        if self._retry is not None:
+            GLib.source_remove(self._retry)
+            self._retry = None
 
-    # get the system bus
-    bus = dbus.SystemBus()
-    # get the ble controller
-    adapter = find_adapter(bus)
 
-    if not adapter:
-        logger.critical("GattManager1 interface not found")
-        return
+AGENT_PATH = "/com/punchthrough/agent"
 
-    adapter_obj = bus.get_object(BLUEZ_SERVICE_NAME, adapter)
+machines = []
+last_state = None
 
-    adapter_props = dbus.Interface(adapter_obj, "org.freedesktop.DBus.Properties")
 
-    # powered property on the controller to on
-    adapter_props.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(1))
+def last_state_store():
+    """
+    Returns the LastStateStore all machines share, opening it on first use.
+    Machine.build_app asks for it once the advertisement has been sent.
+    """
+    global last_state
+    if last_state is None:
+        last_state = LastStateStore(LastStatePath)
+    return last_state
 
-    # Get manager objs
-    service_manager = dbus.Interface(adapter_obj, GATT_MANAGER_IFACE)
-    ad_manager = dbus.Interface(adapter_obj, LE_ADVERTISING_MANAGER_IFACE)
 
-    advertisement = VivaldiAdvertisement(bus, 0)
-    obj = bus.get_object(BLUEZ_SERVICE_NAME, "/org/bluez")
+def main():
+    global mainloop
 
-    agent = Agent(bus, AGENT_PATH)
+    logconfig.configure()
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
-    app = Application(bus)
-    app.add_service(VivaldiS1Service(bus, 2))
+    # get the system bus
+    bus = dbus.SystemBus()
+    # get the ble controllers
+    adapters = find_adapters(bus)
 
-    mainloop = MainLoop()
+    if not adapters:
+        logger.critical("GattManager1 interface not found")
+        return
 
-    agent_manager = dbus.Interface(obj, "org.bluez.AgentManager1")
-    agent_manager.RegisterAgent(AGENT_PATH, "NoInputNoOutput")
+    for path in (LastStatePath, TrustStorePath):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        except OSError as e:
+            logger.error("Could not create %s, state is not kept: %s", os.path.dirname(path), e)
+
+    recorder = None
+    if TrafficLogPath is not None:
+        recorder = TrafficRecorder(TrafficLogPath, payloads=TrafficLogPayloads)
+    for adapter in adapters:
+        name = adapter.rsplit("/", 1)[-1]
+        base_url = MachineBackends.get(name, VivaldiBaseUrl)
+        if base_url is None:
+            logger.info("%s: no machine configured, leaving it alone", name)
+            continue
+        machines.append(Machine(bus, adapter, base_url, recorder=recorder))
+
+    if not machines:
+        logger.critical("No adapter has a machine configured")
+        return
 
-    ad_manager.RegisterAdvertisement(
-        advertisement.get_path(),
-        {},
-        reply_handler=register_ad_cb,
-        error_handler=register_ad_error_cb,
+    # BlueZ takes one agent per connection, it is shared by all adapters
+    policy = PairingPolicy(
+        allow_addresses=PairingAllowAddresses,
+        allow_ouis=PairingAllowOuis,
+        allow_unknown=PairingAllowUnknown,
+        auto_confirm=PairingAutoConfirm,
+        store=TrustStore(TrustStorePath),
     )
+    Agent(bus, AGENT_PATH, policy)
 
-    logger.info("Registering GATT application...")
+    mainloop = MainLoop()
 
-    service_manager.RegisterApplication(
-        app.get_path(),
-        {},
-        reply_handler=register_app_cb,
-        error_handler=[register_app_error_cb],
-    )
+    supervisor = Supervisor(bus, machines, AGENT_PATH)
+    supervisor.start(adapters)
 
-    agent_manager.RequestDefaultAgent(AGENT_PATH)
+    if MetricsPort is not None:
+        metrics.serve(MetricsPort, health=supervisor.health)
 
     mainloop.run()
-    # ad_manager.UnregisterAdvertisement(advertisement)
-    # dbus.service.Object.remove_from_connection(advertisement)
 
 
 if __name__ == "__main__":
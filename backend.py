@@ -0,0 +1,286 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import metrics
+from ble import FailedException, GLib, HANDLER_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast after `failure_threshold` consecutive failures, then lets
+    a single trial call through once `reset_timeout` seconds have passed
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=3, reset_timeout=10.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if self._clock() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning("backend circuit opened")
+                self._opened_at = self._clock()
+
+
+def check_status(breaker, method, path, status):
+    """
+    Records the outcome of a response with the breaker and raises
+    FailedException unless the status is 2xx/3xx
+    """
+    # a 4xx means the backend is up and rejected the request
+    if status >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    if status >= 400:
+        labels = (("method", method), ("path", path), ("error", str(status)))
+        metrics.registry.inc("backend_errors_total", labels)
+        logger.error("Backend %s %s returned %s", method, path, status)
+        raise FailedException(f"Backend returned {status}")
+
+
+class VivaldiBackend:
+    """
+    HTTP client for the Vivaldi machine backend.
+
+    Uses one keep-alive `requests.Session` with a connection pool sized for
+    the GATT handler pool. Every call has connect/read timeouts, status GETs
+    are retried with backoff, and all calls go through a circuit breaker so
+    handlers fail fast with `FailedException` while the backend is down.
+    """
+
+    STATUS_PATH = "/vivaldi"
+    COMMANDS_PATH = "/vivaldi/cmds"
+    TELEMETRY_PATH = "/vivaldi/telemetry"
+
+    def __init__(
+        self,
+        base_url,
+        connect_timeout=2.0,
+        read_timeout=5.0,
+        retries=2,
+        backoff_factor=0.2,
+        pool_size=HANDLER_WORKERS,
+        breaker=None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self.breaker = breaker or CircuitBreaker()
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._request_error = None
+
+    @property
+    def session(self):
+        session = self._session
+        if session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._connect()
+                session = self._session
+        return session
+
+    def _connect(self):
+        # requests takes a while to import on small boards, and nothing needs
+        # it before the first backend call, so it is loaded then
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # only idempotent requests are retried, commands are sent once
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=self.retries,
+            status=self.retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET", "HEAD"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        self._request_error = requests.RequestException
+        return session
+
+    def _request(self, method, path, **kwargs):
+        labels = (("method", method), ("path", path))
+        if not self.breaker.allow():
+            metrics.registry.inc("backend_errors_total", labels + (("error", "circuit-open"),))
+            raise FailedException("Backend unavailable")
+
+        session = self.session
+        start = time.perf_counter()
+        try:
+            res = session.request(
+                method, self.base_url + path, timeout=self.timeout, **kwargs
+            )
+        except self._request_error as e:
+            self.breaker.record_failure()
+            metrics.registry.inc("backend_errors_total", labels + (("error", type(e).__name__),))
+            logger.error("Backend %s %s failed: %s", method, path, e)
+            raise FailedException(str(e))
+        finally:
+            metrics.registry.observe(
+                "backend_request_seconds", time.perf_counter() - start, labels
+            )
+
+        check_status(self.breaker, method, path, res.status_code)
+        return res
+
+    def get_status(self):
+        return self._request("GET", self.STATUS_PATH).json()
+
+    def get_telemetry(self, since=None):
+        """
+        Returns the shot samples recorded after `since` (backend milliseconds),
+        or the backend's recent samples when since is None
+        """
+        params = {} if since is None else {"since": since}
+        return self._request("GET", self.TELEMETRY_PATH, params=params).json()["samples"]
+
+    def send_command(self, data):
+        return self._request("POST", self.COMMANDS_PATH, json=data)
+
+    def send_commands(self, commands):
+        """
+        Posts several commands in one request, for backends that accept a
+        JSON list on the commands endpoint
+        """
+        return self._request("POST", self.COMMANDS_PATH, json=list(commands))
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+
+class CommandQueue:
+    """
+    Coalesces commands on their way to the backend.
+
+    Commands are held for `window` seconds. A command submitted under a key
+    that is already waiting replaces it (last write wins) and both callers
+    get the outcome of the one request sent. With `batch`, everything waiting
+    goes out as one request through `VivaldiBackend.send_commands`.
+    `on_sent` is called after each flush, e.g. to invalidate cached status.
+
+    The window is a main loop timeout. The requests go out from one sender
+    thread of the queue's own, not the handler pool: the writers waiting for
+    them may be holding every handler pool worker.
+    """
+
+    def __init__(self, backend, window=0.05, batch=False, on_sent=None):
+        self.backend = backend
+        self.window = window
+        self.batch = batch
+        self._on_sent = on_sent
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._timer = None
+        self._sender = ThreadPoolExecutor(max_workers=1, thread_name_prefix="command-queue")
+
+    def submit(self, key, data):
+        """
+        Queues data under key and returns a Future for the backend response
+        """
+        future = Future()
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is None:
+                self._pending[key] = [data, [future]]
+            else:
+                logger.debug("coalescing command %s", key)
+                entry[0] = data
+                entry[1].append(future)
+            if self._timer is None:
+                self._timer = GLib.timeout_add(int(self.window * 1000), self._window_closed)
+        return future
+
+    def _window_closed(self):
+        with self._lock:
+            self._timer = None
+        self._sender.submit(self.flush)
+        return False
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            if self._timer is not None:
+                GLib.source_remove(self._timer)
+                self._timer = None
+        if not pending:
+            return
+
+        try:
+            if self.batch and len(pending) > 1:
+                commands = [data for data, futures in pending.values()]
+                futures = [f for data, fs in pending.values() for f in fs]
+                self._send(self.backend.send_commands, commands, futures)
+            else:
+                for data, futures in pending.values():
+                    self._send(self.backend.send_command, data, futures)
+        finally:
+            if self._on_sent is not None:
+                self._on_sent()
+
+    def _send(self, send, data, futures):
+        try:
+            res = send(data)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future in futures:
+            future.set_result(res)
@@ -0,0 +1,94 @@
+import logging
+import struct
+
+from ble import GLib
+
+logger = logging.getLogger(__name__)
+
+# record: magic "pt", version, sequence number, power, boiler,
+# auto-off minutes. States are 0 off, 1 on, 0xFF unknown, auto-off -1 unknown.
+STATUS_RECORD = struct.Struct("<2sBBBBh")
+STATUS_MAGIC = b"pt"
+STATUS_VERSION = 1
+UNKNOWN = 0xFF
+
+STATUS_FIELDS = ("machine", "boiler", "autoOffMinutes")
+
+
+def _state(value):
+    value = str(value).upper()
+    if value == "ON":
+        return 1
+    if value == "OFF":
+        return 0
+    return UNKNOWN
+
+
+def pack_status(snapshot, sequence):
+    """
+    Packs the status fields of a snapshot into a broadcast record
+    """
+    try:
+        auto_off = max(-1, min(0x7FFF, int(snapshot.get("autoOffMinutes"))))
+    except (TypeError, ValueError):
+        auto_off = -1
+    return STATUS_RECORD.pack(
+        STATUS_MAGIC,
+        STATUS_VERSION,
+        sequence & 0xFF,
+        _state(snapshot.get("machine")),
+        _state(snapshot.get("boiler")),
+        auto_off,
+    )
+
+
+def empty_status():
+    return pack_status({}, 0)
+
+
+class StatusBeacon:
+    """
+    Broadcasts the machine status in an advertising field, so observers can
+    read it from advertisements without connecting.
+
+    Follows the status fields through a StatusPoller and sets the field in
+    place only when the record changed, bumping its sequence number so
+    observers can tell a new record from a repeated one.
+    """
+
+    def __init__(self, advertising, field, poller, fields=STATUS_FIELDS):
+        self.advertising = advertising
+        self.field = field
+        self.poller = poller
+        self.fields = fields
+        self.snapshot = {}
+        self.sequence = 0
+        self._callbacks = {}
+        self._publish_source = None
+
+    def start(self):
+        for name in self.fields:
+            callback = self._callbacks[name] = lambda value, name=name: self._changed(name, value)
+            self.poller.subscribe(name, callback)
+
+    def stop(self):
+        for name, callback in self._callbacks.items():
+            self.poller.unsubscribe(name, callback)
+        self._callbacks.clear()
+        if self._publish_source is not None:
+            GLib.source_remove(self._publish_source)
+            self._publish_source = None
+
+    def _changed(self, name, value):
+        self.snapshot[name] = value
+        # every field of one snapshot is reported back to back, publish once
+        if self._publish_source is None:
+            self._publish_source = GLib.idle_add(self._publish)
+
+    def _publish(self):
+        self._publish_source = None
+        self.sequence = (self.sequence + 1) & 0xFF
+        record = pack_status(self.snapshot, self.sequence)
+        logger.debug("broadcasting status %r", self.snapshot)
+        self.advertising.set(self.field, record)
+        return False
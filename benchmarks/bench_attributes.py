@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Measures tree build time and memory per attribute of a large GATT table.
+
+Builds the same table twice, once exported lazily (the default, attributes
+are exported when first called) and once with every attribute exported up
+front, and reports the build time, Python heap and resident memory each
+one added. --baseline builds it once more with ble.py as of a git revision
+(any name git accepts, e.g. the commit before the attribute index was
+added), for numbers to compare against. Needs a session bus to export the
+objects on, e.g.
+
+    dbus-run-session -- python3 benchmarks/bench_attributes.py --baseline REV
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import dbus
+import dbus.mainloop.glib
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+
+def build_tree(ble, bus, args, path):
+    # bench_managed_objects.build_tree, for whichever ble was imported
+    app = ble.Application(bus, path)
+    for s in range(args.services):
+        service = ble.Service(
+            bus, s, "0000%04x-0000-1000-8000-00805f9b34fb" % s, True, path + "/service"
+        )
+        for c in range(args.characteristics):
+            chrc = ble.Characteristic(bus, c, "2a%02x" % (c % 256), ["read"], service)
+            for d in range(args.descriptors):
+                chrc.add_descriptor(ble.Descriptor(bus, d, "2901", ["read"], chrc))
+            service.add_characteristic(chrc)
+        app.add_service(service)
+    return app
+
+
+def measure(ble, bus, args, index, eager):
+    tracemalloc.start()
+    rss_before = rss()
+    start = time.perf_counter()
+
+    app = build_tree(ble, bus, args, "/bench/tree%d" % index)
+    if eager and hasattr(app, "export_all"):
+        app.export_all()
+    objects = app.GetManagedObjects()
+    if hasattr(app, "index"):
+        app.index()
+
+    elapsed = time.perf_counter() - start
+    heap, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return app, len(objects), elapsed, heap, rss() - rss_before
+
+
+def baseline(args):
+    """
+    Returns the measurement with ble.py as of args.baseline, run in a child
+    process on a copy of that revision
+    """
+    with tempfile.TemporaryDirectory(prefix="bench-attributes-") as tree:
+        archive = subprocess.run(
+            ["git", "-C", ROOT, "archive", args.baseline], check=True, capture_output=True
+        )
+        subprocess.run(["tar", "-x", "-C", tree], input=archive.stdout, check=True)
+        out = subprocess.run(
+            [
+                sys.executable, os.path.abspath(__file__), "--tree", tree,
+                "--services", str(args.services),
+                "--characteristics", str(args.characteristics),
+                "--descriptors", str(args.descriptors),
+            ],
+            check=True, capture_output=True, text=True,
+        )
+    return json.loads(out.stdout)
+
+
+def row(name, attributes, elapsed, heap, grown):
+    print(
+        f"{name:8} {attributes:10d} {elapsed * 1000:9.1f} "
+        f"{heap / attributes:12.0f} {grown / attributes:11.0f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--services", type=int, default=10)
+    parser.add_argument("--characteristics", type=int, default=50)
+    parser.add_argument("--descriptors", type=int, default=1)
+    parser.add_argument("--baseline", metavar="REV",
+                        help="also measure ble.py as of this git revision")
+    parser.add_argument("--tree", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    sys.path.insert(0, args.tree or ROOT)
+    import ble
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.SessionBus()
+
+    if args.tree:
+        # child run for --baseline: one eager table, as JSON
+        _, attributes, elapsed, heap, grown = measure(ble, bus, args, 0, True)
+        print(json.dumps([attributes, elapsed, heap, grown]))
+        return
+
+    keep = []
+    print(f"{'':8} {'attributes':>10} {'build ms':>9} {'heap B/attr':>12} {'rss B/attr':>11}")
+    if args.baseline:
+        row("baseline", *baseline(args))
+    for index, (name, eager) in enumerate((("lazy", False), ("eager", True))):
+        app, attributes, elapsed, heap, grown = measure(ble, bus, args, index, eager)
+        keep.append(app)
+        row(name, attributes, elapsed, heap, grown)
+
+
+if __name__ == "__main__":
+    main()
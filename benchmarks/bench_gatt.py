@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Load test for the GATT server without a radio or an espresso machine.
+
+Starts a private dbus-daemon, a stub bluetoothd (stub_bluez.py) and a fake
+machine backend (fake_backend.py), runs app.py against them, then has
+simulated centrals hammer the registered characteristics with ReadValue and
+WriteValue calls, the way bluetoothd forwards them, while one subscriber
+counts notifications. Reports p50/p99 latency and throughput per operation.
+
+    python3 benchmarks/bench_gatt.py --centrals 8 --duration 10 --max-p99 50
+
+Pass --transport asyncio to compare the asyncio transport with the default
+handler pool.
+"""
+
+import argparse
+import json
+import os
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import dbus
+import dbus.bus
+import dbus.mainloop.glib
+from gi.repository import GLib
+
+from fake_backend import FakeBackend
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCHEMA = os.path.join(HERE, "..", "vivaldi_gatt.json")
+
+DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
+STUB_IFACE = "com.punchthrough.StubBluez"
+
+READ_FLAGS = {"read", "encrypt-read", "encrypt-authenticated-read", "secure-read"}
+
+
+def start_bus(workdir):
+    """
+    Starts a private dbus-daemon and returns (process, address)
+    """
+    proc = subprocess.Popen(
+        ["dbus-daemon", "--session", "--nofork", "--print-address=1",
+         "--address=unix:tmpdir=" + workdir],
+        stdout=subprocess.PIPE,
+    )
+    address = proc.stdout.readline().decode().strip()
+    return proc, address
+
+
+def wait_for(predicate, timeout=10.0, what="condition"):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            result = predicate()
+            if result:
+                return result
+        except dbus.exceptions.DBusException:
+            pass
+        time.sleep(0.05)
+    raise RuntimeError("timed out waiting for " + what)
+
+
+def write_values():
+    """
+    Returns {uuid: [payloads]} of valid writes, from the GATT schema
+    """
+    with open(SCHEMA) as f:
+        spec = json.load(f)
+
+    values = {}
+    for service in spec["services"]:
+        for chrc in service["characteristics"]:
+            if "command" not in chrc:
+                continue
+            codec = chrc.get("codec", "utf8")
+            if codec == "utf8-enum":
+                values[chrc["uuid"]] = [v.encode() for v in chrc["values"] if v != "UNKNOWN"]
+            elif codec == "utf8":
+                values[chrc["uuid"]] = [b"on", b"off"]
+            elif codec == "int32":
+                values[chrc["uuid"]] = [struct.pack("<i", m) for m in (15, 30, 60)]
+    return values
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class Central(threading.Thread):
+    """
+    One simulated central: a connection of its own issuing back-to-back
+    reads and writes until stopped
+    """
+
+    def __init__(self, index, address, sender, readable, writable, write_ratio, stop):
+        threading.Thread.__init__(self, name=f"central-{index}", daemon=True)
+        self.address = address
+        self.sender = sender
+        self.readable = readable
+        self.writable = writable
+        self.write_ratio = write_ratio
+        self.stop = stop
+        self.device = dbus.ObjectPath("/org/bluez/hci0/dev_00_00_00_00_00_%02X" % index)
+        self.latencies = {"read": [], "write": []}
+        self.errors = 0
+
+    def run(self):
+        bus = dbus.bus.BusConnection(self.address)
+        chrcs = {
+            path: dbus.Interface(bus.get_object(self.sender, path), GATT_CHRC_IFACE)
+            for path in list(self.readable) + list(self.writable)
+        }
+        options = dbus.Dictionary({"device": self.device}, signature="sv")
+        rng = random.Random(self.name)
+
+        while not self.stop.is_set():
+            write = self.writable and rng.random() < self.write_ratio
+            start = time.perf_counter()
+            try:
+                if write:
+                    path = rng.choice(list(self.writable))
+                    value = rng.choice(self.writable[path])
+                    chrcs[path].WriteValue(dbus.ByteArray(value), options)
+                else:
+                    chrcs[rng.choice(self.readable)].ReadValue(options, byte_arrays=True)
+            except dbus.exceptions.DBusException:
+                self.errors += 1
+                continue
+            self.latencies["write" if write else "read"].append(time.perf_counter() - start)
+        bus.close()
+
+
+class Subscriber(threading.Thread):
+    """
+    Subscribes to every notifying characteristic and counts PropertiesChanged
+    """
+
+    def __init__(self, address, sender, paths):
+        threading.Thread.__init__(self, name="subscriber", daemon=True)
+        self.address = address
+        self.sender = sender
+        self.paths = paths
+        self.count = 0
+        # the only GLib loop in this process, so it may own the default context
+        self.loop = GLib.MainLoop()
+
+    def run(self):
+        bus = dbus.bus.BusConnection(
+            self.address, mainloop=dbus.mainloop.glib.DBusGMainLoop()
+        )
+        bus.add_signal_receiver(
+            self.changed,
+            signal_name="PropertiesChanged",
+            dbus_interface=DBUS_PROP_IFACE,
+            bus_name=self.sender,
+        )
+        for path in self.paths:
+            dbus.Interface(bus.get_object(self.sender, path), GATT_CHRC_IFACE).StartNotify()
+        self.loop.run()
+
+    def changed(self, interface, changed, invalidated):
+        if "Value" in changed:
+            self.count += 1
+
+
+def run(args):
+    dbus.mainloop.glib.threads_init()
+    workdir = tempfile.mkdtemp(prefix="bench-gatt-")
+    procs = []
+    backend = FakeBackend(latency=args.backend_latency).start()
+    try:
+        bus_proc, address = start_bus(workdir)
+        procs.append(bus_proc)
+        env = dict(os.environ, DBUS_SYSTEM_BUS_ADDRESS=address)
+        output = open(os.path.join(workdir, "app.log"), "w")
+
+        procs.append(subprocess.Popen(
+            [sys.executable, os.path.join(HERE, "stub_bluez.py"), "--address", address],
+            env=env,
+        ))
+        bus = dbus.bus.BusConnection(address)
+        wait_for(lambda: bus.name_has_owner("org.bluez"), what="stub bluetoothd")
+
+        started = time.perf_counter()
+        procs.append(subprocess.Popen(
+            [sys.executable, os.path.join(HERE, "run_app.py"), backend.url,
+             args.transport],
+            env=env, cwd=workdir, stdout=output, stderr=output,
+        ))
+        stub = dbus.Interface(bus.get_object("org.bluez", "/org/bluez/hci0"), STUB_IFACE)
+        wait_for(lambda: list(stub.Advertisements()), timeout=10.0, what="advertisement")
+        advertised = time.perf_counter() - started
+        sender, app_path = wait_for(lambda: list(stub.Applications()), what="registration")[0]
+        registered = time.perf_counter() - started
+
+        objects = dbus.Interface(bus.get_object(sender, app_path), DBUS_OM_IFACE).GetManagedObjects()
+        values = write_values()
+        readable, writable, notifying = [], {}, []
+        for path, interfaces in objects.items():
+            chrc = interfaces.get(GATT_CHRC_IFACE)
+            if chrc is None:
+                continue
+            flags = set(chrc["Flags"])
+            if flags & READ_FLAGS:
+                readable.append(path)
+            if str(chrc["UUID"]) in values:
+                writable[path] = values[str(chrc["UUID"])]
+            if "notify" in flags:
+                notifying.append(path)
+
+        stop = threading.Event()
+        subscriber = Subscriber(address, sender, notifying) if args.notify else None
+        centrals = [
+            Central(i, address, sender, readable, writable, args.write_ratio, stop)
+            for i in range(args.centrals)
+        ]
+        if subscriber:
+            subscriber.start()
+        for central in centrals:
+            central.start()
+        time.sleep(args.duration)
+        stop.set()
+        for central in centrals:
+            central.join()
+        if subscriber:
+            subscriber.loop.quit()
+
+        report = {
+            "advertise_s": advertised,
+            "registration_s": registered,
+            "backend_requests": {" ".join(k): v for k, v in backend.requests.items()},
+            "errors": sum(c.errors for c in centrals),
+            "notifications": subscriber.count if subscriber else 0,
+            "ops": {},
+        }
+        for op in ("read", "write"):
+            samples = [l for c in centrals for l in c.latencies[op]]
+            if samples:
+                report["ops"][op] = {
+                    "count": len(samples),
+                    "per_s": len(samples) / args.duration,
+                    "p50_ms": percentile(samples, 0.50) * 1000,
+                    "p99_ms": percentile(samples, 0.99) * 1000,
+                }
+        return report
+    finally:
+        for proc in reversed(procs):
+            proc.terminate()
+            proc.wait()
+        backend.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--centrals", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--write-ratio", type=float, default=0.1)
+    parser.add_argument("--backend-latency", type=float, default=0.005,
+                        help="seconds the fake backend takes per request")
+    parser.add_argument("--transport", choices=("threads", "asyncio"), default="threads",
+                        help="how the app calls the backend (asyncio needs aiohttp)")
+    parser.add_argument("--no-notify", dest="notify", action="store_false")
+    parser.add_argument("--max-p99", type=float,
+                        help="fail if any operation's p99 exceeds this many ms")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    report = run(args)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(
+            f"advertising after {report['advertise_s'] * 1000:.1f} ms, "
+            f"registered after {report['registration_s'] * 1000:.1f} ms"
+        )
+        for op, stats in report["ops"].items():
+            print(
+                f"{op:6} {stats['count']:8d} ops {stats['per_s']:9.1f}/s "
+                f"p50 {stats['p50_ms']:7.2f} ms  p99 {stats['p99_ms']:7.2f} ms"
+            )
+        print(f"errors {report['errors']}, notifications {report['notifications']}")
+        for request, count in sorted(report["backend_requests"].items()):
+            print(f"backend {request}: {count}")
+
+    if args.max_p99 is not None:
+        slow = [op for op, s in report["ops"].items() if s["p99_ms"] > args.max_p99]
+        if slow:
+            print("p99 over budget: " + ", ".join(slow), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
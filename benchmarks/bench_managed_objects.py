@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Measures GetManagedObjects with and without the cached object tree.
+
+Needs a session bus to export the objects on, e.g.
+
+    dbus-run-session -- python3 benchmarks/bench_managed_objects.py --services 10
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import dbus
+import dbus.mainloop.glib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ble import Application, Characteristic, Descriptor, Service  # noqa: E402
+
+
+def build_tree(bus, services, characteristics, descriptors, path="/"):
+    base = "" if path == "/" else path
+    app = Application(bus, path)
+    for s in range(services):
+        service = Service(
+            bus, s, "0000%04x-0000-1000-8000-00805f9b34fb" % s, True, base + "/service"
+        )
+        for c in range(characteristics):
+            chrc = Characteristic(bus, c, "2a%02x" % (c % 256), ["read"], service)
+            for d in range(descriptors):
+                chrc.add_descriptor(Descriptor(bus, d, "2901", ["read"], chrc))
+            service.add_characteristic(chrc)
+        app.add_service(service)
+    return app
+
+
+def cold(app):
+    # rebuild everything, as GetManagedObjects did before caching
+    app.invalidate()
+    for service in app.services:
+        service._properties = None
+        for chrc in service.characteristics:
+            chrc._properties = None
+            for desc in chrc.descriptors:
+                desc._properties = None
+    return app.GetManagedObjects()
+
+
+def warm(app):
+    return app.GetManagedObjects()
+
+
+def measure(func, app, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(app)
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--services", type=int, default=10)
+    parser.add_argument("--characteristics", type=int, default=20)
+    parser.add_argument("--descriptors", type=int, default=1)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.SessionBus()
+    app = build_tree(bus, args.services, args.characteristics, args.descriptors)
+
+    attributes = len(cold(app))
+    cold_s = measure(cold, app, args.iterations)
+    warm_s = measure(warm, app, args.iterations)
+
+    print(f"attributes: {attributes}")
+    print(f"rebuild:    {cold_s * 1e6:10.1f} us/call")
+    print(f"cached:     {warm_s * 1e6:10.1f} us/call")
+    print(f"speedup:    {cold_s / warm_s:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
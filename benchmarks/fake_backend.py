@@ -0,0 +1,105 @@
+"""
+Local HTTP server standing in for the Vivaldi machine backend.
+"""
+
+import collections
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeBackend:
+    """
+    Serves /vivaldi, /vivaldi/cmds and /vivaldi/telemetry from memory, with
+    an optional artificial latency per request. `requests` counts the
+    requests served per (method, path).
+    """
+
+    def __init__(self, latency=0.0, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.state = {"machine": "ON", "boiler": "on", "autoOffMinutes": 30}
+        self.requests = collections.Counter()
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="fake-backend", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def apply(self, command):
+        cmd = command.get("cmd")
+        with self._lock:
+            if cmd in ("on", "off"):
+                self.state["machine"] = cmd.upper()
+            elif cmd == "setboiler":
+                self.state["boiler"] = command["state"]
+            elif cmd == "autoOffMinutes":
+                self.state["autoOffMinutes"] = int(command["time"])
+
+    def telemetry(self, since):
+        now = int((time.monotonic() - self._started) * 1000)
+        start = now - 1000 if since is None else int(since)
+        return [
+            {"t": t, "pressure": 9.0, "temperature": 93.0, "flow": 2.0}
+            for t in range(start - start % 20 + 20, now + 1, 20)
+        ]
+
+    def _handler(self):
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                path, _, query = self.path.partition("?")
+                backend.requests[("GET", path)] += 1
+                if path == "/vivaldi":
+                    with backend._lock:
+                        self.reply(dict(backend.state))
+                elif path == "/vivaldi/telemetry":
+                    params = dict(p.split("=", 1) for p in query.split("&") if "=" in p)
+                    self.reply({"samples": backend.telemetry(params.get("since"))})
+                else:
+                    self.reply({"error": "not found"}, 404)
+
+            def do_POST(self):
+                backend.requests[("POST", self.path)] += 1
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if self.path != "/vivaldi/cmds":
+                    self.reply({"error": "not found"}, 404)
+                    return
+                for command in body if isinstance(body, list) else [body]:
+                    backend.apply(command)
+                self.reply({"ok": True})
+
+            def reply(self, body, status=200):
+                if backend.latency:
+                    time.sleep(backend.latency)
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Replays a GATT traffic log (recorder.TrafficRecorder) against the GATT tree.
+
+Builds the espresso service the way app.py does, backed by a fake machine
+backend (fake_backend.py), and makes the recorded ReadValue, WriteValue,
+StartNotify, StopNotify and GetManagedObjects calls on it in the recorded
+order and at the recorded pace, or faster with --speed (0 for as fast as
+possible). Reports the handler latency per operation as recorded and as
+replayed, so recordings from production can be profiled offline and
+replayed against each version.
+
+    python3 benchmarks/replay.py traffic.log --speed 10
+
+Writes whose payload was not recorded send a valid value from the GATT
+schema instead. Calls on attributes the tree no longer has are counted as
+missing. --record writes the replayed calls to a new log.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+
+import dbus
+import dbus.bus
+import dbus.exceptions
+import dbus.mainloop.glib
+from gi.repository import GLib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+import recorder  # noqa: E402
+from ble import Application  # noqa: E402
+from backend import VivaldiBackend  # noqa: E402
+from bench_gatt import percentile, start_bus, write_values  # noqa: E402
+from fake_backend import FakeBackend  # noqa: E402
+from sessions import SessionManager  # noqa: E402
+
+ROOT = "/replay"
+# calls made per main loop iteration when replaying as fast as possible
+BATCH = 64
+
+
+def build_tree(bus, backend, transport, traffic=None):
+    sessions = SessionManager(
+        max_sessions=1024,
+        read_rate=app.SessionReadRate,
+        read_burst=app.SessionReadBurst,
+        write_rate=app.SessionWriteRate,
+        write_burst=app.SessionWriteBurst,
+        cache_ttl=app.SessionCacheTtl,
+        name="replay",
+    )
+    sessions.start()
+    application = Application(bus, ROOT, sessions=sessions, recorder=traffic)
+    application.add_service(
+        app.VivaldiS1Service(bus, 0, backend, path_base=ROOT + "/service", transport=transport)
+    )
+    return application
+
+
+def target_path(path):
+    """
+    Returns where a recorded attribute path lives in the replay tree
+    """
+    index = path.find("/service")
+    return ROOT + path[index:] if index >= 0 else ROOT
+
+
+class Replay:
+    def __init__(self, application, calls, speed):
+        self.application = application
+        self.calls = calls
+        self.speed = speed
+        self.loop = GLib.MainLoop()
+        self.latencies = {}
+        self.errors = {}
+        self.missing = 0
+        self.outstanding = 0
+        self.values = {
+            uuid: itertools.cycle(payloads) for uuid, payloads in write_values().items()
+        }
+        self._next = 0
+        self._started = None
+
+    def run(self):
+        self._started = time.perf_counter()
+        GLib.idle_add(self._issue_due)
+        self.loop.run()
+        return time.perf_counter() - self._started
+
+    def _issue_due(self):
+        now = time.perf_counter() - self._started
+        issued = 0
+        while self._next < len(self.calls):
+            call = self.calls[self._next]
+            if self.speed:
+                due = call.t / self.speed
+                if due > now:
+                    GLib.timeout_add(max(int((due - now) * 1000), 1), self._issue_due)
+                    return False
+            elif issued >= BATCH:
+                GLib.idle_add(self._issue_due)
+                return False
+            self._next += 1
+            issued += 1
+            self.issue(call)
+        self._check_done()
+        return False
+
+    def _check_done(self):
+        if self._next >= len(self.calls) and self.outstanding == 0:
+            self.loop.quit()
+
+    def _finish(self, op, start, error=None):
+        name = recorder.OPS[op]
+        self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+        if error is not None:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def issue(self, call):
+        if call.op == recorder.GET_MANAGED_OBJECTS:
+            start = time.perf_counter()
+            self.application.GetManagedObjects()
+            self._finish(call.op, start)
+            return
+
+        attribute = self.application.find(target_path(call.path))
+        if attribute is None:
+            self.missing += 1
+            return
+
+        options = {}
+        for name, value in call.options().items():
+            if name == "device":
+                value = dbus.ObjectPath(value)
+            elif name in ("offset", "mtu"):
+                value = dbus.UInt16(value)
+            options[name] = value
+
+        start = time.perf_counter()
+        if call.op in (recorder.START_NOTIFY, recorder.STOP_NOTIFY):
+            method = (
+                attribute.StartNotify if call.op == recorder.START_NOTIFY else attribute.StopNotify
+            )
+            self._call(call.op, start, method)
+            return
+
+        if call.op == recorder.READ_VALUE:
+            method, args = attribute.ReadValue, (options,)
+        else:
+            method, args = attribute.WriteValue, (self.payload(call, attribute), options)
+        if getattr(method, "_dbus_async_callbacks", None) is None:
+            # descriptors answer synchronously
+            self._call(call.op, start, method, *args)
+            return
+
+        def replied(*result):
+            self.outstanding -= 1
+            self._finish(call.op, start)
+            self._check_done()
+
+        def failed(error):
+            self.outstanding -= 1
+            self._finish(call.op, start, error)
+            self._check_done()
+
+        self.outstanding += 1
+        method(*args, reply_handler=replied, error_handler=failed)
+
+    def _call(self, op, start, method, *args):
+        try:
+            method(*args)
+        except dbus.exceptions.DBusException as e:
+            self._finish(op, start, e)
+        else:
+            self._finish(op, start)
+
+    def payload(self, call, attribute):
+        if call.payload is not None:
+            return dbus.ByteArray(call.payload)
+        values = self.values.get(attribute.uuid)
+        if values is not None:
+            return dbus.ByteArray(next(values))
+        return dbus.ByteArray(bytes(call.size))
+
+
+def report(calls, replay, elapsed):
+    recorded = {}
+    recorded_errors = {}
+    for call in calls:
+        name = recorder.OPS[call.op]
+        recorded.setdefault(name, []).append(call.latency)
+        if call.result != recorder.OK:
+            recorded_errors[name] = recorded_errors.get(name, 0) + 1
+
+    ops = {}
+    for name, samples in replay.latencies.items():
+        ops[name] = {
+            "count": len(samples),
+            "errors": replay.errors.get(name, 0),
+            "recorded_errors": recorded_errors.get(name, 0),
+            "recorded_p50_ms": percentile(recorded[name], 0.50) * 1000,
+            "recorded_p99_ms": percentile(recorded[name], 0.99) * 1000,
+            "p50_ms": percentile(samples, 0.50) * 1000,
+            "p99_ms": percentile(samples, 0.99) * 1000,
+        }
+    return {
+        "calls": len(calls),
+        "recorded_s": calls[-1].t if calls else 0.0,
+        "replayed_s": elapsed,
+        "missing": replay.missing,
+        "ops": ops,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("log", help="traffic log written by recorder.TrafficRecorder")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed, 1 for real time, 0 for as fast as possible")
+    parser.add_argument("--adapter", help="only replay the calls made on this adapter")
+    parser.add_argument("--transport", choices=("threads", "asyncio"), default="threads")
+    parser.add_argument("--backend-latency", type=float, default=0.005,
+                        help="seconds the fake backend takes per request")
+    parser.add_argument("--record", help="record the replayed calls to this log")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    started, calls = recorder.read_log(args.log)
+    if args.adapter:
+        calls = [c for c in calls if "/%s/" % args.adapter in c.path + "/"]
+    if calls:
+        # replay from the first call on, not from when recording started
+        first = calls[0].t
+        for call in calls:
+            call.t -= first
+
+    dbus.mainloop.glib.threads_init()
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus_proc, address = start_bus(tempfile.mkdtemp(prefix="replay-"))
+    backend = FakeBackend(latency=args.backend_latency).start()
+    traffic = recorder.TrafficRecorder(args.record) if args.record else None
+    try:
+        bus = dbus.bus.BusConnection(address)
+        if args.transport == "asyncio":
+            from aiobackend import AsyncVivaldiBackend
+
+            client = AsyncVivaldiBackend(backend.url)
+        else:
+            client = VivaldiBackend(backend.url)
+        replay = Replay(build_tree(bus, client, args.transport, traffic), calls, args.speed)
+        elapsed = replay.run()
+    finally:
+        if traffic is not None:
+            traffic.close()
+        backend.stop()
+        bus_proc.terminate()
+        bus_proc.wait()
+
+    result = report(calls, replay, elapsed)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    print(
+        f"{result['calls']} calls recorded over {result['recorded_s']:.1f} s "
+        f"({time.strftime('%Y-%m-%d %H:%M', time.localtime(started))}), "
+        f"replayed in {result['replayed_s']:.1f} s, {result['missing']} missing"
+    )
+    print(
+        f"{'':18} {'count':>7} {'errors':>7} {'rec p50':>8} {'rec p99':>8} "
+        f"{'p50 ms':>8} {'p99 ms':>8}"
+    )
+    for name, stats in sorted(result["ops"].items()):
+        print(
+            f"{name:18} {stats['count']:7d} {stats['errors']:7d} "
+            f"{stats['recorded_p50_ms']:8.2f} {stats['recorded_p99_ms']:8.2f} "
+            f"{stats['p50_ms']:8.2f} {stats['p99_ms']:8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
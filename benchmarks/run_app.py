@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Runs app.main() against whatever bus DBUS_SYSTEM_BUS_ADDRESS points at,
+with the machine backend at the URL given on the command line and,
+optionally, the backend transport ("threads" or "asyncio") after it.
+State files are written to the current directory.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+
+def main():
+    app.VivaldiBaseUrl = sys.argv[1]
+    if len(sys.argv) > 2:
+        app.BackendTransport = sys.argv[2]
+    app.MetricsPort = None
+    # every simulated central shares one stub adapter, do not cap them
+    app.SessionMaxCentrals = 1024
+    # state goes to the work directory the benchmark runs us in
+    app.LastStatePath = os.path.join(os.getcwd(), "last_state.sqlite")
+    app.TrustStorePath = os.path.join(os.getcwd(), "trusted_devices.json")
+    app.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Minimal stand-in for bluetoothd on a private bus.
+
+Owns org.bluez and exposes one adapter (/org/bluez/hci0) with Adapter1,
+GattManager1 and LEAdvertisingManager1, plus AgentManager1 on /org/bluez.
+Like bluetoothd it reads the application's object tree and the
+advertisement's properties before acknowledging a registration. Registered
+applications can be listed through com.punchthrough.StubBluez.Applications.
+"""
+
+import argparse
+
+import dbus
+import dbus.bus
+import dbus.mainloop.glib
+import dbus.service
+from gi.repository import GLib
+
+DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+LE_ADVERTISEMENT_IFACE = "org.bluez.LEAdvertisement1"
+STUB_IFACE = "com.punchthrough.StubBluez"
+
+ADAPTER_PATH = "/org/bluez/hci0"
+
+
+class Root(dbus.service.Object):
+    def __init__(self, bus):
+        dbus.service.Object.__init__(self, bus, "/")
+
+    @dbus.service.method(DBUS_OM_IFACE, out_signature="a{oa{sa{sv}}}")
+    def GetManagedObjects(self):
+        return {
+            dbus.ObjectPath(ADAPTER_PATH): {
+                "org.bluez.Adapter1": {
+                    "Address": dbus.String("00:00:00:00:00:00"),
+                    "Powered": dbus.Boolean(True),
+                },
+                "org.bluez.GattManager1": dbus.Dictionary({}, signature="sv"),
+                "org.bluez.LEAdvertisingManager1": dbus.Dictionary({}, signature="sv"),
+            }
+        }
+
+
+class Adapter(dbus.service.Object):
+    def __init__(self, bus):
+        dbus.service.Object.__init__(self, bus, ADAPTER_PATH)
+        self.properties = {"Powered": dbus.Boolean(False)}
+        self.applications = []
+        self.advertisements = []
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="ss", out_signature="v")
+    def Get(self, interface, name):
+        return self.properties[name]
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="ssv")
+    def Set(self, interface, name, value):
+        self.properties[name] = value
+
+    @dbus.service.method(
+        "org.bluez.GattManager1",
+        in_signature="oa{sv}",
+        sender_keyword="sender",
+        async_callbacks=("reply", "error"),
+    )
+    def RegisterApplication(self, path, options, sender, reply, error):
+        om = dbus.Interface(self.connection.get_object(sender, path), DBUS_OM_IFACE)
+
+        def done(objects):
+            self.applications.append((sender, path))
+            reply()
+
+        om.GetManagedObjects(reply_handler=done, error_handler=error)
+
+    @dbus.service.method(
+        "org.bluez.GattManager1", in_signature="o", sender_keyword="sender"
+    )
+    def UnregisterApplication(self, path, sender):
+        self.applications.remove((sender, path))
+
+    @dbus.service.method(
+        "org.bluez.LEAdvertisingManager1",
+        in_signature="oa{sv}",
+        sender_keyword="sender",
+        async_callbacks=("reply", "error"),
+    )
+    def RegisterAdvertisement(self, path, options, sender, reply, error):
+        props = dbus.Interface(self.connection.get_object(sender, path), DBUS_PROP_IFACE)
+
+        def done(properties):
+            self.advertisements.append((sender, path))
+            reply()
+
+        props.GetAll(LE_ADVERTISEMENT_IFACE, reply_handler=done, error_handler=error)
+
+    @dbus.service.method(
+        "org.bluez.LEAdvertisingManager1", in_signature="o", sender_keyword="sender"
+    )
+    def UnregisterAdvertisement(self, path, sender):
+        self.advertisements.remove((sender, path))
+
+    @dbus.service.method(STUB_IFACE, out_signature="a(so)")
+    def Applications(self):
+        return dbus.Array(self.applications, signature="(so)")
+
+    @dbus.service.method(STUB_IFACE, out_signature="a(so)")
+    def Advertisements(self):
+        return dbus.Array(self.advertisements, signature="(so)")
+
+
+class AgentManager(dbus.service.Object):
+    def __init__(self, bus):
+        dbus.service.Object.__init__(self, bus, "/org/bluez")
+
+    @dbus.service.method("org.bluez.AgentManager1", in_signature="os")
+    def RegisterAgent(self, agent, capability):
+        pass
+
+    @dbus.service.method("org.bluez.AgentManager1", in_signature="o")
+    def RequestDefaultAgent(self, agent):
+        pass
+
+    @dbus.service.method("org.bluez.AgentManager1", in_signature="o")
+    def UnregisterAgent(self, agent):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub bluetoothd")
+    parser.add_argument("--address", required=True, help="D-Bus address to serve on")
+    args = parser.parse_args()
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.bus.BusConnection(args.address)
+    name = dbus.service.BusName("org.bluez", bus)
+    objects = [Root(bus), Adapter(bus), AgentManager(bus)]
+
+    GLib.MainLoop().run()
+
+
+if __name__ == "__main__":
+    main()
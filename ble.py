@@ -1,8 +1,25 @@
 
 import dbus
+import dbus.exceptions
+import dbus.lowlevel
+import dbus.service
+import dbus.types
 
+import inspect
 import logging
+import socket
 import sys
+import types
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import metrics
+from metrics import Instrumented
+from pairing import PairingPolicy, device_address
+
+try:
+    from gi.repository import GLib
+except ImportError:
+    import gobject as GLib
 
 DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
 DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
@@ -18,49 +35,311 @@ BLUEZ_SERVICE_NAME = "org.bluez"
 GATT_MANAGER_IFACE = "org.bluez.GattManager1"
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-logHandler = logging.StreamHandler()
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-logHandler.setFormatter(formatter)
-logger.addHandler(logHandler)
 
-logger.setLevel(logging.DEBUG)
+# upper bound on GATT handlers blocking on I/O at the same time
+HANDLER_WORKERS = 8
 
-def find_adapter(bus):
+# ATT default MTU, used until BlueZ reports the negotiated one
+DEFAULT_MTU = 23
+# how long (ms) to wait for more chunks of a long write before applying it
+LONG_WRITE_SETTLE_MS = 50
+
+handler_pool = ThreadPoolExecutor(
+    max_workers=HANDLER_WORKERS, thread_name_prefix="gatt-handler"
+)
+
+
+class InvalidArgsException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.freedesktop.DBus.Error.InvalidArgs"
+
+
+class NotSupportedException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.NotSupported"
+
+
+class NotPermittedException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.NotPermitted"
+
+
+class InvalidValueLengthException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.InvalidValueLength"
+
+
+class FailedException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.Failed"
+
+
+class InvalidOffsetException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.InvalidOffset"
+
+
+class InProgressException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.InProgress"
+
+
+def to_payload(value):
     """
-    Returns the first object that the bluez service has that has a GattManager1 interface
+    Returns value as a dbus.ByteArray. dbus-python marshals it as `ay` in one
+    block instead of one dbus.Byte at a time, so encode values once when
+    they change and hand the payload out as is.
+    """
+    if isinstance(value, dbus.ByteArray):
+        return value
+    return dbus.ByteArray(bytes(value))
+
+
+def read_slice(payload, options):
+    """
+    Returns the part of payload starting at the `offset` BlueZ asked for
+    """
+    offset = int(options.get("offset", 0))
+    if offset == 0:
+        return payload
+    if offset > len(payload):
+        raise InvalidOffsetException()
+    return dbus.ByteArray(memoryview(payload)[offset:])
+
+
+class _PendingWrite:
+    """
+    A reliable write already applied at offset 0, and the chunks continuing
+    it collected until the write settles
+    """
+
+    def __init__(self, options, value):
+        self.options = options
+        self.data = bytearray(value)
+        self.continued = False
+        self.source = None
+
+
+def submit_handler(func, *args):
+    """
+    Starts func(*args) off the main loop and returns a
+    concurrent.futures.Future for its result. Coroutine functions run on
+    the asyncio loop thread (see aioloop), anything else on the handler
+    pool.
+    """
+    if inspect.iscoroutinefunction(func):
+        # asyncio is only imported once a coroutine handler is called
+        import aioloop
+
+        return aioloop.submit(func(*args))
+    return handler_pool.submit(func, *args)
+
+
+def run_in_worker(func, args, reply_handler, error_handler):
+    """
+    Runs func(*args) with submit_handler and hands the result (or the error)
+    back to reply_handler/error_handler on the main loop. A func returning a
+    concurrent.futures.Future is answered with that future's outcome, so
+    waiting for it holds no worker.
+    """
+
+    def deliver(future):
+        error = future.exception()
+        if error is None:
+            result = future.result()
+            if isinstance(result, Future):
+                result.add_done_callback(lambda f: GLib.idle_add(deliver, f))
+                return False
+            reply_handler(result)
+        else:
+            if not isinstance(error, dbus.exceptions.DBusException):
+                logger.error("Handler %s failed: %r", func.__name__, error)
+                error = FailedException(str(error))
+            error_handler(error)
+        return False
+
+    future = submit_handler(func, *args)
+    future.add_done_callback(lambda f: GLib.idle_add(deliver, f))
+
+
+_flags = {}
+
+
+def intern_uuid(uuid):
+    """
+    Returns one shared string per UUID, however many attributes carry it
+    """
+    return sys.intern(str(uuid))
+
+
+def intern_flags(flags):
+    """
+    Returns one shared, read-only dbus.Array per distinct list of flags
+    """
+    key = tuple(flags)
+    array = _flags.get(key)
+    if array is None:
+        array = _flags[key] = dbus.Array(key, signature="s")
+    return array
+
+
+class _Attribute:
+    """
+    Index record of one service, characteristic or descriptor. Handles are
+    numbered in tree order from 1, like the ATT table BlueZ builds.
+    """
+
+    __slots__ = ("handle", "obj")
+
+    def __init__(self, handle, obj):
+        self.handle = handle
+        self.obj = obj
+
+
+class _AttributeIndex:
+    __slots__ = ("by_path", "by_handle", "by_uuid")
+
+    def __init__(self, services):
+        self.by_path = {}
+        self.by_handle = {}
+        by_uuid = {}
+        for obj in _walk(services):
+            attribute = _Attribute(len(self.by_handle) + 1, obj)
+            self.by_path[obj.path] = attribute
+            self.by_handle[attribute.handle] = attribute
+            by_uuid.setdefault(obj.uuid, []).append(attribute)
+        self.by_uuid = {uuid: tuple(attrs) for uuid, attrs in by_uuid.items()}
+
+
+class _LazyObject(dbus.service.Object):
+    """
+    dbus.service.Object whose D-Bus state is only created by export(), when
+    the application first dispatches a call to it. Until then it is a plain
+    object found through the application's index, and its signals go nowhere.
+    """
+
+    _connection = None
+    _object_path = None
+    _locations = ()
+
+    def export(self):
+        if self._connection is None:
+            dbus.service.Object.__init__(self, self.bus, self.path)
+
+
+def _walk(services):
+    for service in services:
+        yield service
+        for chrc in service.characteristics:
+            yield chrc
+            yield from chrc.descriptors
+
+
+def find_adapters(bus):
+    """
+    Returns every object that the bluez service has that has a GattManager1 interface
     """
     remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, "/"), DBUS_OM_IFACE)
     objects = remote_om.GetManagedObjects()
 
-    for o, props in objects.items():
-        if GATT_MANAGER_IFACE in props.keys():
-            return o
+    return sorted(o for o, props in objects.items() if GATT_MANAGER_IFACE in props)
 
-    return None
 
-class Application(dbus.service.Object):
+def find_adapter(bus):
+    """
+    Returns the first object that the bluez service has that has a GattManager1 interface
+    """
+    adapters = find_adapters(bus)
+    return adapters[0] if adapters else None
+
+class Application(Instrumented, dbus.service.FallbackObject):
     """
     org.bluez.GattApplication1 interface implementation
+
+    `sessions`, a sessions.SessionManager, gives each connected central its
+    own rate limits and read cache. `recorder`, a recorder.TrafficRecorder,
+    logs every call centrals make so it can be replayed.
+
+    Services, characteristics and descriptors are not exported when they are
+    created. The application handles calls for every path below its own and
+    exports an attribute the first time BlueZ calls it, so a large table
+    costs a D-Bus registration only for the attributes centrals use.
     """
 
-    def __init__(self, bus):
-        self.path = "/"
+    def __init__(self, bus, path="/", sessions=None, recorder=None):
+        self.path = dbus.ObjectPath(path)
         self.services = []
-        dbus.service.Object.__init__(self, bus, self.path)
-
-        
+        self.sessions = sessions
+        self.recorder = recorder
+        self._managed_objects = None
+        self._index = None
+        if sessions is not None:
+            sessions.on_end.append(self.forget_device)
+        dbus.service.FallbackObject.__init__(self, bus, self.path)
 
     def get_path(self):
-        return dbus.ObjectPath(self.path)
+        return self.path
 
     def add_service(self, service):
         self.services.append(service)
+        service.application = self
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Drops the cached object tree, it is rebuilt on the next GetManagedObjects
+        """
+        self._managed_objects = None
+        self._index = None
+
+    def index(self):
+        if self._index is None:
+            self._index = _AttributeIndex(self.services)
+        return self._index
+
+    def find(self, path):
+        attribute = self.index().by_path.get(path)
+        return attribute.obj if attribute is not None else None
+
+    def find_handle(self, handle):
+        attribute = self.index().by_handle.get(handle)
+        return attribute.obj if attribute is not None else None
+
+    def find_uuid(self, uuid):
+        return [a.obj for a in self.index().by_uuid.get(uuid, ())]
+
+    def handle_of(self, path):
+        attribute = self.index().by_path.get(path)
+        return attribute.handle if attribute is not None else None
+
+    def forget_device(self, device):
+        """
+        Drops what the characteristics keep for a central whose session ended
+        """
+        for service in self.services:
+            for chrc in service.characteristics:
+                chrc.forget(device)
+
+    def export_all(self):
+        """
+        Exports every attribute up front instead of on first use
+        """
+        for obj in _walk(self.services):
+            obj.export()
+
+    def _message_cb(self, connection, message):
+        path = message.get_path()
+        if path == self.path:
+            return dbus.service.FallbackObject._message_cb(self, connection, message)
+
+        obj = self.find(path)
+        if obj is None:
+            if not message.get_no_reply():
+                connection.send_message(
+                    dbus.lowlevel.ErrorMessage(
+                        message, "org.freedesktop.DBus.Error.UnknownObject", path
+                    )
+                )
+            return
+        # from now on libdbus hands calls for this path straight to obj
+        obj.export()
+        return obj._message_cb(connection, message)
 
-    @dbus.service.method(DBUS_OM_IFACE, out_signature="a{oa{sa{sv}}}")
-    def GetManagedObjects(self):
+    def build_managed_objects(self):
         response = {}
-        logger.info("GetManagedObjects")
 
         for service in self.services:
             response[service.get_path()] = service.get_properties()
@@ -73,23 +352,44 @@ class Application(dbus.service.Object):
 
         return response
 
+    @dbus.service.method(DBUS_OM_IFACE, out_signature="a{oa{sa{sv}}}")
+    def GetManagedObjects(self):
+        if self._managed_objects is None:
+            self._managed_objects = self.build_managed_objects()
+            logger.info("GetManagedObjects: built %d objects", len(self._managed_objects))
+        else:
+            logger.debug("GetManagedObjects")
 
-class Service(dbus.service.Object):
+        return self._managed_objects
+
+    def traffic_recorder(self):
+        # metrics.instrument records the calls made on the tree here
+        return self.recorder
+
+
+class Service(Instrumented, _LazyObject):
     """
     org.bluez.GattService1 interface implementation
     """
 
     PATH_BASE = "/org/bluez/example/service"
 
-    def __init__(self, bus, index, uuid, primary):
-        self.path = self.PATH_BASE + str(index)
+    _properties = None
+
+    def __init__(self, bus, index, uuid, primary, path_base=None):
+        self.path = dbus.ObjectPath((path_base or self.PATH_BASE) + str(index))
         self.bus = bus
-        self.uuid = uuid
+        self.uuid = intern_uuid(uuid)
         self.primary = primary
         self.characteristics = []
-        dbus.service.Object.__init__(self, bus, self.path)
+        self.application = None
 
     def get_properties(self):
+        if self._properties is None:
+            self._properties = self.build_properties()
+        return self._properties
+
+    def build_properties(self):
         return {
             GATT_SERVICE_IFACE: {
                 "UUID": self.uuid,
@@ -101,10 +401,19 @@ class Service(dbus.service.Object):
         }
 
     def get_path(self):
-        return dbus.ObjectPath(self.path)
+        return self.path
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Drops cached properties after the service or its children changed
+        """
+        self._properties = None
+        if self.application is not None:
+            self.application.invalidate()
 
     def get_characteristic_paths(self):
         result = []
@@ -115,6 +424,10 @@ class Service(dbus.service.Object):
     def get_characteristics(self):
         return self.characteristics
 
+    def traffic_recorder(self):
+        application = self.application
+        return application.recorder if application is not None else None
+
     @dbus.service.method(DBUS_PROP_IFACE, in_signature="s", out_signature="a{sv}")
     def GetAll(self, interface):
         if interface != GATT_SERVICE_IFACE:
@@ -123,35 +436,79 @@ class Service(dbus.service.Object):
         return self.get_properties()[GATT_SERVICE_IFACE]
 
 
-class Characteristic(dbus.service.Object):
+class Characteristic(Instrumented, _LazyObject):
     """
     org.bluez.GattCharacteristic1 interface implementation
+
+    Subclasses setting `acquire_notify` (needs the "notify" flag) or
+    `acquire_write` (needs "write-without-response") let BlueZ hand out a
+    socket for notifications or writes instead of a D-Bus call per packet.
+
+    read_value and write_value may be plain methods, run on the handler
+    pool, or coroutines (`async def`), run on the asyncio loop thread.
     """
 
+    acquire_notify = False
+    acquire_write = False
+
+    notifying = False
+    _properties = None
+    _notify_sock = None
+    _notify_watch = None
+    _notify_mtu = DEFAULT_MTU
+    _write_sock = None
+    _write_watch = None
+    _write_options = None
+    # per-central state, an instance dict only once a central needs one
+    _mtus = _read_snapshots = _pending_writes = types.MappingProxyType({})
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._read_handler = (
+            cls._read_async if inspect.iscoroutinefunction(cls.read_value) else cls._read
+        )
+
     def __init__(self, bus, index, uuid, flags, service):
-        self.path = service.path + "/char" + str(index)
+        self.path = dbus.ObjectPath(service.path + "/char" + str(index))
         self.bus = bus
-        self.uuid = uuid
+        self.uuid = intern_uuid(uuid)
         self.service = service
-        self.flags = flags
+        self.flags = intern_flags(flags)
         self.descriptors = []
-        dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
-        return {
-            GATT_CHRC_IFACE: {
-                "Service": self.service.get_path(),
-                "UUID": self.uuid,
-                "Flags": self.flags,
-                "Descriptors": dbus.Array(self.get_descriptor_paths(), signature="o"),
-            }
+        if self._properties is None:
+            self._properties = self.build_properties()
+        return self._properties
+
+    def build_properties(self):
+        properties = {
+            "Service": self.service.get_path(),
+            "UUID": self.uuid,
+            "Flags": self.flags,
+            "Descriptors": dbus.Array(self.get_descriptor_paths(), signature="o"),
         }
+        # BlueZ only tries AcquireNotify/AcquireWrite when these are present
+        if self.acquire_notify:
+            properties["NotifyAcquired"] = dbus.Boolean(self._notify_sock is not None)
+        if self.acquire_write:
+            properties["WriteAcquired"] = dbus.Boolean(self._write_sock is not None)
+        return {GATT_CHRC_IFACE: properties}
 
     def get_path(self):
-        return dbus.ObjectPath(self.path)
+        return self.path
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Drops cached properties after the characteristic or its descriptors
+        changed
+        """
+        self._properties = None
+        self.service.invalidate()
 
     def get_descriptor_paths(self):
         result = []
@@ -169,45 +526,449 @@ class Characteristic(dbus.service.Object):
 
         return self.get_properties()[GATT_CHRC_IFACE]
 
-    @dbus.service.method(GATT_CHRC_IFACE, in_signature="a{sv}", out_signature="ay")
-    def ReadValue(self, options):
+    @dbus.service.method(
+        GATT_CHRC_IFACE,
+        in_signature="a{sv}",
+        out_signature="ay",
+        async_callbacks=("reply_handler", "error_handler"),
+    )
+    def ReadValue(self, options, reply_handler, error_handler):
+        self._note_mtu(options)
+        sessions = self.sessions()
+        if sessions is None or int(options.get("offset", 0)):
+            run_in_worker(self._read_handler, (options,), reply_handler, error_handler)
+            return
+
+        try:
+            session = sessions.admit(options.get("device"))
+        except dbus.exceptions.DBusException as e:
+            error_handler(e)
+            return
+
+        payload = session.cached(self.path, sessions.cache_ttl)
+        if payload is None and not session.take(self.path, "read"):
+            # over its rate: a stale answer beats none, and costs nothing
+            payload = session.cached(self.path)
+            if payload is None:
+                sessions.count(session, "throttled", "read")
+                error_handler(InProgressException("Too many requests"))
+                return
+        if payload is not None:
+            sessions.count(session, "cached", "read")
+            self._own("_read_snapshots")[options.get("device")] = payload
+            reply_handler(payload)
+            return
+
+        def served(payload):
+            session.remember(self.path, payload)
+            sessions.count(session, "served", "read")
+            reply_handler(payload)
+
+        run_in_worker(self._read_handler, (options,), served, error_handler)
+
+    @dbus.service.method(
+        GATT_CHRC_IFACE,
+        in_signature="aya{sv}",
+        async_callbacks=("reply_handler", "error_handler"),
+        byte_arrays=True,
+    )
+    def WriteValue(self, value, options, reply_handler, error_handler):
+        self._note_mtu(options)
+        if options.get("prepare-authorize", False):
+            # BlueZ only asks whether a prepared write may be queued
+            reply_handler()
+            return
+
+        device = options.get("device")
+        offset = int(options.get("offset", 0))
+        if offset == 0 and device in self._pending_writes:
+            self._flush_write(device)
+        sessions = self.sessions()
+        if sessions is not None and offset == 0:
+            try:
+                session = sessions.admit(device)
+            except dbus.exceptions.DBusException as e:
+                error_handler(e)
+                return
+            # a Write Command cannot be told it was throttled, and dropping
+            # it could leave the machine on a stale value: commands skip the
+            # bucket, a burst of them is coalesced on the way to the backend
+            if options.get("type") != "command" and not session.take(self.path, "write"):
+                sessions.count(session, "throttled", "write")
+                error_handler(InProgressException("Too many requests"))
+                return
+            sessions.count(session, "served", "write")
+            sessions.forget(self.path)
+        # BlueZ joins the contiguous chunks of a prepared (long or reliable)
+        # write before executing it, so it arrives here whole at offset 0
+        # and gets the handler's outcome as its reply like a Write Request.
+        # Only chunks continuing it at an offset are collected.
+        if offset:
+            try:
+                self._buffer_write(device, value, offset)
+            except dbus.exceptions.DBusException as e:
+                error_handler(e)
+                return
+            reply_handler()
+            return
+
+        if options.get("type") == "reliable":
+            pending = self._own("_pending_writes")[device] = _PendingWrite(options, value)
+
+            def failed(error):
+                if self._pending_writes.get(device) is pending:
+                    del self._pending_writes[device]
+                on_error(error)
+
+            on_error, error_handler = error_handler, failed
+
+        run_in_worker(
+            self.write_value,
+            (value, options),
+            lambda result: reply_handler(),
+            error_handler,
+        )
+
+    def sessions(self):
+        application = self.service.application
+        return application.sessions if application is not None else None
+
+    def traffic_recorder(self):
+        return self.service.traffic_recorder()
+
+    def negotiated_mtu(self, device=None):
+        """
+        Returns the ATT MTU BlueZ last reported for device, so handlers can
+        size payloads (a read returns at most mtu - 1 bytes per request, a
+        notification carries mtu - 3)
+        """
+        return self._mtus.get(device, DEFAULT_MTU)
+
+    def notify_mtu(self):
+        """
+        Returns the MTU notifications should be sized for: the acquired
+        socket's, or the smallest one any central reported
+        """
+        if self._notify_sock is not None:
+            return self._notify_mtu
+        return min(self._mtus.values(), default=DEFAULT_MTU)
+
+    def forget(self, device):
+        """
+        Drops the MTU and read snapshot kept for device, and applies a long
+        write it left pending
+        """
+        if device in self._pending_writes:
+            self._flush_write(device)
+        for table in (self._mtus, self._read_snapshots):
+            if device in table:
+                del table[device]
+
+    def _own(self, name):
+        # the instance's own dict for one of the per-central tables
+        table = self.__dict__.get(name)
+        if table is None:
+            table = self.__dict__[name] = {}
+        return table
+
+    def _note_mtu(self, options):
+        if "mtu" in options:
+            self._own("_mtus")[options.get("device")] = int(options["mtu"])
+
+    def _read(self, options):
+        payload = self._continued_read(options)
+        if payload is None:
+            payload = self._keep_read(options, self.read_value(options))
+        return payload
+
+    async def _read_async(self, options):
+        payload = self._continued_read(options)
+        if payload is None:
+            payload = self._keep_read(options, await self.read_value(options))
+        return payload
+
+    # subclasses with an `async def` read_value get _read_async
+    _read_handler = _read
+
+    def _continued_read(self, options):
+        # a long read arrives as several requests with growing offsets, serve
+        # the continuation from the value read at offset 0
+        if int(options.get("offset", 0)):
+            payload = self._read_snapshots.get(options.get("device"))
+            if payload is not None:
+                return read_slice(payload, options)
+        return None
+
+    def _keep_read(self, options, value):
+        payload = self._own("_read_snapshots")[options.get("device")] = to_payload(value)
+        return read_slice(payload, options)
+
+    def _buffer_write(self, device, value, offset):
+        pending = self._pending_writes.get(device)
+        if pending is None or offset != len(pending.data):
+            raise InvalidOffsetException()
+
+        pending.data += value
+        pending.continued = True
+        if pending.source is not None:
+            GLib.source_remove(pending.source)
+        pending.source = GLib.timeout_add(
+            LONG_WRITE_SETTLE_MS, self._write_settled, device
+        )
+
+    def _write_settled(self, device):
+        pending = self._pending_writes.get(device)
+        if pending is not None:
+            pending.source = None
+            self._flush_write(device)
+        return False
+
+    def _flush_write(self, device):
+        pending = self._pending_writes.pop(device)
+        if pending.source is not None:
+            GLib.source_remove(pending.source)
+        if not pending.continued:
+            # applied as it was when it arrived at offset 0
+            return
+        options = dict(pending.options)
+        options.pop("offset", None)
+        logger.debug("%s: applying %d byte long write", self.path, len(pending.data))
+
+        def failed(error):
+            logger.error("%s: long write failed: %s", self.path, error)
+
+        run_in_worker(
+            self.write_value,
+            (to_payload(pending.data), options),
+            lambda result: None,
+            failed,
+        )
+
+    def read_value(self, options):
+        """
+        Returns the value for ReadValue, ideally a payload from to_payload.
+        Runs on the handler pool, so it may block on I/O without stalling the
+        main loop. Continuations of long reads are served by the base class.
+        An `async def` override runs on the asyncio loop and must not block.
+        """
         logger.info("Default ReadValue called, returning error")
         raise NotSupportedException()
 
-    @dbus.service.method(GATT_CHRC_IFACE, in_signature="aya{sv}")
-    def WriteValue(self, value, options):
+    def write_value(self, value, options):
+        """
+        Applies a WriteValue. Runs on the handler pool, or the asyncio loop,
+        like read_value. Long and reliable writes arrive here whole, as
+        BlueZ joins their chunks; a chunk continuing one later brings the
+        joined value here again once the write settles. A plain method may
+        return a concurrent.futures.Future instead of blocking on one, the
+        central is answered when it completes.
+        """
         logger.info("Default WriteValue called, returning error")
         raise NotSupportedException()
 
     @dbus.service.method(GATT_CHRC_IFACE)
     def StartNotify(self):
-        logger.info("Default StartNotify called, returning error")
-        raise NotSupportedException()
+        if "notify" not in self.flags and "indicate" not in self.flags:
+            logger.info("StartNotify called on %s, returning error", self.path)
+            raise NotSupportedException()
+        if self.notifying:
+            return
+        self.notifying = True
+        self.start_notify()
 
     @dbus.service.method(GATT_CHRC_IFACE)
     def StopNotify(self):
-        logger.info("Default StopNotify called, returning error")
-        raise NotSupportedException()
+        if not self.notifying:
+            return
+        if self._notify_sock is not None:
+            self._release_notify()
+            return
+        self.notifying = False
+        self.stop_notify()
+
+    def start_notify(self):
+        """
+        Called on the main loop when the first central subscribes
+        """
+        pass
+
+    def stop_notify(self):
+        """
+        Called on the main loop when the last central unsubscribes
+        """
+        pass
+
+    def notify_value(self, value):
+        """
+        Sends value to subscribed centrals. Must be called on the main loop.
+
+        Goes through the acquired notify socket when there is one, one
+        notification per MTU-sized chunk, and falls back to PropertiesChanged
+        otherwise. Returns False if the value was dropped because the socket
+        is full.
+        """
+        if not self.notifying:
+            return False
+        if self._notify_sock is None:
+            self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": to_payload(value)}, [])
+            metrics.registry.inc(
+                "gatt_notifications_total", (("path", self.path), ("via", "signal"))
+            )
+            return True
+
+        view = memoryview(bytes(value))
+        chunk = max(self._notify_mtu - 3, 1)
+        try:
+            for start in range(0, max(len(view), 1), chunk):
+                self._notify_sock.send(view[start : start + chunk])
+        except BlockingIOError:
+            metrics.registry.inc("gatt_notifications_dropped_total", (("path", self.path),))
+            return False
+        except OSError as e:
+            logger.warning("%s: notify socket failed (%s), using signals", self.path, e)
+            self._release_notify(keep_notifying=True)
+            self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": to_payload(value)}, [])
+            metrics.registry.inc(
+                "gatt_notifications_total", (("path", self.path), ("via", "signal"))
+            )
+            return True
+        metrics.registry.inc(
+            "gatt_notifications_total", (("path", self.path), ("via", "socket"))
+        )
+        return True
+
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature="a{sv}", out_signature="hq")
+    def AcquireNotify(self, options):
+        if not self.acquire_notify or "notify" not in self.flags:
+            raise NotSupportedException()
+        if self._notify_sock is not None or self.notifying:
+            raise NotPermittedException("Notifications already enabled")
+
+        self._note_mtu(options)
+        self._notify_mtu = int(options.get("mtu", DEFAULT_MTU))
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        ours.setblocking(False)
+        self._notify_sock = ours
+        # BlueZ closes its end when the central unsubscribes
+        self._notify_watch = GLib.io_add_watch(
+            ours.fileno(),
+            GLib.PRIORITY_DEFAULT,
+            GLib.IO_HUP | GLib.IO_ERR,
+            self._notify_hangup,
+        )
+        self._acquired_changed("NotifyAcquired", True)
+
+        self.notifying = True
+        self.start_notify()
+        return self._hand_out(theirs, self._notify_mtu)
+
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature="a{sv}", out_signature="hq")
+    def AcquireWrite(self, options):
+        if not self.acquire_write or "write-without-response" not in self.flags:
+            raise NotSupportedException()
+        if self._write_sock is not None:
+            raise NotPermittedException("Write already acquired")
+
+        self._note_mtu(options)
+        mtu = int(options.get("mtu", DEFAULT_MTU))
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        ours.setblocking(False)
+        self._write_sock = ours
+        self._write_options = {
+            "device": options.get("device"),
+            "mtu": dbus.UInt16(mtu),
+            "type": "command",
+        }
+        self._write_watch = GLib.io_add_watch(
+            ours.fileno(),
+            GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+            self._write_ready,
+        )
+        self._acquired_changed("WriteAcquired", True)
+        return self._hand_out(theirs, mtu)
+
+    def _hand_out(self, sock, mtu):
+        # UnixFd dups the descriptor, BlueZ owns the copy
+        fd = dbus.types.UnixFd(sock.fileno())
+        sock.close()
+        return fd, dbus.UInt16(mtu)
+
+    def _acquired_changed(self, name, acquired):
+        self.invalidate()
+        self.PropertiesChanged(GATT_CHRC_IFACE, {name: dbus.Boolean(acquired)}, [])
+
+    def _notify_hangup(self, fd, condition):
+        logger.debug("%s: notify socket closed", self.path)
+        self._notify_watch = None
+        self._release_notify()
+        return False
+
+    def _release_notify(self, keep_notifying=False):
+        if self._notify_watch is not None:
+            GLib.source_remove(self._notify_watch)
+            self._notify_watch = None
+        self._notify_sock.close()
+        self._notify_sock = None
+        self._acquired_changed("NotifyAcquired", False)
+        if not keep_notifying and self.notifying:
+            self.notifying = False
+            self.stop_notify()
+
+    def _write_ready(self, fd, condition):
+        data = b""
+        if condition & GLib.IO_IN:
+            try:
+                data = self._write_sock.recv(int(self._write_options["mtu"]))
+            except BlockingIOError:
+                return True
+            except OSError as e:
+                logger.warning("%s: write socket failed: %s", self.path, e)
+
+        if not data:
+            logger.debug("%s: write socket closed", self.path)
+            self._write_sock.close()
+            self._write_sock = None
+            self._write_watch = None
+            self._acquired_changed("WriteAcquired", False)
+            return False
+
+        def failed(error):
+            logger.error("%s: acquired write failed: %s", self.path, error)
+
+        run_in_worker(
+            self.write_value,
+            (to_payload(data), dict(self._write_options)),
+            lambda result: None,
+            failed,
+        )
+        return True
 
     @dbus.service.signal(DBUS_PROP_IFACE, signature="sa{sv}as")
     def PropertiesChanged(self, interface, changed, invalidated):
         pass
 
 
-class Descriptor(dbus.service.Object):
+class Descriptor(Instrumented, _LazyObject):
     """
     org.bluez.GattDescriptor1 interface implementation
     """
 
+    _properties = None
+
     def __init__(self, bus, index, uuid, flags, characteristic):
-        self.path = characteristic.path + "/desc" + str(index)
+        self.path = dbus.ObjectPath(characteristic.path + "/desc" + str(index))
         self.bus = bus
-        self.uuid = uuid
-        self.flags = flags
+        self.uuid = intern_uuid(uuid)
+        self.flags = intern_flags(flags)
         self.chrc = characteristic
-        dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
+        if self._properties is None:
+            self._properties = self.build_properties()
+        return self._properties
+
+    def build_properties(self):
         return {
             GATT_DESC_IFACE: {
                 "Characteristic": self.chrc.get_path(),
@@ -217,7 +978,14 @@ class Descriptor(dbus.service.Object):
         }
 
     def get_path(self):
-        return dbus.ObjectPath(self.path)
+        return self.path
+
+    def invalidate(self):
+        self._properties = None
+        self.chrc.invalidate()
+
+    def traffic_recorder(self):
+        return self.chrc.traffic_recorder()
 
     @dbus.service.method(DBUS_PROP_IFACE, in_signature="s", out_signature="a{sv}")
     def GetAll(self, interface):
@@ -231,16 +999,16 @@ class Descriptor(dbus.service.Object):
         logger.info("Default ReadValue called, returning error")
         raise NotSupportedException()
 
-    @dbus.service.method(GATT_DESC_IFACE, in_signature="aya{sv}")
+    @dbus.service.method(GATT_DESC_IFACE, in_signature="aya{sv}", byte_arrays=True)
     def WriteValue(self, value, options):
         logger.info("Default WriteValue called, returning error")
         raise NotSupportedException()
 
-class Advertisement(dbus.service.Object):
+class Advertisement(Instrumented, dbus.service.Object):
     PATH_BASE = "/org/bluez/example/advertisement"
 
-    def __init__(self, bus, index, advertising_type):
-        self.path = self.PATH_BASE + str(index)
+    def __init__(self, bus, index, advertising_type, path_base=None):
+        self.path = (path_base or self.PATH_BASE) + str(index)
         self.bus = bus
         self.ad_type = advertising_type
         self.service_uuids = None
@@ -250,6 +1018,12 @@ class Advertisement(dbus.service.Object):
         self.local_name = None
         self.include_tx_power = None
         self.data = None
+        self.scan_response_service_uuids = None
+        self.scan_response_manufacturer_data = None
+        self.scan_response_service_data = None
+        self.scan_response_data = None
+        # called with no arguments when BlueZ drops the advertisement
+        self.on_release = None
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
@@ -274,8 +1048,35 @@ class Advertisement(dbus.service.Object):
 
         if self.data is not None:
             properties["Data"] = dbus.Dictionary(self.data, signature="yv")
+
+        if self.scan_response_service_uuids is not None:
+            properties["ScanResponseServiceUUIDs"] = dbus.Array(
+                self.scan_response_service_uuids, signature="s"
+            )
+        if self.scan_response_manufacturer_data is not None:
+            properties["ScanResponseManufacturerData"] = dbus.Dictionary(
+                self.scan_response_manufacturer_data, signature="qv"
+            )
+        if self.scan_response_service_data is not None:
+            properties["ScanResponseServiceData"] = dbus.Dictionary(
+                self.scan_response_service_data, signature="sv"
+            )
+        if self.scan_response_data is not None:
+            properties["ScanResponseData"] = dbus.Dictionary(
+                self.scan_response_data, signature="yv"
+            )
         return {LE_ADVERTISEMENT_IFACE: properties}
 
+    def update(self, *names):
+        """
+        Tells BlueZ the named properties changed, so it refreshes the data
+        being advertised without the advertisement being registered again
+        """
+        properties = self.get_properties()[LE_ADVERTISEMENT_IFACE]
+        changed = {name: properties[name] for name in names if name in properties}
+        invalidated = [name for name in names if name not in properties]
+        self.PropertiesChanged(LE_ADVERTISEMENT_IFACE, changed, invalidated)
+
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
@@ -311,36 +1112,43 @@ class Advertisement(dbus.service.Object):
 
     @dbus.service.method(DBUS_PROP_IFACE, in_signature="s", out_signature="a{sv}")
     def GetAll(self, interface):
-        logger.info("GetAll")
+        logger.debug("GetAll")
         if interface != LE_ADVERTISEMENT_IFACE:
             raise InvalidArgsException()
-        logger.info("returning props")
         return self.get_properties()[LE_ADVERTISEMENT_IFACE]
 
+    @dbus.service.signal(DBUS_PROP_IFACE, signature="sa{sv}as")
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
     @dbus.service.method(LE_ADVERTISEMENT_IFACE, in_signature="", out_signature="")
     def Release(self):
-        logger.info("%s: Released!" % self.path)
+        logger.info("%s: Released!", self.path)
+        if self.on_release is not None:
+            self.on_release()
 
 
 AGENT_INTERFACE = "org.bluez.Agent1"
 
 
 
-def ask(prompt):
-    try:
-        return raw_input(prompt)
-    except:
-        return input(prompt)
-
-
-def set_trusted(path):
+def set_trusted(bus, path):
+    """
+    Marks a device trusted without waiting for BlueZ to answer
+    """
     props = dbus.Interface(
         bus.get_object("org.bluez", path), "org.freedesktop.DBus.Properties"
     )
-    props.Set("org.bluez.Device1", "Trusted", True)
+    props.Set(
+        "org.bluez.Device1",
+        "Trusted",
+        dbus.Boolean(True),
+        reply_handler=lambda: None,
+        error_handler=lambda error: logger.error("Trusting %s failed: %s", path, error),
+    )
 
 
-def dev_connect(path):
+def dev_connect(bus, path):
     dev = dbus.Interface(bus.get_object("org.bluez", path), "org.bluez.Device1")
     dev.Connect()
 
@@ -349,63 +1157,85 @@ class Rejected(dbus.DBusException):
     _dbus_error_name = "org.bluez.Error.Rejected"
 
 
-class Agent(dbus.service.Object):
-    exit_on_release = True
+class Agent(Instrumented, dbus.service.Object):
+    """
+    org.bluez.Agent1 implementation answering from a pairing.PairingPolicy,
+    so requests are decided on the spot instead of waiting for someone at
+    a console. Devices that pair are marked trusted, and remembered when
+    the policy lists them.
+    """
 
-    def set_exit_on_release(self, exit_on_release):
-        self.exit_on_release = exit_on_release
+    def __init__(self, bus, path, policy=None):
+        dbus.service.Object.__init__(self, bus, path)
+        self.bus = bus
+        self.policy = policy or PairingPolicy()
+
+    def decide(self, method, device):
+        address = device_address(device)
+        allowed = self.policy.allows(address)
+        metrics.registry.inc(
+            "pairing_decisions_total",
+            (("method", method), ("result", "allowed" if allowed else "rejected")),
+        )
+        if not allowed:
+            logger.warning("%s: rejected %s", method, address)
+            raise Rejected("%s is not allowed to pair" % address)
+        return address
+
+    def trust(self, device, address):
+        self.policy.trust(address)
+        set_trusted(self.bus, device)
 
     @dbus.service.method(AGENT_INTERFACE, in_signature="", out_signature="")
     def Release(self):
+        # BlueZ releases the agent when it exits, the supervisor registers
+        # it again once bluetoothd is back
         logger.info("Release")
-        if self.exit_on_release:
-            mainloop.quit()
 
     @dbus.service.method(AGENT_INTERFACE, in_signature="os", out_signature="")
     def AuthorizeService(self, device, uuid):
-        logger.info("AuthorizeService (%s, %s)" % (device, uuid))
-        authorize = ask("Authorize connection (yes/no): ")
-        if authorize == "yes":
-            return
-        raise Rejected("Connection rejected by user")
+        logger.info("AuthorizeService (%s, %s)", device, uuid)
+        self.decide("AuthorizeService", device)
 
     @dbus.service.method(AGENT_INTERFACE, in_signature="o", out_signature="s")
     def RequestPinCode(self, device):
-        logger.info("RequestPinCode (%s)" % (device))
-        set_trusted(device)
-        return ask("Enter PIN Code: ")
+        logger.info("RequestPinCode (%s)", device)
+        address = self.decide("RequestPinCode", device)
+        if self.policy.pin is None:
+            raise Rejected("No PIN code configured")
+        self.trust(device, address)
+        return self.policy.pin
 
     @dbus.service.method(AGENT_INTERFACE, in_signature="o", out_signature="u")
     def RequestPasskey(self, device):
-        logger.info("RequestPasskey (%s)" % (device))
-        set_trusted(device)
-        passkey = ask("Enter passkey: ")
-        return dbus.UInt32(passkey)
+        logger.info("RequestPasskey (%s)", device)
+        address = self.decide("RequestPasskey", device)
+        if self.policy.passkey is None:
+            raise Rejected("No passkey configured")
+        self.trust(device, address)
+        return dbus.UInt32(self.policy.passkey)
 
     @dbus.service.method(AGENT_INTERFACE, in_signature="ouq", out_signature="")
     def DisplayPasskey(self, device, passkey, entered):
-        logger.info("DisplayPasskey (%s, %06u entered %u)" % (device, passkey, entered))
+        logger.info("DisplayPasskey (%s, %06u entered %u)", device, passkey, entered)
 
     @dbus.service.method(AGENT_INTERFACE, in_signature="os", out_signature="")
     def DisplayPinCode(self, device, pincode):
-        logger.info("DisplayPinCode (%s, %s)" % (device, pincode))
+        logger.info("DisplayPinCode (%s, %s)", device, pincode)
 
     @dbus.service.method(AGENT_INTERFACE, in_signature="ou", out_signature="")
     def RequestConfirmation(self, device, passkey):
-        logger.info("RequestConfirmation (%s, %06d)" % (device, passkey))
-        confirm = ask("Confirm passkey (yes/no): ")
-        if confirm == "yes":
-            set_trusted(device)
-            return
-        raise Rejected("Passkey doesn't match")
+        logger.info("RequestConfirmation (%s, %06d)", device, passkey)
+        address = self.decide("RequestConfirmation", device)
+        if not self.policy.auto_confirm:
+            raise Rejected("Passkey confirmation is disabled")
+        self.trust(device, address)
 
     @dbus.service.method(AGENT_INTERFACE, in_signature="o", out_signature="")
     def RequestAuthorization(self, device):
-        logger.info("RequestAuthorization (%s)" % (device))
-        auth = ask("Authorize? (yes/no): ")
-        if auth == "yes":
-            return
-        raise Rejected("Pairing rejected")
+        logger.info("RequestAuthorization (%s)", device)
+        address = self.decide("RequestAuthorization", device)
+        self.trust(device, address)
 
     @dbus.service.method(AGENT_INTERFACE, in_signature="", out_signature="")
     def Cancel(self):
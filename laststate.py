@@ -0,0 +1,113 @@
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LastStateStore:
+    """
+    The last good backend snapshot of each machine, with the time it was
+    fetched, kept in memory and in a sqlite file.
+
+    Lookups only touch memory. Saves are written by a background thread,
+    latest snapshot per key only. An unchanged snapshot is written again
+    only every `refresh_interval` seconds to keep its timestamp current
+    without writing to flash on every poll.
+    """
+
+    def __init__(self, path, refresh_interval=30.0):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self._snapshots = {}
+        self._written = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._writer = None
+        self._load()
+
+    def _connect(self):
+        # sqlite3 is imported where it is used, only once a store exists
+        import sqlite3
+
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots ("
+            "key TEXT PRIMARY KEY, data TEXT NOT NULL, fetched_at REAL NOT NULL)"
+        )
+        return db
+
+    def _load(self):
+        import sqlite3
+
+        try:
+            db = self._connect()
+            try:
+                rows = db.execute("SELECT key, data, fetched_at FROM snapshots").fetchall()
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            logger.error("Could not load last known state from %s: %s", self.path, e)
+            return
+
+        for key, data, fetched_at in rows:
+            try:
+                self._snapshots[key] = (json.loads(data), fetched_at)
+            except ValueError:
+                logger.warning("Dropping unreadable last known state of %s", key)
+        self._written = dict(self._snapshots)
+        logger.info("last known state of %d machines loaded", len(self._snapshots))
+
+    def get(self, key):
+        """
+        Returns (snapshot, fetched_at wall clock time) or None
+        """
+        return self._snapshots.get(key)
+
+    def put(self, key, snapshot, fetched_at=None):
+        entry = (snapshot, time.time() if fetched_at is None else fetched_at)
+        with self._lock:
+            self._snapshots[key] = entry
+            written = self._written.get(key)
+            if (
+                written is not None
+                and written[0] == snapshot
+                and entry[1] - written[1] < self.refresh_interval
+            ):
+                return
+            self._written[key] = entry
+            self._pending[key] = entry
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._write_loop, name="last-state", daemon=True
+                )
+                self._writer.start()
+        self._wake.set()
+
+    def _write_loop(self):
+        import sqlite3
+
+        # sqlite connections stay on the thread that opened them
+        try:
+            db = self._connect()
+        except sqlite3.Error as e:
+            logger.error("Could not open %s, last known state is not saved: %s", self.path, e)
+            return
+
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            try:
+                with db:
+                    db.executemany(
+                        "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)",
+                        [(k, json.dumps(s), t) for k, (s, t) in pending.items()],
+                    )
+            except (sqlite3.Error, TypeError, ValueError) as e:
+                logger.error("Could not save last known state: %s", e)
@@ -0,0 +1,85 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record
+    """
+
+    def format(self, record):
+        entry = {
+            "ts": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=repr)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that merges the message arguments on the logging thread,
+    while the objects they refer to still hold the logged state, and leaves
+    the rest of the formatting (timestamp, JSON, traceback) to the listener
+    thread
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        return record
+
+
+def configure():
+    """
+    Routes all logging through a queue drained by a background listener that
+    writes to stderr and a rotating file. Configured from the environment:
+
+    VIVALDI_LOG_LEVEL   level name, default INFO
+    VIVALDI_LOG_FILE    file to write, default logs.log, empty to disable
+    VIVALDI_LOG_FORMAT  "text" (default) or "json"
+    """
+    global _listener
+
+    if _listener is not None:
+        return
+
+    level = os.environ.get("VIVALDI_LOG_LEVEL", "INFO").upper()
+    path = os.environ.get("VIVALDI_LOG_FILE", "logs.log")
+    if os.environ.get("VIVALDI_LOG_FORMAT", "text") == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT)
+
+    handlers = [logging.StreamHandler()]
+    if path:
+        handlers.append(
+            logging.handlers.RotatingFileHandler(path, maxBytes=5 * 1024 * 1024, backupCount=3)
+        )
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(DeferredQueueHandler(log_queue))
+
+    _listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -0,0 +1,291 @@
+import bisect
+import functools
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# latency bucket upper bounds in seconds
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """
+    Counters, gauges and latency histograms keyed by metric name and a
+    tuple of (label, value) pairs, rendered in the Prometheus text format
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set(self, name, value, labels=()):
+        with self._lock:
+            self._gauges[(name, labels)] = value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def counter(self, name, labels=()):
+        with self._lock:
+            return self._counters.get((name, labels), 0)
+
+    def gauge(self, name, labels=()):
+        with self._lock:
+            return self._gauges.get((name, labels))
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted(
+                (key, (h.buckets, list(h.counts), h.sum, h.count))
+                for key, h in self._histograms.items()
+            )
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+        for (name, labels), value in gauges:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+        for (name, labels), (buckets, counts, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(
+                    f"{name}_bucket{_labels(labels + (('le', repr(bound)),))} {cumulative}"
+                )
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+registry = Registry()
+
+
+def error_name(error):
+    """
+    Returns the D-Bus error name a handler exception is reported as
+    """
+    get_dbus_name = getattr(error, "get_dbus_name", None)
+    name = get_dbus_name() if get_dbus_name is not None else None
+    return name or "org.freedesktop.DBus.Python." + type(error).__name__
+
+
+def _object_label(obj):
+    return getattr(obj, "path", None) or getattr(obj, "_object_path", None) or type(obj).__name__
+
+
+def _finish(labels, start, error):
+    registry.observe("dbus_handler_seconds", time.perf_counter() - start, labels)
+    registry.inc("dbus_calls_total", labels)
+    if error is not None:
+        registry.inc("dbus_errors_total", labels + (("error", error_name(error)),))
+
+
+def _begin_recording(obj, name, args):
+    # objects whose traffic_recorder() returns a recorder.TrafficRecorder
+    # have their calls recorded too
+    traffic_recorder = getattr(obj, "traffic_recorder", None)
+    recorder = traffic_recorder() if traffic_recorder is not None else None
+    return recorder.begin(name, obj.path, args) if recorder is not None else None
+
+
+def instrument(func, name, async_callbacks=None):
+    """
+    Wraps a D-Bus method implementation to count calls and errors and time
+    it, and to record it to the object's traffic recorder if it has one.
+    For async_callbacks methods the time runs until the reply or error is
+    sent, and the time spent marshalling the reply is recorded apart.
+    """
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        labels = (("method", name), ("path", _object_label(self)))
+        start = time.perf_counter()
+        recording = _begin_recording(self, name, args)
+
+        if async_callbacks:
+            reply_name, error_name_ = async_callbacks
+            reply_handler = kwargs[reply_name]
+            error_handler = kwargs[error_name_]
+
+            def on_reply(*result):
+                marshal_start = time.perf_counter()
+                reply_handler(*result)
+                registry.observe(
+                    "dbus_reply_seconds", time.perf_counter() - marshal_start, labels
+                )
+                _finish(labels, start, None)
+                if recording is not None:
+                    recording.done(result[0] if result else None)
+
+            def on_error(error):
+                error_handler(error)
+                _finish(labels, start, error)
+                if recording is not None:
+                    recording.done(error=error)
+
+            kwargs[reply_name] = on_reply
+            kwargs[error_name_] = on_error
+
+        try:
+            result = func(self, *args, **kwargs)
+        except Exception as e:
+            _finish(labels, start, e)
+            if recording is not None:
+                recording.done(error=e)
+            raise
+        if not async_callbacks:
+            _finish(labels, start, None)
+            if recording is not None:
+                recording.done(result)
+        return result
+
+    wrapper._instrumented = True
+    return wrapper
+
+
+def _dbus_method(cls, name):
+    for klass in cls.__mro__:
+        func = klass.__dict__.get(name)
+        if func is not None and getattr(func, "_dbus_is_method", False):
+            return func
+    return None
+
+
+def instrument_class(cls):
+    """
+    Instruments every D-Bus method cls defines or overrides
+    """
+    for name, func in list(cls.__dict__.items()):
+        if not callable(func) or getattr(func, "_instrumented", False):
+            continue
+        method = _dbus_method(cls, name)
+        if method is None:
+            continue
+        async_callbacks = getattr(method, "_dbus_async_callbacks", None)
+        setattr(cls, name, instrument(func, name, async_callbacks))
+
+
+class Instrumented:
+    """
+    Mixin for dbus.service.Object classes: instruments the D-Bus methods of
+    the class and of every subclass, including plain overrides
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        instrument_class(cls)
+
+
+class _Handler:
+    # methods of the http.server.BaseHTTPRequestHandler serve() builds.
+    # health returns a dict with a "healthy" key, served as JSON at /health
+    health = None
+
+    def do_GET(self):
+        if self.path == "/health" and self.health is not None:
+            report = self.health()
+            status = 200 if report.get("healthy") else 503
+            self.reply(status, json.dumps(report, default=str), "application/json")
+        elif self.path in ("/", "/metrics"):
+            self.reply(200, registry.render(), "text/plain; version=0.0.4")
+        else:
+            self.send_error(404)
+
+    def reply(self, status, text, content_type):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host="127.0.0.1", health=None):
+    """
+    Serves the registry at http://host:port/metrics from a daemon thread,
+    and the report health() returns at /health if given. Returns the
+    server, or None if the port could not be bound: monitoring must not
+    take the BLE service down with it.
+    """
+    # http.server pulls in http.client, email and ssl, only load it if needed
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    handler = type(
+        "Handler",
+        (_Handler, BaseHTTPRequestHandler),
+        {"health": staticmethod(health)} if health else {},
+    )
+    try:
+        server = ThreadingHTTPServer((host, port), handler)
+    except OSError as e:
+        logger.error("Could not serve metrics on %s:%s: %s", host, port, e)
+        return None
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    logger.info("serving metrics on http://%s:%s/metrics", host, port)
+    return server
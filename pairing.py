@@ -0,0 +1,142 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def device_address(path):
+    """
+    Returns the address of a BlueZ device object path,
+    e.g. /org/bluez/hci0/dev_AA_BB_CC_DD_EE_FF -> AA:BB:CC:DD:EE:FF
+    """
+    name = path.rsplit("/", 1)[-1]
+    if name.startswith("dev_"):
+        name = name[4:]
+    return name.replace("_", ":").upper()
+
+
+def _normalize(address):
+    return address.replace("-", ":").upper()
+
+
+class TrustStore:
+    """
+    Addresses of devices that paired before, kept in memory and saved to a
+    JSON file. Lookups never touch the disk; saves are written from a
+    background thread, replacing the file atomically.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._devices = {}
+        self._lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._writer = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self._devices = {_normalize(a): v for a, v in json.load(f).items()}
+        except FileNotFoundError:
+            self._devices = {}
+        except (OSError, ValueError) as e:
+            logger.error("Could not load trusted devices from %s: %s", self.path, e)
+            self._devices = {}
+        logger.info("%d trusted devices", len(self._devices))
+
+    def __contains__(self, address):
+        return address in self._devices
+
+    def __len__(self):
+        return len(self._devices)
+
+    def add(self, address):
+        if address in self._devices:
+            return
+        with self._lock:
+            devices = dict(self._devices)
+            devices[address] = {"trusted_at": time.time()}
+            self._devices = devices
+        self._save()
+
+    def remove(self, address):
+        if address not in self._devices:
+            return
+        with self._lock:
+            devices = dict(self._devices)
+            devices.pop(address, None)
+            self._devices = devices
+        self._save()
+
+    def _save(self):
+        self._dirty.set()
+        if self._writer is None:
+            self._writer = threading.Thread(
+                target=self._write_loop, name="trust-store", daemon=True
+            )
+            self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            self._dirty.wait()
+            self._dirty.clear()
+            devices = self._devices
+            tmp = self.path + ".tmp"
+            try:
+                with open(tmp, "w") as f:
+                    json.dump(devices, f, indent=1, sort_keys=True)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                logger.error("Could not save trusted devices to %s: %s", self.path, e)
+
+
+class PairingPolicy:
+    """
+    Decides pairing requests without asking anyone.
+
+    A device is allowed if it is in the trust store, its address is in
+    allow_addresses or its first three octets are in allow_ouis. With both
+    lists empty every device is allowed when allow_unknown is set. Only
+    devices in the lists are added to the trust store when they pair.
+    Numeric comparison requests are confirmed for allowed devices when
+    auto_confirm is set; pin and passkey answer legacy pairing requests and
+    are refused when None.
+    """
+
+    def __init__(
+        self,
+        allow_addresses=(),
+        allow_ouis=(),
+        allow_unknown=False,
+        auto_confirm=True,
+        pin=None,
+        passkey=None,
+        store=None,
+    ):
+        self.allow_addresses = frozenset(_normalize(a) for a in allow_addresses)
+        self.allow_ouis = frozenset(_normalize(o)[:8] for o in allow_ouis)
+        self.allow_unknown = allow_unknown
+        self.auto_confirm = auto_confirm
+        self.pin = pin
+        self.passkey = passkey
+        self.store = store
+
+    def allows(self, address):
+        if self.store is not None and address in self.store:
+            return True
+        if self.listed(address):
+            return True
+        return self.allow_unknown and not (self.allow_addresses or self.allow_ouis)
+
+    def listed(self, address):
+        return address in self.allow_addresses or address[:8] in self.allow_ouis
+
+    def trust(self, address):
+        # a device let in only by allow_unknown is not remembered, so
+        # configuring allow lists later shuts it out again
+        if self.store is not None and self.listed(address):
+            self.store.add(address)
@@ -0,0 +1,58 @@
+import logging
+
+from ble import GLib, submit_handler
+
+logger = logging.getLogger(__name__)
+
+
+class Poller:
+    """
+    Calls `fetch` off the main loop (ble.submit_handler) every `interval`
+    seconds between start() and stop(), never more than one call at a time,
+    and hands each result to `on_result` on the main loop. `args`, if given,
+    returns the arguments for each call. Failed calls are logged under
+    `name` and skipped.
+    """
+
+    def __init__(self, fetch, interval, on_result, args=None, name="poll"):
+        self.fetch = fetch
+        self.interval = interval
+        self.on_result = on_result
+        self.args = args
+        self.name = name
+        self._source = None
+        self._polling = False
+
+    @property
+    def active(self):
+        return self._source is not None
+
+    def start(self):
+        if self._source is None:
+            logger.debug("starting %s", self.name)
+            self._source = GLib.timeout_add(int(self.interval * 1000), self._tick)
+            self._tick()
+
+    def stop(self):
+        if self._source is not None:
+            logger.debug("stopping %s", self.name)
+            GLib.source_remove(self._source)
+            self._source = None
+
+    def _tick(self):
+        if not self._polling:
+            self._polling = True
+            args = self.args() if self.args is not None else ()
+            future = submit_handler(self.fetch, *args)
+            future.add_done_callback(lambda f: GLib.idle_add(self._done, f))
+        return True
+
+    def _done(self, future):
+        self._polling = False
+        error = future.exception()
+        if error is not None:
+            logger.warning("%s failed: %s", self.name, error)
+        elif self._source is not None:
+            # a result arriving after stop() is for nobody
+            self.on_result(future.result())
+        return False
@@ -0,0 +1,291 @@
+import atexit
+import logging
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# log header: magic, version, flags, wall clock time recording started
+HEADER = struct.Struct("<4sBBd")
+MAGIC = b"GTRC"
+VERSION = 1
+# write payloads follow their WRITE_VALUE records
+FLAG_PAYLOADS = 0x01
+
+# every record starts with its kind. A NAME record gives a device or
+# attribute path its id the first time one is seen: kind, namespace, id,
+# length of the UTF-8 path that follows.
+NAME = 0
+NAME_RECORD = struct.Struct("<BBHH")
+ATTRIBUTE = 0
+DEVICE = 1
+
+# the other kinds are calls: kind, microseconds since recording started,
+# attribute id, device id, offset, MTU, write type, result, payload size
+# (objects for GetManagedObjects), handler latency in microseconds
+READ_VALUE = 1
+WRITE_VALUE = 2
+START_NOTIFY = 3
+STOP_NOTIFY = 4
+GET_MANAGED_OBJECTS = 5
+CALL_RECORD = struct.Struct("<BQHHHHBBII")
+OPS = {
+    READ_VALUE: "ReadValue",
+    WRITE_VALUE: "WriteValue",
+    START_NOTIFY: "StartNotify",
+    STOP_NOTIFY: "StopNotify",
+    GET_MANAGED_OBJECTS: "GetManagedObjects",
+}
+_OPS_BY_NAME = {name: op for op, name in OPS.items()}
+
+OK = 0
+ERROR = 1
+
+# write types from the options BlueZ passes, with prepare-authorize as a flag
+WRITE_TYPES = {"request": 1, "command": 2, "reliable": 3}
+PREPARE_AUTHORIZE = 0x80
+
+# buffered records are written out once there are this many bytes of them,
+# or every flush_interval seconds
+FLUSH_BYTES = 64 * 1024
+
+
+class Call:
+    """
+    One call read back from a log by read_log
+    """
+
+    __slots__ = (
+        "op", "t", "path", "device", "offset", "mtu", "write_type", "result", "size",
+        "latency", "payload",
+    )
+
+    def __init__(
+        self, op, t, path, device, offset, mtu, write_type, result, size, latency, payload
+    ):
+        self.op = op
+        self.t = t
+        self.path = path
+        self.device = device
+        self.offset = offset
+        self.mtu = mtu
+        self.write_type = write_type
+        self.result = result
+        self.size = size
+        self.latency = latency
+        self.payload = payload
+
+    def options(self):
+        """
+        Returns the options dict BlueZ passed with the call, as far as it
+        was recorded
+        """
+        options = {}
+        if self.device is not None:
+            options["device"] = self.device
+        if self.offset:
+            options["offset"] = self.offset
+        if self.mtu:
+            options["mtu"] = self.mtu
+        for name, code in WRITE_TYPES.items():
+            if self.write_type & ~PREPARE_AUTHORIZE == code:
+                options["type"] = name
+        if self.write_type & PREPARE_AUTHORIZE:
+            options["prepare-authorize"] = True
+        return options
+
+
+class _Recording:
+    """
+    One call being recorded, written out by done() when it is answered
+    """
+
+    __slots__ = ("recorder", "op", "start", "path", "options", "size", "payload")
+
+    def __init__(self, recorder, op, path, args):
+        self.recorder = recorder
+        self.op = op
+        self.start = recorder.clock()
+        self.path = path
+        self.options = None
+        self.size = 0
+        self.payload = None
+        if op == READ_VALUE and args:
+            self.options = args[0]
+        elif op == WRITE_VALUE and len(args) > 1:
+            self.payload, self.options = args[0], args[1]
+            self.size = len(self.payload)
+
+    def done(self, result=None, error=None):
+        """
+        Records the call, answered with result (the payload of a read, the
+        objects of GetManagedObjects) or failed with error
+        """
+        size = self.size
+        if error is None and result is not None and self.op != WRITE_VALUE:
+            size = len(result)
+        self.recorder.record(
+            self.op, self.start, self.path, self.options, size,
+            OK if error is None else ERROR, self.payload,
+        )
+
+
+class TrafficRecorder:
+    """
+    Records the GATT calls centrals make, for ble.Application(recorder=).
+
+    Each call becomes a fixed-size binary record: when it arrived, which
+    attribute and device, offset, MTU, write type, outcome, payload size and
+    how long the handler took to answer. Paths are written once and then
+    referred to by id. Write payloads are kept only with `payloads`, as they
+    may be private. Records are appended from the main loop to a buffer that
+    a background thread writes out, so recording costs no disk I/O on the
+    main loop. benchmarks/replay.py plays a log back.
+    """
+
+    def __init__(self, path, payloads=False, flush_interval=1.0, clock=time.perf_counter):
+        self.path = path
+        self.payloads = payloads
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.started = clock()
+        self._ids = ({}, {})
+        self._buffer = bytearray(
+            HEADER.pack(MAGIC, VERSION, FLAG_PAYLOADS if payloads else 0, time.time())
+        )
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._file = open(path, "wb")
+        self._writer = threading.Thread(
+            target=self._write_loop, name="traffic-recorder", daemon=True
+        )
+        self._writer.start()
+        atexit.register(self.close)
+        logger.info("recording GATT traffic to %s", path)
+
+    def record(self, op, start, path, options=None, size=0, result=OK, payload=None):
+        """
+        Records a call that arrived at `start` and was answered just now
+        """
+        now = self.clock()
+        options = options or {}
+        write_type = WRITE_TYPES.get(options.get("type"), 0)
+        if options.get("prepare-authorize", False):
+            write_type |= PREPARE_AUTHORIZE
+        with self._lock:
+            attribute = self._id(ATTRIBUTE, path)
+            device = self._id(DEVICE, options.get("device"))
+            self._buffer += CALL_RECORD.pack(
+                op,
+                int((start - self.started) * 1e6),
+                attribute,
+                device,
+                min(int(options.get("offset", 0)), 0xFFFF),
+                min(int(options.get("mtu", 0)), 0xFFFF),
+                write_type,
+                result,
+                size,
+                min(int((now - start) * 1e6), 0xFFFFFFFF),
+            )
+            if op == WRITE_VALUE and self.payloads:
+                self._buffer += bytes(payload or b"")[:size].ljust(size, b"\0")
+            full = len(self._buffer) >= FLUSH_BYTES
+        if full:
+            self._wake.set()
+
+    def begin(self, name, path, args):
+        """
+        Returns a _Recording of a call to the D-Bus method `name` with the
+        arguments BlueZ passed, or None if name is not a recorded method.
+        metrics.instrument calls this for every GATT object whose
+        traffic_recorder() returns this recorder.
+        """
+        op = _OPS_BY_NAME.get(name)
+        return _Recording(self, op, path, args) if op is not None else None
+
+    def _id(self, namespace, name):
+        # 0 stands for none, e.g. the device of a GetManagedObjects
+        if name is None:
+            return 0
+        ids = self._ids[namespace]
+        record_id = ids.get(name)
+        if record_id is None:
+            record_id = ids[name] = len(ids) + 1
+            encoded = str(name).encode("utf-8")
+            self._buffer += NAME_RECORD.pack(NAME, namespace, record_id, len(encoded))
+            self._buffer += encoded
+        return record_id
+
+    def _write_loop(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        # holding the file lock from the swap on keeps buffers in order
+        with self._file_lock:
+            with self._lock:
+                data, self._buffer = self._buffer, bytearray()
+            if not data or self._file.closed:
+                return
+            try:
+                self._file.write(data)
+                self._file.flush()
+            except OSError as e:
+                logger.error("Could not write traffic log %s: %s", self.path, e)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self.flush()
+        with self._file_lock:
+            self._file.close()
+
+
+def read_log(path):
+    """
+    Returns (wall clock start time, list of Call) read from a traffic log
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, flags, started = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("%s is not a version %d traffic log" % (path, VERSION))
+
+    names = ({0: None}, {0: None})
+    calls = []
+    pos = HEADER.size
+    while pos < len(data):
+        if data[pos] == NAME:
+            if pos + NAME_RECORD.size > len(data):
+                break
+            kind, namespace, record_id, length = NAME_RECORD.unpack_from(data, pos)
+            pos += NAME_RECORD.size
+            if pos + length > len(data):
+                break
+            names[namespace][record_id] = data[pos : pos + length].decode("utf-8")
+            pos += length
+            continue
+
+        if pos + CALL_RECORD.size > len(data):
+            # the recorder was killed mid-write
+            break
+        op, t, attribute, device, offset, mtu, write_type, result, size, latency = (
+            CALL_RECORD.unpack_from(data, pos)
+        )
+        pos += CALL_RECORD.size
+        payload = None
+        if op == WRITE_VALUE and flags & FLAG_PAYLOADS:
+            payload = data[pos : pos + size]
+            pos += size
+        calls.append(Call(
+            op, t / 1e6, names[ATTRIBUTE][attribute], names[DEVICE][device], offset, mtu,
+            write_type, result, size, latency / 1e6, payload,
+        ))
+    return started, calls
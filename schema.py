@@ -0,0 +1,171 @@
+"""
+Declarative GATT schema.
+
+A schema file (JSON, or YAML when PyYAML is installed) lists services and
+their characteristics: UUIDs, flags, the backend status field a
+characteristic reads, the codec used to turn that field into bytes and the
+command posted to the backend on write. Codecs and command templates are
+resolved into plain functions when the file is loaded, so request handlers
+never look anything up by name.
+
+    {
+        "services": [{
+            "uuid": "...",
+            "primary": true,
+            "characteristics": [{
+                "uuid": "...",
+                "flags": ["read", "write", "notify"],
+                "description": "Get/set boiler state",
+                "field": "boiler",
+                "codec": "utf8",
+                "command": {"cmd": "setboiler", "state": "$lower"}
+            }]
+        }]
+    }
+
+Command values of "$value" are replaced by the decoded written value and
+"$lower" by its lower-cased form.
+"""
+
+import json
+import os
+import struct
+
+from ble import InvalidArgsException, InvalidValueLengthException, NotPermittedException
+
+
+class SchemaError(ValueError):
+    pass
+
+
+def _utf8_codec(spec):
+    def encode(value):
+        return str(value).encode("utf-8")
+
+    def decode(data):
+        try:
+            return bytes(data).decode("utf-8")
+        except UnicodeDecodeError:
+            raise InvalidArgsException("Value is not valid UTF-8")
+
+    return encode, decode
+
+
+def _utf8_enum_codec(spec):
+    values = spec.get("values")
+    if not values:
+        raise SchemaError("utf8-enum codec needs a list of values")
+    allowed = frozenset(values)
+    encode, decode_utf8 = _utf8_codec(spec)
+
+    def decode(data):
+        value = decode_utf8(data)
+        if value not in allowed:
+            raise NotPermittedException(f"Invalid value {value!r}")
+        return value
+
+    return encode, decode
+
+
+def _struct_codec(fmt):
+    packer = struct.Struct(fmt)
+
+    def codec(spec):
+        def encode(value):
+            return packer.pack(int(value))
+
+        def decode(data):
+            if len(data) != packer.size:
+                raise InvalidValueLengthException()
+            return packer.unpack(bytes(data))[0]
+
+        return encode, decode
+
+    return codec
+
+
+CODECS = {
+    "utf8": _utf8_codec,
+    "utf8-enum": _utf8_enum_codec,
+    "uint8": _struct_codec("<B"),
+    "int16": _struct_codec("<h"),
+    "uint16": _struct_codec("<H"),
+    "int32": _struct_codec("<i"),
+    "uint32": _struct_codec("<I"),
+}
+
+_PLACEHOLDERS = {
+    "$value": lambda value: value,
+    "$lower": lambda value: value.lower(),
+}
+
+
+def compile_command(template):
+    """
+    Returns a function building the command body for a written value
+    """
+    constant = {}
+    dynamic = []
+    for key, item in template.items():
+        if isinstance(item, str) and item in _PLACEHOLDERS:
+            dynamic.append((key, _PLACEHOLDERS[item]))
+        else:
+            constant[key] = item
+
+    def make_command(value):
+        data = dict(constant)
+        for key, transform in dynamic:
+            data[key] = transform(value)
+        return data
+
+    return make_command
+
+
+class CharacteristicSpec:
+    def __init__(self, spec):
+        try:
+            self.uuid = spec["uuid"]
+            self.flags = list(spec["flags"])
+        except KeyError as e:
+            raise SchemaError(f"characteristic is missing {e}")
+
+        self.field = spec.get("field")
+        self.default = spec.get("default")
+        self.description = spec.get("description", "").encode("utf-8")
+
+        codec = spec.get("codec", "utf8")
+        if codec not in CODECS:
+            raise SchemaError(f"unknown codec {codec!r} for {self.uuid}")
+        self.encode, self.decode = CODECS[codec](spec)
+
+        command = spec.get("command")
+        self.make_command = compile_command(command) if command else None
+
+
+class ServiceSpec:
+    def __init__(self, spec):
+        try:
+            self.uuid = spec["uuid"]
+        except KeyError:
+            raise SchemaError("service is missing 'uuid'")
+        self.primary = spec.get("primary", True)
+        self.characteristics = [
+            CharacteristicSpec(c) for c in spec.get("characteristics", [])
+        ]
+
+
+def load_schema(path):
+    """
+    Reads a schema file and returns its compiled list of ServiceSpec
+    """
+    with open(path) as f:
+        if os.path.splitext(path)[1] in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError:
+                raise SchemaError("PyYAML is needed to load " + path)
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+
+    return [ServiceSpec(s) for s in spec.get("services", [])]
@@ -0,0 +1,220 @@
+import logging
+import time
+
+import dbus
+
+import metrics
+from ble import GLib, NotPermittedException
+from pairing import device_address
+
+logger = logging.getLogger(__name__)
+
+DEVICE_IFACE = "org.bluez.Device1"
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+
+
+class TokenBucket:
+    """
+    Allows `rate` operations per second on average and bursts of up to
+    `burst` operations
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "clock")
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.clock = clock
+        self.updated = clock()
+
+    def take(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Session:
+    """
+    State of one connected central: a rate limiter per characteristic and
+    operation, the payloads it last read, and request counts
+    """
+
+    def __init__(self, device, limits, clock=time.monotonic):
+        self.device = device
+        self.address = device_address(device) if device else "unknown"
+        self.limits = limits
+        self.clock = clock
+        self.connected_at = clock()
+        self.last_seen = self.connected_at
+        self.buckets = {}
+        self.cache = {}
+        self.stats = {"served": 0, "cached": 0, "throttled": 0}
+
+    def take(self, path, op):
+        key = (path, op)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            rate, burst = self.limits[op]
+            bucket = self.buckets[key] = TokenBucket(rate, burst, self.clock)
+        return bucket.take()
+
+    def cached(self, path, max_age=None):
+        """
+        Returns the payload this session last read from path, if it is
+        younger than max_age seconds (any age if None)
+        """
+        entry = self.cache.get(path)
+        if entry is None:
+            return None
+        payload, read_at = entry
+        if max_age is not None and self.clock() - read_at >= max_age:
+            return None
+        return payload
+
+    def remember(self, path, payload):
+        self.cache[path] = (payload, self.clock())
+
+
+class SessionManager:
+    """
+    Sessions of the centrals connected to one adapter, keyed by the device
+    path BlueZ passes in the options of every request.
+
+    Each central gets its own token bucket per characteristic, so one
+    polling in a loop only slows itself down: its reads are answered from
+    its read cache, or rejected as busy when it has none. Reads within
+    cache_ttl seconds of the previous one are answered from the cache
+    without reaching the handler. Centrals beyond max_sessions are refused
+    and disconnected. The callbacks in `on_end` are called with the device
+    path of every session that ends.
+    """
+
+    def __init__(
+        self,
+        bus=None,
+        max_sessions=4,
+        read_rate=20.0,
+        read_burst=10,
+        write_rate=5.0,
+        write_burst=5,
+        cache_ttl=0.5,
+        idle_timeout=300.0,
+        name="",
+        clock=time.monotonic,
+    ):
+        self.bus = bus
+        self.max_sessions = max_sessions
+        self.limits = {"read": (read_rate, read_burst), "write": (write_rate, write_burst)}
+        self.cache_ttl = cache_ttl
+        self.idle_timeout = idle_timeout
+        self.name = name
+        self.clock = clock
+        self.sessions = {}
+        self.on_end = []
+        self._labels = (("adapter", name),)
+
+    def start(self):
+        """
+        Ends sessions when their device disconnects, and sweeps idle ones
+        """
+        if self.bus is not None:
+            self.bus.add_signal_receiver(
+                self._properties_changed,
+                signal_name="PropertiesChanged",
+                dbus_interface=DBUS_PROP_IFACE,
+                bus_name="org.bluez",
+                arg0=DEVICE_IFACE,
+                path_keyword="path",
+            )
+        GLib.timeout_add_seconds(max(int(self.idle_timeout // 2), 1), self._sweep)
+
+    def admit(self, device):
+        """
+        Returns the session of device, starting one if there is room.
+        Raises NotPermittedException when the connection cap is reached.
+        """
+        session = self.sessions.get(device)
+        if session is None:
+            if len(self.sessions) >= self.max_sessions:
+                metrics.registry.inc("gatt_sessions_refused_total", self._labels)
+                logger.warning("%s: session cap reached, refusing %s", self.name, device)
+                self._disconnect(device)
+                raise NotPermittedException("Too many connections")
+            session = self.sessions[device] = Session(device, self.limits, self.clock)
+            logger.info("%s: session started for %s", self.name, session.address)
+            self._publish_count()
+        session.last_seen = self.clock()
+        return session
+
+    def count(self, session, result, op):
+        session.stats[result] += 1
+        metrics.registry.inc(
+            "gatt_session_requests_total", self._labels + (("op", op), ("result", result))
+        )
+
+    def forget(self, path):
+        """
+        Drops every session's cached read of path, after a write changed it
+        """
+        for session in self.sessions.values():
+            session.cache.pop(path, None)
+
+    def end(self, device):
+        session = self.sessions.pop(device, None)
+        if session is not None:
+            logger.info(
+                "%s: session ended for %s after %.0fs %r",
+                self.name, session.address, self.clock() - session.connected_at, session.stats,
+            )
+            self._publish_count()
+            self._ended(device)
+
+    def clear(self):
+        """
+        Ends every session, when bluetoothd or the adapter went away and took
+        the connections with it without a Connected=False for each
+        """
+        if self.sessions:
+            logger.info("%s: dropping %d sessions", self.name, len(self.sessions))
+        sessions, self.sessions = self.sessions, {}
+        self._publish_count()
+        for device in sessions:
+            self._ended(device)
+
+    def _ended(self, device):
+        for callback in self.on_end:
+            callback(device)
+
+    def stats(self):
+        now = self.clock()
+        return {
+            session.address: dict(session.stats, connected=now - session.connected_at)
+            for session in self.sessions.values()
+        }
+
+    def _publish_count(self):
+        metrics.registry.set("gatt_sessions", len(self.sessions), self._labels)
+
+    def _properties_changed(self, interface, changed, invalidated, path=None):
+        if changed.get("Connected") is False:
+            self.end(path)
+
+    def _sweep(self):
+        deadline = self.clock() - self.idle_timeout
+        for device, session in list(self.sessions.items()):
+            if session.last_seen < deadline:
+                self.end(device)
+        return True
+
+    def _disconnect(self, device):
+        if self.bus is None or not device:
+            return
+        dbus.Interface(self.bus.get_object("org.bluez", device), DEVICE_IFACE).Disconnect(
+            reply_handler=lambda: None,
+            error_handler=lambda error: logger.debug("Disconnect %s: %s", device, error),
+        )
@@ -0,0 +1,205 @@
+import logging
+import threading
+import time
+
+from ble import handler_pool
+from polling import Poller
+
+logger = logging.getLogger(__name__)
+
+
+class _Fetch:
+    """
+    A single in-flight refresh that concurrent readers can wait on
+    """
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MachineStatus:
+    """
+    Shared snapshot of the machine state reported by the backend.
+
+    Every characteristic of a service reads from the same snapshot, so a
+    central reading power, boiler and auto-off back to back costs one backend
+    round trip. Reads that arrive while a refresh is running wait for it
+    instead of starting their own, and `invalidate` forces the next read to
+    go back to the backend (call it after posting a command).
+
+    With a `store` (laststate.LastStateStore) every good snapshot is saved
+    under `key`. After a restart, or once a refresh failed, reads are
+    answered from the last good snapshot straight away while a single
+    refresh runs in the background, so they never wait on a dead backend.
+    Once there is a snapshot, a read waits at most `stale_wait` seconds for
+    a refresh and is answered from the snapshot if it takes longer.
+    `source` and `age()` tell how current the snapshot is.
+    """
+
+    LIVE = "live"
+    STORED = "stored"
+
+    def __init__(
+        self, fetch, max_age=2.0, clock=time.monotonic, store=None, key=None, stale_wait=0.5
+    ):
+        self._fetch = fetch
+        self.max_age = max_age
+        self.stale_wait = stale_wait
+        self._clock = clock
+        self._store = store
+        self._key = key
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._fetched_at = None
+        self._generation = 0
+        self._inflight = None
+        self.source = None
+        # wall clock time of the snapshot, it survives restarts in the store
+        self.fetched_wall = None
+
+        stored = store.get(key) if store is not None else None
+        if stored is not None:
+            self._snapshot, self.fetched_wall = stored
+            self.source = self.STORED
+
+    def _is_fresh(self):
+        return (
+            self._fetched_at is not None
+            and self._clock() - self._fetched_at < self.max_age
+        )
+
+    def get(self):
+        """
+        Returns the current snapshot, refreshing it if it is older than
+        `max_age`. Raises whatever the fetch raised if the refresh failed
+        and there is no earlier snapshot to fall back on.
+        """
+        with self._lock:
+            if self._is_fresh():
+                return self._snapshot
+            fetch = self._inflight
+            if self.source == self.STORED:
+                # cold start or outage: answer now, refresh in the background
+                if fetch is None:
+                    fetch = self._inflight = _Fetch(self._generation)
+                    handler_pool.submit(self._run, fetch)
+                return self._snapshot
+            leader = fetch is None
+            if leader:
+                fetch = self._inflight = _Fetch(self._generation)
+            fallback = self._snapshot
+
+        if fallback is None:
+            # nothing to answer with until the backend replies
+            if leader:
+                self._run(fetch)
+            else:
+                fetch.done.wait()
+        else:
+            if leader:
+                handler_pool.submit(self._run, fetch)
+            if not fetch.done.wait(self.stale_wait):
+                logger.debug("status refresh is slow, serving the previous snapshot")
+                return fallback
+
+        if fetch.error is not None:
+            # _run fell back to the last good snapshot if there is one
+            with self._lock:
+                if self.source == self.STORED:
+                    return self._snapshot
+            raise fetch.error
+        return fetch.result
+
+    def _run(self, fetch):
+        accepted = None
+        try:
+            fetch.result = self._fetch()
+        except Exception as e:
+            fetch.error = e
+        finally:
+            with self._lock:
+                if self._inflight is fetch:
+                    self._inflight = None
+                if fetch.error is not None:
+                    if self._snapshot is not None and self.source != self.STORED:
+                        logger.warning("status refresh failed, serving the last good snapshot")
+                        self.source = self.STORED
+                # a snapshot fetched before an invalidation is already stale
+                elif fetch.generation == self._generation:
+                    self._snapshot = fetch.result
+                    self._fetched_at = self._clock()
+                    self.fetched_wall = accepted = time.time()
+                    self.source = self.LIVE
+            fetch.done.set()
+
+        # only the snapshot now served is kept for the next start
+        if accepted is not None and self._store is not None:
+            self._store.put(self._key, fetch.result, accepted)
+
+    def age(self):
+        """
+        Seconds since the snapshot was fetched, None if there is none
+        """
+        if self.fetched_wall is None:
+            return None
+        return max(time.time() - self.fetched_wall, 0.0)
+
+    def field(self, name):
+        return self.get()[name]
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._fetched_at = None
+            self._inflight = None
+        logger.debug("status snapshot invalidated")
+
+
+class StatusPoller:
+    """
+    Polls a `MachineStatus` (or an aiobackend.AsyncMachineStatus) on the
+    main loop while anyone is subscribed and calls each field's subscribers
+    only when that field's value changed.
+
+    Subscribers are called on the main loop, so they may emit D-Bus signals
+    directly. Polling stops as soon as the last subscriber goes away.
+    """
+
+    def __init__(self, status, interval=1.0):
+        self.status = status
+        self.interval = interval
+        self._subscribers = {}
+        self._last = {}
+        self._poller = Poller(status.get, interval, self._on_snapshot, name="status poll")
+
+    @property
+    def active(self):
+        return self._poller.active
+
+    def subscribe(self, field, callback):
+        self._subscribers.setdefault(field, []).append(callback)
+        self._poller.start()
+
+    def unsubscribe(self, field, callback):
+        callbacks = self._subscribers.get(field, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks:
+            self._subscribers.pop(field, None)
+            self._last.pop(field, None)
+        if not self._subscribers:
+            self._poller.stop()
+
+    def _on_snapshot(self, snapshot):
+        for field, callbacks in list(self._subscribers.items()):
+            if field not in snapshot:
+                continue
+            value = snapshot[field]
+            if field in self._last and self._last[field] == value:
+                continue
+            self._last[field] = value
+            for callback in list(callbacks):
+                callback(value)
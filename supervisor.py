@@ -0,0 +1,216 @@
+import logging
+import time
+
+import dbus
+import dbus.exceptions
+
+import metrics
+from ble import GLib, find_adapters
+
+logger = logging.getLogger(__name__)
+
+BLUEZ_SERVICE_NAME = "org.bluez"
+ADAPTER_IFACE = "org.bluez.Adapter1"
+AGENT_MANAGER_IFACE = "org.bluez.AgentManager1"
+GATT_MANAGER_IFACE = "org.bluez.GattManager1"
+DBUS_IFACE = "org.freedesktop.DBus"
+DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+
+# registration states reported by health()
+DOWN = "down"  # bluetoothd or the adapter is not there
+REGISTERING = "registering"
+REGISTERED = "registered"
+BACKOFF = "backoff"  # the last attempt failed, another one is scheduled
+
+
+class Backoff:
+    """
+    Exponential retry delays in seconds, from initial up to maximum
+    """
+
+    def __init__(self, initial=1.0, maximum=30.0, factor=2.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.current = initial
+
+    def next(self):
+        delay = self.current
+        self.current = min(self.current * self.factor, self.maximum)
+        return delay
+
+    def reset(self):
+        self.current = self.initial
+
+
+class Supervisor:
+    """
+    Keeps the agent and every machine registered with bluetoothd.
+
+    Watches NameOwnerChanged for org.bluez and InterfacesAdded/Removed and
+    Powered changes for the adapters. When bluetoothd restarts or an adapter
+    resets, BlueZ forgets our registrations but the exported objects stay as
+    they are, so the machines only have to power the adapter on and register
+    again. Failed attempts are retried with backoff; health() reports where
+    everything stands.
+    """
+
+    def __init__(self, bus, machines, agent_path, capability="NoInputNoOutput", backoff=None):
+        self.bus = bus
+        self.machines = {machine.adapter: machine for machine in machines}
+        self.agent_path = agent_path
+        self.capability = capability
+        self.backoff = backoff or Backoff()
+        self.bluez_up = False
+        self.agent_registered = False
+        self._agent_retry = None
+        self.started_at = time.monotonic()
+
+    def start(self, adapters=None):
+        """
+        Starts watching bluetoothd and registers everything. Pass the
+        adapters already found to skip listing them again.
+        """
+        self.bus.add_signal_receiver(
+            self._owner_changed,
+            signal_name="NameOwnerChanged",
+            dbus_interface=DBUS_IFACE,
+            bus_name=DBUS_IFACE,
+            arg0=BLUEZ_SERVICE_NAME,
+        )
+        self.bus.add_signal_receiver(
+            self._interfaces_added,
+            signal_name="InterfacesAdded",
+            dbus_interface=DBUS_OM_IFACE,
+            bus_name=BLUEZ_SERVICE_NAME,
+        )
+        self.bus.add_signal_receiver(
+            self._interfaces_removed,
+            signal_name="InterfacesRemoved",
+            dbus_interface=DBUS_OM_IFACE,
+            bus_name=BLUEZ_SERVICE_NAME,
+        )
+        self.bus.add_signal_receiver(
+            self._properties_changed,
+            signal_name="PropertiesChanged",
+            dbus_interface=DBUS_PROP_IFACE,
+            bus_name=BLUEZ_SERVICE_NAME,
+            arg0=ADAPTER_IFACE,
+            path_keyword="path",
+        )
+
+        if adapters is not None or self.bus.name_has_owner(BLUEZ_SERVICE_NAME):
+            self._bluez_appeared(adapters)
+        else:
+            logger.warning("bluetoothd is not running, waiting for it")
+
+    def health(self):
+        return {
+            "healthy": self.healthy,
+            "bluez": self.bluez_up,
+            "agent": self.agent_registered,
+            "uptime": time.monotonic() - self.started_at,
+            "machines": {m.name: m.health() for m in self.machines.values()},
+        }
+
+    @property
+    def healthy(self):
+        return (
+            self.bluez_up
+            and self.agent_registered
+            and all(m.state == REGISTERED for m in self.machines.values())
+        )
+
+    def _owner_changed(self, name, old_owner, new_owner):
+        if old_owner:
+            self._bluez_vanished()
+        if new_owner:
+            self._bluez_appeared()
+
+    def _bluez_appeared(self, adapters=None):
+        logger.info("bluetoothd is up")
+        self.bluez_up = True
+        self.backoff.reset()
+
+        if adapters is None:
+            try:
+                adapters = find_adapters(self.bus)
+            except dbus.exceptions.DBusException as e:
+                logger.error("Listing adapters failed: %s", e)
+                adapters = []
+        for adapter, machine in self.machines.items():
+            if adapter in adapters:
+                machine.register()
+            else:
+                logger.warning("%s: adapter not present, waiting for it", machine.name)
+
+        # advertising goes first, the agent is only needed once a central
+        # pairs
+        self._register_agent()
+
+    def _bluez_vanished(self):
+        logger.warning("bluetoothd went away")
+        metrics.registry.inc("bluez_restarts_total")
+        self.bluez_up = False
+        self.agent_registered = False
+        if self._agent_retry is not None:
+            GLib.source_remove(self._agent_retry)
+            self._agent_retry = None
+        for machine in self.machines.values():
+            machine.lost()
+
+    def _interfaces_added(self, path, interfaces):
+        machine = self.machines.get(path)
+        if machine is not None and GATT_MANAGER_IFACE in interfaces:
+            logger.info("%s: adapter appeared", machine.name)
+            machine.register()
+
+    def _interfaces_removed(self, path, interfaces):
+        machine = self.machines.get(path)
+        if machine is not None and ADAPTER_IFACE in interfaces:
+            logger.warning("%s: adapter removed", machine.name)
+            machine.lost()
+
+    def _properties_changed(self, interface, changed, invalidated, path=None):
+        machine = self.machines.get(path)
+        if machine is not None and changed.get("Powered") is False:
+            logger.warning("%s: adapter powered off", machine.name)
+            machine.powered_off()
+
+    def _register_agent(self):
+        self._agent_retry = None
+        manager = dbus.Interface(
+            self.bus.get_object(BLUEZ_SERVICE_NAME, "/org/bluez", introspect=False),
+            AGENT_MANAGER_IFACE,
+        )
+
+        def registered():
+            manager.RequestDefaultAgent(
+                self.agent_path, reply_handler=made_default, error_handler=failed
+            )
+
+        def register_failed(error):
+            if error.get_dbus_name() == "org.bluez.Error.AlreadyExists":
+                registered()
+            else:
+                failed(error)
+
+        def made_default():
+            logger.info("Agent registered")
+            self.agent_registered = True
+
+        def failed(error):
+            if not self.bluez_up:
+                return
+            delay = self.backoff.next()
+            logger.error("Registering agent failed: %s, retrying in %.1fs", error, delay)
+            self._agent_retry = GLib.timeout_add(int(delay * 1000), self._register_agent)
+
+        manager.RegisterAgent(
+            self.agent_path,
+            self.capability,
+            reply_handler=registered,
+            error_handler=register_failed,
+        )
+        return False
@@ -0,0 +1,153 @@
+import collections
+import logging
+import struct
+
+from polling import Poller
+
+logger = logging.getLogger(__name__)
+
+# frame: version, sample count, sequence number of the first sample
+FRAME_HEADER = struct.Struct("<BBH")
+# sample: ms since the previous sample, pressure (centibar),
+# temperature (centidegrees C), flow (centi-ml/s)
+SAMPLE = struct.Struct("<HHhH")
+FRAME_VERSION = 1
+
+
+class Sample:
+    __slots__ = ("seq", "t", "pressure", "temperature", "flow")
+
+    def __init__(self, seq, t, pressure, temperature, flow):
+        self.seq = seq
+        self.t = t
+        self.pressure = pressure
+        self.temperature = temperature
+        self.flow = flow
+
+
+def _clamp(value, low, high):
+    return max(low, min(high, int(round(value))))
+
+
+def samples_per_frame(mtu):
+    """
+    Returns how many samples fit one notification for the given ATT MTU
+    """
+    return max((mtu - 3 - FRAME_HEADER.size) // SAMPLE.size, 1)
+
+
+def pack_frame(samples, previous_t=None):
+    """
+    Packs samples into one frame. Timestamps are sent as deltas to the
+    previous sample, the first one relative to previous_t (the last sample of
+    the previous frame) when given.
+    """
+    frame = bytearray(FRAME_HEADER.size + SAMPLE.size * len(samples))
+    FRAME_HEADER.pack_into(frame, 0, FRAME_VERSION, len(samples), samples[0].seq & 0xFFFF)
+
+    t = samples[0].t if previous_t is None else previous_t
+    offset = FRAME_HEADER.size
+    for sample in samples:
+        SAMPLE.pack_into(
+            frame,
+            offset,
+            _clamp(sample.t - t, 0, 0xFFFF),
+            _clamp(sample.pressure * 100, 0, 0xFFFF),
+            _clamp(sample.temperature * 100, -0x8000, 0x7FFF),
+            _clamp(sample.flow * 100, 0, 0xFFFF),
+        )
+        t = sample.t
+        offset += SAMPLE.size
+    return bytes(frame)
+
+
+def decimate(samples):
+    """
+    Halves the sample rate, keeping the newest sample
+    """
+    return samples[(len(samples) + 1) % 2 :: 2]
+
+
+class TelemetryBuffer:
+    """
+    Bounded ring buffer of the most recent samples
+    """
+
+    def __init__(self, capacity):
+        self._samples = collections.deque(maxlen=capacity)
+        self._seq = 0
+
+    @property
+    def latest_t(self):
+        return self._samples[-1].t if self._samples else None
+
+    def extend(self, raw_samples):
+        """
+        Stores backend samples and returns them as numbered Samples
+        """
+        added = []
+        for raw in raw_samples:
+            sample = Sample(
+                self._seq,
+                int(raw["t"]),
+                float(raw["pressure"]),
+                float(raw["temperature"]),
+                float(raw["flow"]),
+            )
+            self._seq += 1
+            self._samples.append(sample)
+            added.append(sample)
+        return added
+
+    def latest(self):
+        return self._samples[-1] if self._samples else None
+
+    def clear(self):
+        self._samples.clear()
+
+    def recent(self, seconds):
+        if not self._samples:
+            return []
+        since = self._samples[-1].t - seconds * 1000
+        return [s for s in self._samples if s.t > since]
+
+
+class TelemetryFeed:
+    """
+    Polls the backend for new shot samples on the main loop while anyone is
+    subscribed, stores them in the ring buffer and hands each batch to the
+    subscribers.
+
+    The buffer is emptied when the last subscriber goes away, as it would
+    only go stale: the next subscriber's first poll asks the backend for
+    its recent samples instead of everything since the previous shot.
+    """
+
+    def __init__(self, fetch, capacity=1024, interval=0.1):
+        self.buffer = TelemetryBuffer(capacity)
+        self.interval = interval
+        self._subscribers = []
+        self._poller = Poller(
+            fetch,
+            interval,
+            self._on_samples,
+            args=lambda: (self.buffer.latest_t,),
+            name="telemetry poll",
+        )
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+        self._poller.start()
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+        if not self._subscribers and self._poller.active:
+            self._poller.stop()
+            self.buffer.clear()
+
+    def _on_samples(self, raw_samples):
+        samples = self.buffer.extend(raw_samples)
+        if samples:
+            for callback in list(self._subscribers):
+                callback(samples)
@@ -0,0 +1,44 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+class Clock:
+    """
+    Clock for the `clock=` arguments that only moves when a test sets `now`
+    """
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def run_main_loop():
+    """
+    Returns run(until): iterates the GLib main context, where handler
+    replies are delivered, until until() is true
+    """
+    from ble import GLib
+
+    def run(until, timeout=2.0):
+        context = GLib.MainContext.default()
+        deadline = time.monotonic() + timeout
+        while not until():
+            if time.monotonic() > deadline:
+                raise AssertionError("timed out waiting for the main loop")
+            if not context.iteration(False):
+                time.sleep(0.001)
+
+    return run
@@ -0,0 +1,130 @@
+import pytest
+
+import advertising
+from advertising import AdField, AdvertisingManager
+from beacon import empty_status
+
+ESPRESSO_SVC_UUID = "12634d89-d598-4874-8e86-7d042ee07ba7"
+
+
+def manager(**kwargs):
+    # layout() needs no bus, only build() exports anything
+    return AdvertisingManager(None, "/test/advertisement", **kwargs)
+
+
+def used(payload, budget=advertising.LEGACY_PAYLOAD_SIZE):
+    # including the Flags the first peripheral payload starts with
+    return budget - payload.free
+
+
+def test_field_sizes():
+    assert AdField(advertising.UUID, "180d").reserved == 2
+    assert AdField(advertising.UUID, ESPRESSO_SVC_UUID).reserved == 16
+    assert AdField(advertising.TX_POWER).reserved == 3
+    assert AdField(advertising.MANUFACTURER, 0xFFFF, (b"pt",)).reserved == 6
+    assert AdField(advertising.SERVICE, "180d", (b"\x01",)).reserved == 5
+    assert AdField(advertising.NAME, values=("Vivaldi",)).reserved == 9
+
+
+def test_field_reserves_its_largest_value():
+    field = AdField(advertising.MANUFACTURER, 0xFFFF, values=(b"a", b"abcd", b"ab"))
+    assert field.reserved == 8
+    assert field.value == b"a"
+
+
+def test_unknown_kind():
+    with pytest.raises(ValueError):
+        AdField("appearance")
+
+
+def test_espresso_advertisement_takes_30_bytes():
+    ads = manager()
+    ads.add(advertising.UUID, ESPRESSO_SVC_UUID)
+    ads.add(advertising.TX_POWER)
+    ads.add(advertising.MANUFACTURER, 0xFFFF, bytes([0x70, 0x74]))
+    ads.add(advertising.NAME, value="Vivaldi")
+
+    [(data, scan_response)] = ads.layout()
+    # Flags 3, UUID list 2 + 16, TX power 3, manufacturer data 4 + 2
+    assert used(data) == 30
+    assert [f.kind for f in data.fields] == [
+        advertising.UUID, advertising.TX_POWER, advertising.MANUFACTURER,
+    ]
+    assert [f.kind for f in scan_response.fields] == [advertising.NAME]
+
+
+def test_status_record_spills_to_a_second_instance():
+    ads = manager(max_instances=2)
+    ads.add(advertising.UUID, ESPRESSO_SVC_UUID)
+    ads.add(advertising.TX_POWER)
+    status = ads.add(advertising.MANUFACTURER, 0xFFFF, empty_status(), scan_response=False)
+    ads.add(advertising.NAME, value="Vivaldi")
+
+    first, second = ads.layout()
+    assert status not in first[0].fields + first[1].fields
+    # broadcasts carry no Flags, so the whole budget is left for the record
+    assert second[0].fields == [status]
+    assert used(second[0]) == 4 + len(empty_status())
+    assert [f.kind for f in first[1].fields] == [advertising.NAME]
+
+
+def test_status_record_does_not_fit_one_instance():
+    ads = manager(max_instances=1)
+    ads.add(advertising.UUID, ESPRESSO_SVC_UUID)
+    ads.add(advertising.TX_POWER)
+    ads.add(advertising.MANUFACTURER, 0xFFFF, empty_status(), scan_response=False)
+    with pytest.raises(ValueError):
+        ads.layout()
+
+
+def test_uuids_of_one_width_share_a_header():
+    ads = manager()
+    ads.add(advertising.UUID, "180d")
+    ads.add(advertising.UUID, "180f")
+    ads.add(advertising.UUID, ESPRESSO_SVC_UUID)
+
+    [(data, _)] = ads.layout()
+    # Flags 3, one 16-bit list (2 + 2 + 2) and one 128-bit list (2 + 16)
+    assert used(data) == 27
+
+
+def test_flags_only_counted_for_a_peripheral():
+    for ad_type, free in (("peripheral", 25), ("broadcast", 28)):
+        ads = manager(ad_type=ad_type)
+        ads.add(advertising.TX_POWER)
+        [(data, _)] = ads.layout()
+        assert data.free == free
+
+
+def test_overflow_goes_to_the_scan_response():
+    ads = manager()
+    ads.add(advertising.UUID, ESPRESSO_SVC_UUID)
+    ads.add(advertising.MANUFACTURER, 0xFFFF, bytes(10))
+
+    [(data, scan_response)] = ads.layout()
+    assert [f.kind for f in data.fields] == [advertising.UUID]
+    assert [f.kind for f in scan_response.fields] == [advertising.MANUFACTURER]
+
+
+def test_tx_power_stays_out_of_the_scan_response():
+    ads = manager(max_instances=2)
+    ads.add(advertising.DATA, 0x16, bytes(26))
+    ads.add(advertising.TX_POWER)
+
+    first, second = ads.layout()
+    assert first[1].fields == []
+    assert [f.kind for f in second[0].fields] == [advertising.TX_POWER]
+
+
+def test_field_larger_than_an_advertisement():
+    ads = manager()
+    ads.add(advertising.MANUFACTURER, 0xFFFF, bytes(28))
+    with pytest.raises(ValueError):
+        ads.layout()
+
+
+def test_fields_are_added_before_build():
+    ads = manager()
+    ads.instances.append(object())
+    with pytest.raises(RuntimeError):
+        ads.add(advertising.TX_POWER)
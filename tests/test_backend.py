@@ -0,0 +1,106 @@
+from backend import CircuitBreaker, CommandQueue
+from ble import FailedException
+
+
+def test_circuit_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10.0, clock=clock)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_success_resets_the_failure_count(clock):
+    breaker = CircuitBreaker(failure_threshold=2, clock=clock)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_lets_one_trial_through(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10.0, clock=clock)
+    breaker.record_failure()
+
+    clock.now = 10.0
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_failed_trial_opens_the_circuit_again(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10.0, clock=clock)
+    breaker.record_failure()
+    clock.now = 10.0
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now = 19.0
+    assert not breaker.allow()
+
+
+class Backend:
+    def __init__(self, fail=False):
+        self.sent = []
+        self.fail = fail
+
+    def send_command(self, data):
+        return self._send(data)
+
+    def send_commands(self, commands):
+        return self._send(commands)
+
+    def _send(self, body):
+        self.sent.append(body)
+        if self.fail:
+            raise FailedException("backend down")
+        return len(self.sent)
+
+
+def test_commands_under_one_key_are_coalesced(run_main_loop):
+    backend = Backend()
+    sent = []
+    queue = CommandQueue(backend, window=0.01, on_sent=lambda: sent.append(True))
+    first = queue.submit("boiler", {"cmd": "setboiler", "state": "on"})
+    second = queue.submit("boiler", {"cmd": "setboiler", "state": "off"})
+
+    run_main_loop(second.done)
+    assert backend.sent == [{"cmd": "setboiler", "state": "off"}]
+    # both writers get the outcome of the one request
+    assert first.result() == second.result() == 1
+    run_main_loop(lambda: sent)
+
+
+def test_other_keys_are_sent_apart(run_main_loop):
+    backend = Backend()
+    queue = CommandQueue(backend, window=0.01)
+    futures = [queue.submit("boiler", {"cmd": "on"}), queue.submit("machine", {"cmd": "off"})]
+
+    run_main_loop(lambda: all(f.done() for f in futures))
+    assert backend.sent == [{"cmd": "on"}, {"cmd": "off"}]
+
+
+def test_batch_sends_one_request(run_main_loop):
+    backend = Backend()
+    queue = CommandQueue(backend, window=0.01, batch=True)
+    futures = [queue.submit("boiler", {"cmd": "on"}), queue.submit("machine", {"cmd": "off"})]
+
+    run_main_loop(lambda: all(f.done() for f in futures))
+    assert backend.sent == [[{"cmd": "on"}, {"cmd": "off"}]]
+
+
+def test_backend_errors_reach_every_writer(run_main_loop):
+    queue = CommandQueue(Backend(fail=True), window=0.01)
+    futures = [queue.submit("boiler", {"cmd": "on"}), queue.submit("boiler", {"cmd": "off"})]
+
+    run_main_loop(lambda: all(f.done() for f in futures))
+    assert all(isinstance(f.exception(), FailedException) for f in futures)
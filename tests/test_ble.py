@@ -0,0 +1,194 @@
+import types
+from concurrent.futures import Future
+
+import dbus
+
+from ble import (
+    Application,
+    Characteristic,
+    InProgressException,
+    NotPermittedException,
+    Service,
+)
+from sessions import SessionManager
+
+DEVICE = dbus.ObjectPath("/org/bluez/hci0/dev_AA_BB_CC_DD_EE_FF")
+
+
+class Value(Characteristic):
+    """
+    Characteristic holding a value, rejecting writes of b"bad"
+    """
+
+    def __init__(self, service, value=b""):
+        Characteristic.__init__(self, None, 0, "2a00", ["read", "write"], service)
+        self.value = value
+        self.written = []
+
+    def read_value(self, options):
+        return self.value
+
+    def write_value(self, value, options):
+        if bytes(value) == b"bad":
+            raise NotPermittedException("bad value")
+        self.written.append(bytes(value))
+        self.value = bytes(value)
+
+
+def characteristic(sessions=None, value=b""):
+    # attributes are only exported on first use, so no bus is needed
+    service = Service(None, 0, "1234", True, "/test/service")
+    chrc = Value(service, value)
+    service.add_characteristic(chrc)
+    service.application = types.SimpleNamespace(sessions=sessions, recorder=None)
+    return chrc
+
+
+class Call:
+    """
+    reply_handler/error_handler pair remembering how a call was answered
+    """
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.done = False
+
+    def reply(self, *result):
+        self.result = result[0] if result else None
+        self.done = True
+
+    def fail(self, error):
+        self.error = error
+        self.done = True
+
+
+def write(chrc, value, run_main_loop, **options):
+    options.setdefault("device", DEVICE)
+    call = Call()
+    chrc.WriteValue(
+        dbus.ByteArray(value), options, reply_handler=call.reply, error_handler=call.fail
+    )
+    run_main_loop(lambda: call.done)
+    return call
+
+
+def test_throttled_write_requests_are_rejected(run_main_loop, clock):
+    chrc = characteristic(SessionManager(write_rate=1.0, write_burst=1, clock=clock))
+    assert write(chrc, b"1", run_main_loop, type="request").error is None
+    assert isinstance(write(chrc, b"2", run_main_loop, type="request").error, InProgressException)
+
+
+def test_write_commands_are_not_throttled(run_main_loop, clock):
+    chrc = characteristic(SessionManager(write_rate=1.0, write_burst=1, clock=clock))
+    for value in (b"1", b"2", b"3"):
+        assert write(chrc, value, run_main_loop, type="command").error is None
+    run_main_loop(lambda: len(chrc.written) == 3)
+    assert chrc.value == b"3"
+
+
+def read(chrc, run_main_loop, **options):
+    options.setdefault("device", DEVICE)
+    call = Call()
+    chrc.ReadValue(options, reply_handler=call.reply, error_handler=call.fail)
+    run_main_loop(lambda: call.done)
+    return call
+
+
+def test_long_read_is_served_from_the_first_read(run_main_loop):
+    chrc = characteristic(value=b"0123456789")
+    assert bytes(read(chrc, run_main_loop).result) == b"0123456789"
+
+    # the value changes between the requests of one long read
+    chrc.value = b"abcdefghij"
+    assert bytes(read(chrc, run_main_loop, offset=dbus.UInt16(4)).result) == b"456789"
+    assert bytes(read(chrc, run_main_loop).result) == b"abcdefghij"
+
+
+def test_long_read_offset_past_the_end(run_main_loop):
+    chrc = characteristic(value=b"0123")
+    read(chrc, run_main_loop)
+    assert read(chrc, run_main_loop, offset=dbus.UInt16(5)).error is not None
+
+
+def test_invalid_write_request_reports_the_error(run_main_loop):
+    chrc = characteristic()
+    call = write(chrc, b"bad", run_main_loop, type="request", mtu=dbus.UInt16(8))
+    assert isinstance(call.error, NotPermittedException)
+
+
+def test_invalid_reliable_write_reports_the_error(run_main_loop):
+    chrc = characteristic()
+    call = write(chrc, b"bad", run_main_loop, type="reliable")
+    assert isinstance(call.error, NotPermittedException)
+    assert chrc.written == []
+
+
+def test_reliable_write_is_applied_before_the_reply(run_main_loop):
+    chrc = characteristic()
+    assert write(chrc, b"long value", run_main_loop, type="reliable").error is None
+    assert chrc.written == [b"long value"]
+
+
+def test_chunk_continuing_a_reliable_write(run_main_loop):
+    chrc = characteristic()
+    write(chrc, b"0123", run_main_loop, type="reliable")
+    assert write(chrc, b"4567", run_main_loop, type="reliable", offset=dbus.UInt16(4)).error is None
+
+    run_main_loop(lambda: len(chrc.written) == 2)
+    assert chrc.written == [b"0123", b"01234567"]
+
+
+def test_chunk_at_the_wrong_offset(run_main_loop):
+    chrc = characteristic()
+    write(chrc, b"0123", run_main_loop, type="reliable")
+    assert write(chrc, b"x", run_main_loop, type="reliable", offset=dbus.UInt16(9)).error is not None
+    assert write(characteristic(), b"x", run_main_loop, offset=dbus.UInt16(2)).error is not None
+
+
+def test_mtu_is_kept_per_central(run_main_loop):
+    chrc = characteristic(value=b"x")
+    read(chrc, run_main_loop, mtu=dbus.UInt16(185))
+    read(chrc, run_main_loop, device=dbus.ObjectPath("/org/bluez/hci0/dev_2"), mtu=dbus.UInt16(64))
+    assert chrc.negotiated_mtu(DEVICE) == 185
+    assert chrc.notify_mtu() == 64
+
+
+def test_ended_session_drops_the_central_state(run_main_loop, clock):
+    sessions = SessionManager(clock=clock)
+    chrc = characteristic(sessions, value=b"0123")
+    application = types.SimpleNamespace(services=[chrc.service])
+    sessions.on_end.append(lambda device: Application.forget_device(application, device))
+
+    read(chrc, run_main_loop, mtu=dbus.UInt16(185))
+    write(chrc, b"01", run_main_loop, type="reliable")
+    assert write(chrc, b"23", run_main_loop, type="reliable", offset=dbus.UInt16(2)).error is None
+
+    sessions.end(DEVICE)
+    assert DEVICE not in chrc._mtus
+    assert DEVICE not in chrc._read_snapshots
+    assert DEVICE not in chrc._pending_writes
+    # the pending chunk is still applied
+    run_main_loop(lambda: chrc.written == [b"01", b"0123"])
+
+
+def test_write_value_may_return_a_future(run_main_loop):
+    chrc = characteristic()
+    outcome = Future()
+    called = []
+
+    def write_value(value, options):
+        called.append(value)
+        return outcome
+
+    chrc.write_value = write_value
+    call = Call()
+    chrc.WriteValue(
+        dbus.ByteArray(b"1"), {"device": DEVICE}, reply_handler=call.reply, error_handler=call.fail
+    )
+    run_main_loop(lambda: called)
+    assert not call.done
+
+    outcome.set_exception(NotPermittedException("rejected"))
+    run_main_loop(lambda: call.done)
+    assert isinstance(call.error, NotPermittedException)
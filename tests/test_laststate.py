@@ -0,0 +1,43 @@
+import time
+
+from laststate import LastStateStore
+
+
+def reloaded(path, key, timeout=2.0):
+    # saves are written by a background thread
+    deadline = time.monotonic() + timeout
+    while True:
+        entry = LastStateStore(path).get(key)
+        if entry is not None or time.monotonic() > deadline:
+            return entry
+        time.sleep(0.01)
+
+
+def test_a_snapshot_survives_a_restart(tmp_path):
+    path = str(tmp_path / "last_state.sqlite")
+    LastStateStore(path).put("machine", {"power": True, "boiler": 93.5}, 1000.0)
+    assert reloaded(path, "machine") == ({"power": True, "boiler": 93.5}, 1000.0)
+
+
+def test_lookups_see_the_latest_snapshot_before_it_is_written(tmp_path):
+    store = LastStateStore(str(tmp_path / "last_state.sqlite"))
+    store.put("machine", {"power": True}, 1000.0)
+    store.put("machine", {"power": False}, 1001.0)
+    assert store.get("machine") == ({"power": False}, 1001.0)
+    assert store.get("other") is None
+
+
+def test_an_unchanged_snapshot_is_rewritten_only_after_the_refresh_interval(tmp_path):
+    store = LastStateStore(str(tmp_path / "last_state.sqlite"), refresh_interval=30.0)
+    store.put("machine", {"power": True}, 1000.0)
+    store.put("machine", {"power": True}, 1010.0)
+    assert store._written["machine"][1] == 1000.0
+    assert store.get("machine") == ({"power": True}, 1010.0)
+
+    store.put("machine", {"power": True}, 1040.0)
+    assert store._written["machine"][1] == 1040.0
+
+
+def test_an_unusable_file_leaves_the_store_empty(tmp_path):
+    store = LastStateStore(str(tmp_path))
+    assert store.get("machine") is None
@@ -0,0 +1,26 @@
+import json
+import socket
+import urllib.request
+
+import metrics
+
+
+def test_serves_metrics_and_health():
+    metrics.registry.inc("test_requests_total", (("path", "/x"),))
+    server = metrics.serve(0, health=lambda: {"healthy": True})
+    try:
+        base = "http://127.0.0.1:%d" % server.server_address[1]
+        text = urllib.request.urlopen(base + "/metrics").read().decode()
+        assert 'test_requests_total{path="/x"}' in text
+        assert json.loads(urllib.request.urlopen(base + "/health").read()) == {"healthy": True}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_port_in_use_is_logged_not_raised(caplog):
+    with socket.socket() as taken:
+        taken.bind(("127.0.0.1", 0))
+        taken.listen()
+        assert metrics.serve(taken.getsockname()[1]) is None
+    assert "Could not serve metrics" in caplog.text
@@ -0,0 +1,72 @@
+import json
+import time
+
+from pairing import PairingPolicy, TrustStore, device_address
+
+PHONE = "AA:BB:CC:DD:EE:FF"
+
+
+def saved(path, timeout=2.0):
+    # saves are written by a background thread
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            if time.monotonic() > deadline:
+                raise
+        time.sleep(0.01)
+
+
+def test_device_address_from_an_object_path():
+    assert device_address("/org/bluez/hci0/dev_aa_bb_cc_dd_ee_ff") == PHONE
+
+
+def test_listed_addresses_and_ouis_are_allowed():
+    policy = PairingPolicy(allow_addresses=["aa-bb-cc-dd-ee-ff"], allow_ouis=["11:22:33"])
+    assert policy.allows(PHONE)
+    assert policy.allows("11:22:33:44:55:66")
+    assert not policy.allows("11:22:34:44:55:66")
+
+
+def test_allow_unknown_applies_only_without_allow_lists():
+    assert PairingPolicy(allow_unknown=True).allows(PHONE)
+    assert not PairingPolicy(allow_unknown=False).allows(PHONE)
+    assert not PairingPolicy(allow_ouis=["11:22:33"], allow_unknown=True).allows(PHONE)
+
+
+def test_only_listed_devices_are_trusted(tmp_path):
+    store = TrustStore(str(tmp_path / "trusted_devices.json"))
+    policy = PairingPolicy(allow_ouis=["AA:BB:CC"], allow_unknown=True, store=store)
+    policy.trust(PHONE)
+    policy.trust("11:22:33:44:55:66")
+    assert PHONE in store
+    assert len(store) == 1
+
+
+def test_a_trusted_device_stays_allowed_after_the_lists_change(tmp_path):
+    path = str(tmp_path / "trusted_devices.json")
+    PairingPolicy(allow_addresses=[PHONE], store=TrustStore(path)).trust(PHONE)
+    assert PHONE in saved(path)
+
+    policy = PairingPolicy(allow_addresses=["11:22:33:44:55:66"], store=TrustStore(path))
+    assert policy.allows(PHONE)
+
+
+def test_removed_devices_are_saved_too(tmp_path):
+    path = str(tmp_path / "trusted_devices.json")
+    store = TrustStore(path)
+    store.add(PHONE)
+    store.remove(PHONE)
+    deadline = time.monotonic() + 2
+    while saved(path) != {}:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert PHONE not in TrustStore(path)
+
+
+def test_an_unreadable_store_starts_empty(tmp_path):
+    path = tmp_path / "trusted_devices.json"
+    path.write_text("not json")
+    assert len(TrustStore(str(path))) == 0
@@ -0,0 +1,78 @@
+import pytest
+
+import recorder
+
+
+@pytest.fixture
+def log(tmp_path):
+    return str(tmp_path / "traffic.log")
+
+
+def record_calls(path, payloads, clock):
+    traffic = recorder.TrafficRecorder(path, payloads=payloads, clock=clock)
+    device = "/org/bluez/hci0/dev_AA_BB_CC_DD_EE_FF"
+
+    call = traffic.begin("ReadValue", "/app/service0/char0", ({"device": device, "mtu": 185},))
+    clock.now += 0.002
+    call.done(b"abcd")
+
+    call = traffic.begin(
+        "WriteValue", "/app/service0/char1", (b"\x01\x02", {"device": device, "type": "request"})
+    )
+    clock.now += 0.001
+    call.done(error=ValueError("no"))
+
+    traffic.begin("StartNotify", "/app/service0/char0", ()).done()
+    traffic.begin("GetManagedObjects", "/app", ()).done({"a": 1, "b": 2})
+    assert traffic.begin("GetAll", "/app/service0", ("x",)) is None
+    traffic.close()
+    return device
+
+
+def test_round_trip(log, clock):
+    device = record_calls(log, True, clock)
+    _, calls = recorder.read_log(log)
+
+    read, write, notify, managed = calls
+    assert (read.op, read.path, read.device, read.mtu, read.size) == (
+        recorder.READ_VALUE, "/app/service0/char0", device, 185, 4,
+    )
+    assert read.t == 0.0
+    assert read.latency == pytest.approx(0.002, abs=1e-5)
+    assert read.result == recorder.OK
+
+    assert write.op == recorder.WRITE_VALUE
+    assert write.result == recorder.ERROR
+    assert write.payload == b"\x01\x02"
+    assert write.options() == {"device": device, "type": "request"}
+
+    assert (notify.op, notify.device) == (recorder.START_NOTIFY, None)
+    assert (managed.op, managed.path, managed.size) == (recorder.GET_MANAGED_OBJECTS, "/app", 2)
+
+
+def test_payloads_are_left_out_by_default(log, clock):
+    record_calls(log, False, clock)
+    _, calls = recorder.read_log(log)
+    assert calls[1].size == 2
+    assert calls[1].payload is None
+
+
+@pytest.mark.parametrize("cut", [1, recorder.NAME_RECORD.size + 3, 5])
+def test_truncated_log(log, clock, cut):
+    record_calls(log, False, clock)
+    with open(log, "rb") as f:
+        data = f.read()
+    _, complete = recorder.read_log(log)
+
+    # a crash can cut the log anywhere, even inside a record
+    with open(log, "wb") as f:
+        f.write(data[: recorder.HEADER.size + cut])
+    _, calls = recorder.read_log(log)
+    assert len(calls) < len(complete)
+
+
+def test_not_a_log(log):
+    with open(log, "wb") as f:
+        f.write(recorder.HEADER.pack(b"NOPE", 1, 0, 0.0))
+    with pytest.raises(ValueError):
+        recorder.read_log(log)
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+import schema
+from ble import InvalidArgsException, InvalidValueLengthException, NotPermittedException
+from schema import CharacteristicSpec, SchemaError
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def spec(**kwargs):
+    return CharacteristicSpec(dict({"uuid": "2a00", "flags": ["read"]}, **kwargs))
+
+
+def test_utf8_round_trip():
+    chrc = spec(codec="utf8")
+    assert chrc.encode("ON") == b"ON"
+    assert chrc.decode(bytearray(b"ON")) == "ON"
+
+
+def test_utf8_rejects_invalid_bytes():
+    with pytest.raises(InvalidArgsException):
+        spec(codec="utf8").decode(b"\xff\xfe")
+
+
+def test_utf8_enum_only_accepts_its_values():
+    chrc = spec(codec="utf8-enum", values=["ON", "OFF"])
+    assert chrc.decode(b"OFF") == "OFF"
+    with pytest.raises(NotPermittedException):
+        chrc.decode(b"MAYBE")
+
+
+def test_utf8_enum_needs_values():
+    with pytest.raises(SchemaError):
+        spec(codec="utf8-enum")
+
+
+@pytest.mark.parametrize(
+    "codec, value, encoded",
+    [
+        ("uint8", 200, b"\xc8"),
+        ("int16", -2, b"\xfe\xff"),
+        ("uint16", 0x1234, b"\x34\x12"),
+        ("int32", -1, b"\xff\xff\xff\xff"),
+        ("uint32", 1, b"\x01\x00\x00\x00"),
+    ],
+)
+def test_struct_codecs_are_little_endian(codec, value, encoded):
+    chrc = spec(codec=codec)
+    assert chrc.encode(value) == encoded
+    assert chrc.decode(encoded) == value
+
+
+def test_struct_codec_checks_the_length():
+    with pytest.raises(InvalidValueLengthException):
+        spec(codec="int32").decode(b"\x01\x00")
+
+
+def test_unknown_codec():
+    with pytest.raises(SchemaError):
+        spec(codec="float")
+
+
+def test_missing_flags():
+    with pytest.raises(SchemaError):
+        CharacteristicSpec({"uuid": "2a00"})
+
+
+def test_command_placeholders():
+    make_command = schema.compile_command({"cmd": "setboiler", "state": "$lower", "raw": "$value"})
+    assert make_command("ON") == {"cmd": "setboiler", "state": "on", "raw": "ON"}
+    # each call gets a fresh dict
+    make_command("OFF")["cmd"] = "changed"
+    assert make_command("OFF")["cmd"] == "setboiler"
+
+
+def test_load_vivaldi_schema():
+    [service] = schema.load_schema(os.path.join(ROOT, "vivaldi_gatt.json"))
+    assert service.uuid == "12634d89-d598-4874-8e86-7d042ee07ba7"
+    fields = {c.field: c for c in service.characteristics}
+    assert fields["machine"].make_command(fields["machine"].decode(b"ON")) == {"cmd": "on"}
+    assert fields["autoOffMinutes"].decode(b"\x1e\x00\x00\x00") == 30
@@ -0,0 +1,36 @@
+from sessions import SessionManager, TokenBucket
+
+
+def test_token_bucket_allows_a_burst_then_the_rate(clock):
+    bucket = TokenBucket(rate=2.0, burst=3, clock=clock)
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+
+    clock.now = 0.5
+    assert bucket.take()
+    assert not bucket.take()
+
+
+def test_token_bucket_refills_up_to_the_burst(clock):
+    bucket = TokenBucket(rate=10.0, burst=2, clock=clock)
+    bucket.take()
+    bucket.take()
+
+    clock.now = 60.0
+    assert [bucket.take() for _ in range(3)] == [True, True, False]
+
+
+def test_each_central_has_its_own_buckets(clock):
+    sessions = SessionManager(read_rate=1.0, read_burst=1, clock=clock)
+    first = sessions.admit("/org/bluez/hci0/dev_1")
+    second = sessions.admit("/org/bluez/hci0/dev_2")
+    assert first.take("/char0", "read")
+    assert not first.take("/char0", "read")
+    assert first.take("/char1", "read")
+    assert second.take("/char0", "read")
+
+
+def test_clear_ends_every_session(clock):
+    sessions = SessionManager(max_sessions=1, clock=clock)
+    sessions.admit("/org/bluez/hci0/dev_1")
+    sessions.clear()
+    assert sessions.admit("/org/bluez/hci0/dev_2") is not None
@@ -0,0 +1,267 @@
+import threading
+import time
+
+import pytest
+
+from status import MachineStatus, StatusPoller
+
+
+class Store:
+    def __init__(self, stored=None):
+        self.stored = stored
+        self.puts = []
+
+    def get(self, key):
+        return self.stored
+
+    def put(self, key, snapshot, fetched_at=None):
+        self.puts.append(snapshot)
+
+
+class Backend:
+    """
+    get_status that returns `snapshot`, blocks while `gate` is cleared and
+    raises `error` if set
+    """
+
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot or {"power": True}
+        self.error = None
+        self.calls = 0
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def __call__(self):
+        self.calls += 1
+        self.gate.wait(5)
+        if self.error is not None:
+            raise self.error
+        return dict(self.snapshot)
+
+
+def test_a_slow_refresh_is_answered_from_the_previous_snapshot(clock):
+    backend = Backend({"power": True})
+    status = MachineStatus(backend, max_age=1.0, clock=clock, stale_wait=0.05)
+    assert status.get() == {"power": True}
+
+    clock.now = 5.0
+    backend.gate.clear()
+    backend.snapshot = {"power": False}
+    start = time.monotonic()
+    assert status.get() == {"power": True}
+    assert time.monotonic() - start < 1.0
+
+    backend.gate.set()
+    deadline = time.monotonic() + 2
+    while status.get() != {"power": False}:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert status.source == MachineStatus.LIVE
+
+
+def test_a_failed_refresh_falls_back_to_the_last_snapshot(clock):
+    backend = Backend({"power": True})
+    status = MachineStatus(backend, max_age=1.0, clock=clock)
+    status.get()
+
+    clock.now = 5.0
+    backend.error = OSError("backend down")
+    assert status.get() == {"power": True}
+    assert status.source == MachineStatus.STORED
+
+
+def test_without_a_snapshot_a_failed_refresh_raises(clock):
+    backend = Backend()
+    backend.error = OSError("backend down")
+    status = MachineStatus(backend, clock=clock)
+    with pytest.raises(OSError):
+        status.get()
+
+
+def test_a_stored_snapshot_is_served_at_once_and_replaced(clock):
+    store = Store(({"power": False}, time.time() - 60))
+    backend = Backend({"power": True})
+    backend.gate.clear()
+    status = MachineStatus(backend, clock=clock, store=store, key="machine")
+
+    assert status.get() == {"power": False}
+    assert status.source == MachineStatus.STORED
+    assert status.age() >= 60
+
+    backend.gate.set()
+    deadline = time.monotonic() + 2
+    while status.source != MachineStatus.LIVE:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert status.get() == {"power": True}
+    assert store.puts == [{"power": True}]
+
+
+def test_a_snapshot_fetched_before_an_invalidation_is_not_stored(clock):
+    store = Store()
+    backend = Backend({"power": True})
+
+    def invalidated_midway():
+        result = backend()
+        status.invalidate()
+        return result
+
+    status = MachineStatus(invalidated_midway, clock=clock, store=store, key="machine")
+    status.get()
+    assert store.puts == []
+
+
+def test_a_fresh_snapshot_is_served_without_a_fetch(clock):
+    backend = Backend()
+    status = MachineStatus(backend, max_age=2.0, clock=clock)
+    status.get()
+    clock.now = 1.5
+    assert status.field("power") is True
+    assert backend.calls == 1
+
+    clock.now = 2.0
+    status.get()
+    assert backend.calls == 2
+
+
+def test_concurrent_reads_share_one_fetch(clock):
+    backend = Backend({"power": True})
+    backend.gate.clear()
+    status = MachineStatus(backend, clock=clock)
+    results = []
+    readers = [threading.Thread(target=lambda: results.append(status.get())) for _ in range(5)]
+    for reader in readers:
+        reader.start()
+
+    deadline = time.monotonic() + 2
+    while backend.calls == 0:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    backend.gate.set()
+    for reader in readers:
+        reader.join(2)
+
+    assert results == [{"power": True}] * 5
+    assert backend.calls == 1
+
+
+def test_followers_see_the_leaders_error(clock):
+    backend = Backend()
+    backend.gate.clear()
+    backend.error = OSError("backend down")
+    status = MachineStatus(backend, clock=clock)
+    errors = []
+
+    def read():
+        try:
+            status.get()
+        except OSError as e:
+            errors.append(e)
+
+    readers = [threading.Thread(target=read) for _ in range(3)]
+    for reader in readers:
+        reader.start()
+    deadline = time.monotonic() + 2
+    while backend.calls == 0:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    backend.gate.set()
+    for reader in readers:
+        reader.join(2)
+
+    assert len(errors) == 3
+    assert backend.calls == 1
+
+
+def test_invalidate_forces_the_next_read_to_fetch(clock):
+    backend = Backend({"power": True})
+    status = MachineStatus(backend, max_age=60.0, clock=clock)
+    status.get()
+
+    backend.snapshot = {"power": False}
+    status.invalidate()
+    assert status.get() == {"power": False}
+    assert backend.calls == 2
+
+
+def test_a_fetch_started_before_invalidate_does_not_become_the_snapshot(clock):
+    backend = Backend({"power": True})
+    posted = []
+
+    def fetch():
+        result = backend()
+        if not posted:
+            # a command lands while the first fetch is on the wire
+            posted.append(True)
+            backend.snapshot = {"power": False}
+            status.invalidate()
+        return result
+
+    status = MachineStatus(fetch, max_age=60.0, clock=clock)
+    status.get()
+    assert status.get() == {"power": False}
+    assert backend.calls == 2
+
+
+class Snapshots:
+    """
+    status for a StatusPoller that returns `snapshots` in turn, then the
+    last one again
+    """
+
+    def __init__(self, *snapshots):
+        self.snapshots = list(snapshots)
+        self.calls = 0
+
+    def get(self):
+        self.calls += 1
+        if len(self.snapshots) > 1:
+            return self.snapshots.pop(0)
+        return self.snapshots[0]
+
+
+def test_poller_calls_subscribers_only_when_their_field_changes(run_main_loop):
+    status = Snapshots(
+        {"power": True, "boiler": 90.0},
+        {"power": True, "boiler": 91.0},
+        {"power": False, "boiler": 91.0},
+    )
+    poller = StatusPoller(status, interval=0.01)
+    power, boiler = [], []
+    poller.subscribe("power", power.append)
+    poller.subscribe("boiler", boiler.append)
+
+    run_main_loop(lambda: status.calls >= 5)
+    poller.unsubscribe("power", power.append)
+    poller.unsubscribe("boiler", boiler.append)
+
+    assert power == [True, False]
+    assert boiler == [90.0, 91.0]
+
+
+def test_poller_stops_with_the_last_subscriber(run_main_loop):
+    status = Snapshots({"power": True})
+    poller = StatusPoller(status, interval=0.01)
+    first, second = [], []
+    poller.subscribe("power", first.append)
+    poller.subscribe("power", second.append)
+    run_main_loop(lambda: first)
+
+    poller.unsubscribe("power", first.append)
+    assert poller.active
+    poller.unsubscribe("power", second.append)
+    assert not poller.active
+
+
+def test_a_new_subscriber_gets_the_current_value_again(run_main_loop):
+    status = Snapshots({"power": True})
+    poller = StatusPoller(status, interval=0.01)
+    first, second = [], []
+    poller.subscribe("power", first.append)
+    run_main_loop(lambda: first)
+    poller.unsubscribe("power", first.append)
+
+    poller.subscribe("power", second.append)
+    run_main_loop(lambda: second)
+    poller.unsubscribe("power", second.append)
+    assert first == second == [True]
@@ -0,0 +1,63 @@
+import telemetry
+from telemetry import FRAME_HEADER, SAMPLE, Sample
+
+
+def test_frame_layout():
+    samples = [Sample(0x10001, 1000, 9.0, 93.5, 1.25), Sample(0x10002, 1100, 9.01, -1.0, 0)]
+    frame = telemetry.pack_frame(samples, previous_t=950)
+
+    assert len(frame) == FRAME_HEADER.size + 2 * SAMPLE.size
+    # the sequence number is cut to 16 bits
+    assert FRAME_HEADER.unpack_from(frame) == (telemetry.FRAME_VERSION, 2, 0x0001)
+    assert SAMPLE.unpack_from(frame, FRAME_HEADER.size) == (50, 900, 9350, 125)
+    assert SAMPLE.unpack_from(frame, FRAME_HEADER.size + SAMPLE.size) == (100, 901, -100, 0)
+
+
+def test_first_delta_is_zero_without_previous_frame():
+    frame = telemetry.pack_frame([Sample(1, 500, 0, 0, 0)])
+    assert SAMPLE.unpack_from(frame, FRAME_HEADER.size)[0] == 0
+
+
+def test_values_are_clamped():
+    frame = telemetry.pack_frame([Sample(1, 0, 1000.0, 500.0, -3.0)], previous_t=-100000)
+    assert SAMPLE.unpack_from(frame, FRAME_HEADER.size) == (0xFFFF, 0xFFFF, 0x7FFF, 0)
+
+
+def test_samples_per_frame():
+    # 23 byte default MTU: 20 byte notifications, 4 byte header, 8 byte samples
+    assert telemetry.samples_per_frame(23) == 2
+    assert telemetry.samples_per_frame(247) == 30
+    assert telemetry.samples_per_frame(5) == 1
+
+
+def test_decimate_keeps_the_newest_sample():
+    assert telemetry.decimate([1, 2, 3, 4]) == [2, 4]
+    assert telemetry.decimate([1, 2, 3, 4, 5]) == [1, 3, 5]
+
+
+def raw(t):
+    return {"t": t, "pressure": 9.0, "temperature": 93.0, "flow": 2.0}
+
+
+def test_buffer_numbers_and_bounds_samples():
+    buffer = telemetry.TelemetryBuffer(capacity=3)
+    added = buffer.extend([raw(t) for t in (100, 200, 300, 400)])
+    assert [s.seq for s in added] == [0, 1, 2, 3]
+    assert [s.t for s in buffer.recent(10)] == [200, 300, 400]
+    assert buffer.latest_t == 400
+
+
+def test_recent_is_measured_from_the_newest_sample():
+    buffer = telemetry.TelemetryBuffer(capacity=10)
+    buffer.extend([raw(t) for t in (0, 1000, 1500, 2000)])
+    assert [s.t for s in buffer.recent(1)] == [1500, 2000]
+
+
+def test_feed_empties_the_buffer_when_the_last_subscriber_leaves():
+    feed = telemetry.TelemetryFeed(lambda since: [], interval=60)
+    feed.subscribe(print)
+    feed.buffer.extend([raw(100)])
+
+    feed.unsubscribe(print)
+    assert feed.buffer.latest_t is None
+    assert feed.buffer.recent(5) == []